@@ -0,0 +1,103 @@
+"""
+Benchmark HTML pruning on the fixture pages.
+
+Parses every fixture with and without default.pruning applied and reports lxml
+parse time, extraction time and peak RSS. Each (fixture, mode) pair runs in a
+fresh interpreter so peak RSS is not polluted by earlier runs.
+
+Usage (from the repository root):
+    python benchmarks/bench_pruning.py [--repeat 5]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+FIXTURES = [
+    ('fixtures/test0.html', 'product'),
+    ('fixtures/test1.html', 'product'),
+    ('fixtures/test2.html', 'product'),
+    ('fixtures/test3.html', 'product'),
+    ('fixtures/critical_reviews.html', 'reviews'),
+    ('fixtures/qa.html', 'qa'),
+    ('tests/fixtures/search_pages/test0.html', 'search'),
+    ('tests/fixtures/search_pages/test1.html', 'search'),
+]
+
+
+def extract(response, page_type):
+    from default.spiders import amazon, amazon_search
+    if page_type == 'product':
+        amazon.parse_product_page(response, 'bench')
+    elif page_type == 'reviews':
+        amazon.get_reviews(response, [])
+    elif page_type == 'qa':
+        spider = amazon.AmazonSpider(url='https://www.amazon.com/dp/B0BENCH000', job_id='bench')
+        for _ in spider.extract_questions_and_answers(response):
+            pass
+    else:
+        amazon_search.parse_products(response)
+
+
+def run_worker(path, page_type, pruned, repeat):
+    from scrapy.http import HtmlResponse
+    from default.pruning import prune_html
+    from default.settings import HTML_PRUNING
+    with open(os.path.join(ROOT, path), 'rb') as file:
+        raw = file.read()
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    prune_times, parse_times, extract_times = [], [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        body = prune_html(raw, HTML_PRUNING[page_type]) if pruned else raw
+        prune_times.append(time.perf_counter() - start)
+        response = HtmlResponse(url='https://www.amazon.com/dp/B0BENCH000', body=body, encoding='utf-8')
+        start = time.perf_counter()
+        response.selector
+        parse_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        extract(response, page_type)
+        extract_times.append(time.perf_counter() - start)
+        del response
+    print(json.dumps({
+        'bytes': len(body),
+        'prune_ms': statistics.median(prune_times) * 1000,
+        'parse_ms': statistics.median(parse_times) * 1000,
+        'extract_ms': statistics.median(extract_times) * 1000,
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss) / 1024,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--worker', nargs=3, metavar=('PATH', 'PAGE_TYPE', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.worker:
+        path, page_type, mode = args.worker
+        run_worker(path, page_type, mode == 'pruned', args.repeat)
+        return
+
+    header = f"{'fixture':<40} {'mode':<7} {'bytes':>9} {'prune ms':>9} {'parse ms':>9} {'extract ms':>10} {'peak RSS MB':>11}"
+    print(header)
+    print('-' * len(header))
+    for path, page_type in FIXTURES:
+        for mode in ('raw', 'pruned'):
+            output = subprocess.run([sys.executable, __file__, '--repeat', str(args.repeat),
+                                     '--worker', path, page_type, mode],
+                                    check=True, capture_output=True, text=True, cwd=ROOT).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{path:<40} {mode:<7} {result['bytes']:>9} {result['prune_ms']:>9.1f} {result['parse_ms']:>9.1f} "
+                  f"{result['extract_ms']:>10.1f} {result['peak_rss_mb']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
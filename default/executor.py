@@ -0,0 +1,78 @@
+# Off-reactor parsing for CPU heavy spider callbacks.
+#
+# Enable with the PARSE_EXECUTOR_ENABLED setting. Spiders then hand the raw
+# response bytes to a pool of worker processes and get the parsed result back
+# as a Deferred, so the reactor keeps downloading while pages are parsed.
+import asyncio
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from scrapy.http import HtmlResponse
+from scrapy.utils.reactor import is_asyncio_reactor_installed
+from twisted.internet import threads
+from twisted.internet.defer import Deferred
+
+_pool = None
+
+
+def get_pool(max_workers=None):
+    """
+    Return the process-wide worker pool, creating it on first use.
+    The pool is shared by every crawler running in this process and sized to the CPU count by default. It outlives
+    the crawls, e.g. those of a long-lived worker, and is shut down when the process exits.
+    """
+    global _pool
+    if _pool is None:
+        # Workers are spawned rather than forked: forking a process with a running reactor and
+        # its thread pool is unsafe. Scripts that start a crawl themselves need the usual
+        # `if __name__ == '__main__':` guard.
+        _pool = ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),
+                                    mp_context=multiprocessing.get_context('spawn'))
+        atexit.register(shutdown_pool)
+    return _pool
+
+
+def shutdown_pool(wait=True):
+    """Stop the worker processes. The next get_pool call starts a new pool."""
+    global _pool
+    if _pool is not None:
+        atexit.unregister(shutdown_pool)
+        _pool.shutdown(wait=wait)
+        _pool = None
+
+
+def run_parser(parser, url, body, encoding, *args):
+    """
+    Worker side entry point: rebuild the response from its bytes and run the parser on it.
+    :param parser: Module level function taking (response, *args). It is pickled by reference.
+    :return: Whatever the parser returns. It must be picklable.
+    """
+    response = HtmlResponse(url=url, body=body, encoding=encoding)
+    return parser(response, *args)
+
+
+class ParseExecutor(object):
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Return an executor when PARSE_EXECUTOR_ENABLED is set, None otherwise."""
+        if not crawler.settings.getbool('PARSE_EXECUTOR_ENABLED'):
+            return None
+        return cls(max_workers=crawler.settings.getint('PARSE_EXECUTOR_WORKERS') or None)
+
+    def submit(self, parser, response, *args) -> Deferred:
+        """
+        Parse a response in a worker process.
+        :param parser: Module level function taking (response, *args).
+        :param response: Scrapy response to parse. Only its url, body and encoding are sent to the worker.
+        :return: Deferred firing with the parser's return value.
+        """
+        future = get_pool(self.max_workers).submit(run_parser, parser, response.url, response.body,
+                                                   response.encoding, *args)
+        if is_asyncio_reactor_installed():
+            return Deferred.fromFuture(asyncio.wrap_future(future))
+        return threads.deferToThread(future.result)
@@ -0,0 +1,138 @@
+# Define here your extensions
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/extensions.html
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+from default import metrics
+from default import signals as project_signals
+
+
+class LatencyMetrics:
+    # Copies the latency histograms recorded by default.metrics.timeit during the
+    # crawl into the stats collector when the spider closes, with p50/p95/p99.
+    # The histograms belong to this crawl, those of other crawls running in the
+    # same process are kept apart.
+
+    percentiles = (50, 95, 99)
+
+    def __init__(self, stats, histograms):
+        self.stats = stats
+        self.histograms = histograms
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not metrics.TIMING_ENABLED:
+            raise NotConfigured
+        ext = cls(crawler.stats, metrics.crawl_histograms(crawler))
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        return ext
+
+    def spider_closed(self, spider):
+        lines = []
+        for name, histogram in sorted(self.histograms.items()):
+            values = metrics.write_stats(self.stats, f"timing/{name}", histogram, spider, self.percentiles)
+            summary = ' '.join(f"p{q}={value}ms" for q, value in values.items())
+            lines.append(f"{name}: n={histogram.count} {summary}")
+        if lines:
+            spider.logger.info("Latency percentiles:\n%s", "\n".join(lines))
+
+
+class AdaptiveConcurrency:
+    # Sizes the concurrency of every downloader slot (one per domain) with AIMD,
+    # like TCP congestion control: the window grows by ADAPTIVE_CONCURRENCY_INCREASE
+    # for every window's worth of healthy responses, and is multiplied by
+    # ADAPTIVE_CONCURRENCY_DECREASE on a 503/429, a robot-check page or a latency
+    # above ADAPTIVE_CONCURRENCY_TARGET_LATENCY. Decreases are spaced by
+    # ADAPTIVE_CONCURRENCY_COOLDOWN seconds so that one burst of errors, which
+    # usually comes from requests sent with the old window, only counts once.
+    #
+    # CONCURRENT_REQUESTS still caps the total across slots.
+
+    def __init__(self, crawler, start=8, minimum=1, maximum=64, increase=1.0, decrease=0.5, target_latency=5.0,
+                 cooldown=5.0, backoff_codes=(429, 503)):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+        self.backoff_codes = set(backoff_codes)
+        # Slot key -> [window, time of the last decrease]
+        self.windows = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            start=settings.getint('ADAPTIVE_CONCURRENCY_START', settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN')),
+            minimum=settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1),
+            maximum=settings.getint('ADAPTIVE_CONCURRENCY_MAX', 64),
+            increase=settings.getfloat('ADAPTIVE_CONCURRENCY_INCREASE', 1.0),
+            decrease=settings.getfloat('ADAPTIVE_CONCURRENCY_DECREASE', 0.5),
+            target_latency=settings.getfloat('ADAPTIVE_CONCURRENCY_TARGET_LATENCY', 5.0),
+            cooldown=settings.getfloat('ADAPTIVE_CONCURRENCY_COOLDOWN', 5.0),
+            backoff_codes=settings.getlist('ADAPTIVE_CONCURRENCY_BACKOFF_CODES', [429, 503]),
+        )
+        crawler.signals.connect(ext.response_downloaded, signal=signals.response_downloaded)
+        crawler.signals.connect(ext.request_blocked, signal=project_signals.request_blocked)
+        return ext
+
+    def get_slot(self, request):
+        key = request.meta.get('download_slot')
+        if not key:
+            # data: and file: requests have no host, there is nothing to adapt
+            return key, None
+        return key, self.crawler.engine.downloader.slots.get(key)
+
+    def response_downloaded(self, response, request, spider):
+        key, slot = self.get_slot(request)
+        if slot is None:
+            return
+        latency = request.meta.get('download_latency')
+        if response.status in self.backoff_codes:
+            self.back_off(key, slot, spider, 'status')
+        elif latency is not None and latency > self.target_latency:
+            self.back_off(key, slot, spider, 'latency')
+        else:
+            state = self.get_state(key)
+            # +increase per window of healthy responses, i.e. roughly per round trip
+            state[0] = min(state[0] + self.increase / state[0], self.maximum)
+            self.apply(key, slot, spider)
+
+    def request_blocked(self, request, response, spider, signature):
+        key, slot = self.get_slot(request)
+        if slot is not None:
+            self.back_off(key, slot, spider, 'blocked')
+
+    def get_state(self, key):
+        state = self.windows.get(key)
+        if state is None:
+            state = self.windows[key] = [float(self.start), 0.0]
+        return state
+
+    def back_off(self, key, slot, spider, reason):
+        state = self.get_state(key)
+        now = time.monotonic()
+        if now - state[1] < self.cooldown:
+            return
+        state[0] = max(state[0] * self.decrease, self.minimum)
+        state[1] = now
+        self.stats.inc_value(f"adaptive_concurrency/{key}/decreases/{reason}", spider=spider)
+        self.apply(key, slot, spider)
+
+    def apply(self, key, slot, spider):
+        window = int(self.windows[key][0])
+        slot.concurrency = window
+        self.stats.set_value(f"adaptive_concurrency/{key}/window", window, spider=spider)
+        self.stats.max_value(f"adaptive_concurrency/{key}/max_window", window, spider=spider)
+        self.stats.min_value(f"adaptive_concurrency/{key}/min_window", window, spider=spider)
@@ -0,0 +1,162 @@
+# HTTP cache storage for HttpCacheMiddleware.
+#
+# Responses are kept in one SQLite database shared by every spider and process
+# on the host, with compressed bodies (zstd when the zstandard package is
+# installed, zlib otherwise). How long a response stays fresh depends on the
+# page type of its request (request.meta['page_type']): prices on product pages
+# change within the hour, Q&A barely changes in a week. The database is kept
+# under HTTPCACHE_MAX_SIZE compressed bytes by evicting the least recently used
+# responses. The total size is kept in the database next to the responses, and
+# updated in the same transactions, so that every process sharing the cache
+# sees the same total.
+import logging
+import os
+import time
+import zlib
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+from default.storage import connect, transaction
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+
+class SqliteCacheStorage(object):
+    """
+    Settings:
+    HTTPCACHE_DIR: Directory of the httpcache.db database, relative to the project's .scrapy directory.
+    HTTPCACHE_EXPIRATION_SECS: Freshness of responses whose page type has no entry in
+                               HTTPCACHE_PAGE_TYPE_EXPIRATION. 0 means they never expire.
+    HTTPCACHE_PAGE_TYPE_EXPIRATION: Freshness in seconds per page type, e.g. {'product': 1800, 'qa': 604800}.
+    HTTPCACHE_MAX_SIZE: Maximum total size of the compressed bodies, in bytes. 0 means unbounded.
+    HTTPCACHE_ZSTD_LEVEL: zstd compression level.
+    """
+
+    def __init__(self, settings):
+        self.path = os.path.join(data_path(settings['HTTPCACHE_DIR'], createdir=True), 'httpcache.db')
+        self.expiration_secs = settings.getint('HTTPCACHE_EXPIRATION_SECS')
+        self.page_type_expiration = settings.getdict('HTTPCACHE_PAGE_TYPE_EXPIRATION')
+        self.max_size = settings.getint('HTTPCACHE_MAX_SIZE', 0)
+        self.zstd_level = settings.getint('HTTPCACHE_ZSTD_LEVEL', 3)
+        self.db = None
+        self.size = 0
+        self.stats = None
+        self._fingerprinter = None
+        self._compressor = zstandard.ZstdCompressor(level=self.zstd_level) if zstandard else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard else None
+
+    def open_spider(self, spider):
+        self._fingerprinter = spider.crawler.request_fingerprinter
+        self.stats = spider.crawler.stats
+        self.db = connect(self.path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        ' fingerprint BLOB PRIMARY KEY, url TEXT NOT NULL, page_type TEXT, status INTEGER NOT NULL,'
+                        ' headers BLOB NOT NULL, body BLOB NOT NULL, codec TEXT NOT NULL, size INTEGER NOT NULL,'
+                        ' stored_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0),'
+                        ' size INTEGER NOT NULL)')
+        with transaction(self.db, 'IMMEDIATE'):
+            # Databases created before the total was kept start from the size of their responses
+            self.db.execute('INSERT OR IGNORE INTO cache_size (id, size)'
+                            ' SELECT 0, COALESCE(SUM(size), 0) FROM responses')
+            self.size = self.read_size()
+        logger.debug(f"Using SQLite cache storage in {self.path} ({self.size} bytes)", extra={'spider': spider})
+
+    def close_spider(self, spider):
+        self.db.close()
+        self.db = None
+
+    def read_size(self):
+        """Return the total size of the cache, as left by the last transaction of any process."""
+        return self.db.execute('SELECT size FROM cache_size WHERE id = 0').fetchone()[0]
+
+    def get_expiration(self, request):
+        return self.page_type_expiration.get(request.meta.get('page_type'), self.expiration_secs)
+
+    def retrieve_response(self, spider, request):
+        """Return the cached response of a request if it is still fresh for its page type, or None otherwise."""
+        page_type = request.meta.get('page_type', 'other')
+        fingerprint = self._fingerprinter.fingerprint(request)
+        row = self.db.execute('SELECT url, status, headers, body, codec, stored_at FROM responses'
+                              ' WHERE fingerprint = ?', (fingerprint,)).fetchone()
+        if row is None:
+            self.stats.inc_value(f"httpcache/{page_type}/miss", spider=spider)
+            return None
+        expiration = self.get_expiration(request)
+        if expiration and time.time() - row['stored_at'] > expiration:
+            self.stats.inc_value(f"httpcache/{page_type}/stale", spider=spider)
+            return None
+        self.stats.inc_value(f"httpcache/{page_type}/hit", spider=spider)
+        self.db.execute('UPDATE responses SET accessed_at = ? WHERE fingerprint = ?', (time.time(), fingerprint))
+        body = self.decompress(row['body'], row['codec'])
+        headers = Headers(headers_raw_to_dict(row['headers']))
+        respcls = responsetypes.from_args(headers=headers, url=row['url'], body=body)
+        return respcls(url=row['url'], headers=headers, status=row['status'], body=body)
+
+    def store_response(self, spider, request, response):
+        """Store a response, unless it is a block page that was given up on."""
+        if 'blocked' in response.flags:
+            return
+        fingerprint = self._fingerprinter.fingerprint(request)
+        body, codec = self.compress(response.body)
+        now = time.time()
+        with transaction(self.db, 'IMMEDIATE'):
+            previous = self.db.execute('SELECT size FROM responses WHERE fingerprint = ?', (fingerprint,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO responses (fingerprint, url, page_type, status, headers, body,'
+                            ' codec, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (fingerprint, response.url, request.meta.get('page_type'), response.status,
+                             headers_dict_to_raw(response.headers), body, codec, len(body), now, now))
+            self.db.execute('UPDATE cache_size SET size = size + ? WHERE id = 0',
+                            (len(body) - (previous['size'] if previous else 0),))
+            self.size = self.read_size()
+        page_type = request.meta.get('page_type', 'other')
+        self.stats.inc_value(f"httpcache/{page_type}/stored_bytes", len(body), spider=spider)
+        self.stats.inc_value(f"httpcache/{page_type}/uncompressed_bytes", len(response.body), spider=spider)
+        if self.max_size and self.size > self.max_size:
+            self.evict(spider)
+
+    def evict(self, spider):
+        # Evict down to 90% of the limit so that every store does not trigger an eviction
+        target = self.max_size * 0.9
+        evicted = 0
+        while self.size > target:
+            with transaction(self.db, 'IMMEDIATE'):
+                # Other processes may have stored or evicted responses since the size was last read
+                self.size = self.read_size()
+                rows = []
+                if self.size > target:
+                    rows = self.db.execute('SELECT fingerprint, size FROM responses ORDER BY accessed_at'
+                                           ' LIMIT 100').fetchall()
+                    if not rows:
+                        self.size = 0
+                for row in rows:
+                    self.db.execute('DELETE FROM responses WHERE fingerprint = ?', (row['fingerprint'],))
+                    self.size -= row['size']
+                    evicted += 1
+                    if self.size <= target:
+                        break
+                self.db.execute('UPDATE cache_size SET size = ? WHERE id = 0', (self.size,))
+            if not rows:
+                break
+        self.stats.inc_value('httpcache/evicted', evicted, spider=spider)
+
+    def compress(self, body):
+        if self._compressor is not None:
+            return self._compressor.compress(body), 'zstd'
+        return zlib.compress(body), 'zlib'
+
+    def decompress(self, body, codec):
+        if codec == 'zstd':
+            if self._decompressor is None:
+                raise RuntimeError("The HTTP cache has zstd compressed responses, install zstandard to read them")
+            return self._decompressor.decompress(body)
+        return zlib.decompress(body)
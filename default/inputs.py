@@ -0,0 +1,130 @@
+# Lazy sources of product URLs for the bulk spiders.
+#
+# A batch of URLs passed as one JSON spider argument is limited by the command
+# line and the schedule API, and sits in memory before the first request. The
+# sources below are read a few URLs at a time instead: a file with one URL (or
+# ASIN) per line, or a SQLite queue other processes can keep filling while the
+# crawl runs. Every URL is normalized to https://<domain>/dp/<ASIN>, so the
+# same product asked for through different links is only fetched once.
+import json
+import re
+import time
+from urllib.parse import urlsplit
+
+from default.storage import connect, transaction
+
+ASIN_RE = re.compile(r'^[A-Z0-9]{10}$')
+# /dp/<ASIN>, /gp/product/<ASIN>, /gp/aw/d/<ASIN> and /product-reviews/<ASIN> links
+URL_ASIN_RE = re.compile(r'/(?:dp|gp/product|gp/aw/d|product-reviews)/([A-Z0-9]{10})(?:[/?#]|$)')
+
+
+def normalize_product_url(value, domain='www.amazon.com'):
+    """
+    Return the canonical product page URL of a product URL or a bare ASIN.
+    :param value: Product URL in any of the usual link forms, or an ASIN.
+    :param domain: Amazon domain of bare ASINs.
+    :return: https://<domain>/dp/<ASIN> (keeping the scheme and host of URLs), or None when value holds no ASIN.
+    """
+    if not isinstance(value, str):
+        return None
+    value = value.strip()
+    if ASIN_RE.match(value):
+        return f"https://{domain}/dp/{value}"
+    parts = urlsplit(value)
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return None
+    match = URL_ASIN_RE.search(parts.path)
+    if match is None:
+        return None
+    return f"{parts.scheme}://{parts.netloc.lower()}/dp/{match.group(1)}"
+
+
+def read_urls_file(path):
+    """
+    Yield the raw URLs of a file, one per line, without reading the whole file.
+    Lines are plain URLs or ASINs, or JSON strings or {"url": ...} objects (JSON lines). Blank lines and lines
+    starting with # are skipped. A JSON line that is malformed or has no string URL is yielded as is, for the caller
+    to report as an invalid URL along with the rest of the file.
+    """
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line[0] in '{"':
+                try:
+                    value = json.loads(line)
+                except ValueError:
+                    value = None
+                if isinstance(value, dict):
+                    value = value.get('url')
+                if isinstance(value, str):
+                    line = value
+            yield line
+
+
+class UrlQueue(object):
+    """
+    SQLite queue of URLs to scrape, a local stand-in for a queue service.
+    Producers put URLs while a crawl claims them in batches and acknowledges each one once it is scraped. A claimed
+    URL is not handed out again unless it is released, or its lease runs out before it is acknowledged (the crawl
+    that claimed it died).
+    :param path: Path of the SQLite database.
+    :param lease: Seconds a claimed URL waits for its acknowledgement, 0 to wait forever.
+    :param batch: Number of URLs claimed at a time when iterating the queue.
+    """
+
+    def __init__(self, path, lease=3600, batch=100):
+        self.lease = lease
+        self.batch = batch
+        # URLs claimed through this queue and neither acknowledged nor released, iterated or not
+        self.claimed = set()
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS urls ('
+                        ' id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL, claimed_at REAL)')
+
+    def put(self, urls):
+        with transaction(self.db):
+            self.db.executemany('INSERT INTO urls (url) VALUES (?)', ((url,) for url in urls))
+
+    def claim(self, limit):
+        """Claim up to `limit` URLs, oldest first."""
+        now = time.time()
+        # Claims are stamped with a positive time, none has expired without a lease
+        expired = now - self.lease if self.lease else 0
+        with transaction(self.db, 'IMMEDIATE'):
+            rows = self.db.execute('SELECT id, url FROM urls WHERE claimed_at IS NULL OR claimed_at <= ?'
+                                   ' ORDER BY id LIMIT ?', (expired, limit)).fetchall()
+            self.db.executemany('UPDATE urls SET claimed_at = ? WHERE id = ?', ((now, row['id']) for row in rows))
+        urls = [row['url'] for row in rows]
+        self.claimed.update(urls)
+        return urls
+
+    def ack(self, url):
+        """Remove a claimed URL from the queue once it is scraped."""
+        self.db.execute('DELETE FROM urls WHERE url = ? AND claimed_at IS NOT NULL', (url,))
+        self.claimed.discard(url)
+
+    def release(self, urls):
+        """Put claimed URLs that were not scraped back in the queue."""
+        urls = list(urls)
+        with transaction(self.db):
+            self.db.executemany('UPDATE urls SET claimed_at = NULL WHERE url = ?', ((url,) for url in urls))
+        self.claimed.difference_update(urls)
+
+    def release_claimed(self):
+        """Put back every URL this queue claimed and did not see acknowledged, including those never iterated."""
+        self.release(self.claimed)
+
+    def pending(self):
+        return self.db.execute('SELECT COUNT(*) FROM urls WHERE claimed_at IS NULL').fetchone()[0]
+
+    def __iter__(self):
+        while True:
+            urls = self.claim(self.batch)
+            if not urls:
+                return
+            yield from urls
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,177 @@
+# Low-overhead latency metrics for extractors and spider callbacks.
+#
+# Timing is switched on with the ENABLE_TIMING environment variable, read once at
+# import. When it is off, the timeit decorator returns the function untouched, so
+# decorated code pays nothing. When it is on, every call is recorded into a
+# fixed-bucket histogram; the LatencyMetrics extension (default/extensions.py)
+# copies the histograms and their p50/p95/p99 into the Scrapy stats when the
+# spider closes instead of logging one line per call.
+#
+# Each crawl with the extension has its own histograms, so the crawls a worker
+# runs side by side in one process do not mix their latencies. A timed spider
+# method records into the histograms of its spider's crawler, and so does
+# everything timed it calls, e.g. the extractors a callback runs.
+import bisect
+import functools
+import inspect
+import os
+import time
+import weakref
+
+TIMING_ENABLED = os.getenv('ENABLE_TIMING', 'false').lower() == 'true'
+
+# Upper bounds of the histogram buckets, in seconds. The last bucket is open-ended.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram(object):
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        Estimate the q-th percentile (0-100) as the upper bound of the bucket it falls in, capped at the largest
+        observed value. Returns None when nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                bound = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def copy(self):
+        histogram = Histogram(self.bounds)
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.total = self.total
+        histogram.max = self.max
+        return histogram
+
+    def since(self, earlier):
+        """Return the observations made after the `earlier` copy of this histogram was taken."""
+        histogram = self.copy()
+        histogram.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        histogram.count -= earlier.count
+        histogram.total -= earlier.total
+        # The exact maximum of the recent observations is unknown, bound it by their highest bucket
+        highest = max((index for index, count in enumerate(histogram.counts) if count), default=None)
+        if highest is not None and highest < len(self.bounds):
+            histogram.max = min(self.max, self.bounds[highest])
+        return histogram
+
+    def bucket_counts(self):
+        """Return the non-empty buckets as a {'<=bound_ms': count} dict."""
+        labels = [f"<={bound * 1000:g}ms" for bound in self.bounds] + [f">{self.bounds[-1] * 1000:g}ms"]
+        return {label: count for label, count in zip(labels, self.counts) if count}
+
+
+def write_stats(stats, prefix, histogram, spider=None, percentiles=(50, 95, 99)):
+    """
+    Write a histogram into the crawl stats under `prefix`: count, total_ms, buckets and p<q>_ms for each percentile.
+    :return: The percentile values, in milliseconds.
+    """
+    stats.set_value(f"{prefix}/count", histogram.count, spider=spider)
+    stats.set_value(f"{prefix}/total_ms", round(histogram.total * 1000, 3), spider=spider)
+    stats.set_value(f"{prefix}/buckets", histogram.bucket_counts(), spider=spider)
+    values = {}
+    for q in percentiles:
+        if histogram.count:
+            values[q] = round(histogram.percentile(q) * 1000, 3)
+            stats.set_value(f"{prefix}/p{q}_ms", values[q], spider=spider)
+    return values
+
+
+# Histograms of the calls made outside any crawl, keyed by metric name
+histograms = {}
+# Histograms of each crawl, by crawler
+_crawls = weakref.WeakKeyDictionary()
+# Histograms of the crawl whose timed code is running, None outside any crawl
+_active = None
+
+
+def crawl_histograms(crawler):
+    """Return the histograms of a crawl, keyed by metric name, which its timed code records into from now on."""
+    return _crawls.setdefault(crawler, {})
+
+
+def _histograms_of(args):
+    # The crawl of a spider method, or the one of the code calling this function
+    crawler = getattr(args[0], 'crawler', None) if args else None
+    if crawler is not None:
+        try:
+            return _crawls.get(crawler, _active)
+        except TypeError:
+            # Not a Crawler, but some other object's crawler attribute
+            pass
+    return _active
+
+
+def observe(name, seconds, target=None):
+    if target is None:
+        target = histograms
+    histogram = target.get(name)
+    if histogram is None:
+        histogram = target[name] = Histogram()
+    histogram.observe(seconds)
+
+
+def _timed_generator(name, generator, elapsed, target):
+    # Only the time spent inside the generator counts, not the time its consumer holds it suspended
+    global _active
+    try:
+        while True:
+            previous, _active = _active, target
+            start = time.perf_counter()
+            try:
+                item = next(generator)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            finally:
+                _active = previous
+            elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        generator.close()
+        observe(name, elapsed, target)
+
+
+def timeit(method):
+    """Decorator recording the execution time of a function or spider callback when ENABLE_TIMING is set."""
+    if not TIMING_ENABLED:
+        return method
+    name = f"{method.__module__.rsplit('.', 1)[-1]}.{method.__qualname__}"
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        global _active
+        target = _histograms_of(args)
+        previous, _active = _active, target
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+        finally:
+            _active = previous
+        if inspect.isgenerator(result):
+            # Callbacks do their work while being iterated, time that instead of the call
+            return _timed_generator(name, result, time.perf_counter() - start, target)
+        observe(name, time.perf_counter() - start, target)
+        return result
+
+    return wrapper
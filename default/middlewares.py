@@ -3,11 +3,28 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import os
+import time
+from weakref import WeakKeyDictionary
+
 from scrapy import signals
+from scrapy.downloadermiddlewares.retry import get_retry_request
+from scrapy.downloadermiddlewares.robotstxt import RobotsTxtMiddleware
+from scrapy.exceptions import IgnoreRequest, NotConfigured, StopDownload
+from scrapy.http import HtmlResponse
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.project import data_path
+from twisted.internet import defer
 
 # useful for handling different item types with a single interface
 from itemadapter import is_item, ItemAdapter
 
+from default import signals as project_signals
+from default.metrics import Histogram
+from default.proxies import BLOCK, ERROR, OK, ProxySessionPool
+from default.pruning import declared_encoding, prune_html
+from default.storage import connect
+
 
 class ProjectnameSpiderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
@@ -101,3 +118,507 @@ class ProjectnameDownloaderMiddleware:
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+
+class HtmlPruningMiddleware:
+    # Empties <script>, <style>, <svg> and similar regions of HTML responses before
+    # the spider builds a DOM from them. What gets pruned is configured per page
+    # type (request.meta['page_type']) through the HTML_PRUNING setting.
+
+    def __init__(self, page_types, stats):
+        self.page_types = page_types
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('HTML_PRUNING_ENABLED'):
+            raise NotConfigured
+        return cls(crawler.settings.getdict('HTML_PRUNING'), crawler.stats)
+
+    def process_response(self, request, response, spider):
+        regions = self.page_types.get(request.meta.get('page_type'))
+        if not regions or not isinstance(response, HtmlResponse):
+            return response
+        body = prune_html(response.body, regions)
+        # Pass the declared charset explicitly so the pruned response never falls back to encoding sniffing
+        encoding = declared_encoding(body, response.headers.get('Content-Type', b'').decode('latin-1'))
+        self.stats.inc_value('html_pruning/bytes_removed', len(response.body) - len(body), spider=spider)
+        self.stats.inc_value('html_pruning/response_count', spider=spider)
+        if encoding:
+            return response.replace(body=body, encoding=encoding)
+        return response.replace(body=body)
+
+
+class ProxySessionPoolMiddleware:
+    # Sends every request through one of a pool of sticky Bright Data sessions
+    # (see default/proxies.py) and reports each outcome back to the pool, which
+    # replaces the sessions whose error or block rate degrades.
+    #
+    # Request meta keys:
+    #   proxy_session_key    requests with the same key stick to the same session
+    #   proxy_session_avoid  ids of sessions not to use, e.g. after a block
+    #   proxy_session        set to the id of the session the request was sent with
+    # Requests that already carry a 'proxy' of their own are left alone.
+    #
+    # SlotAwareScheduler (default/scheduler.py) asks can_send before handing a
+    # request over, so requests wait for a free session in the scheduler rather
+    # than in the downloader. Those that still find every session busy, e.g.
+    # after waiting for robots.txt, wait here until releases free enough of them.
+    #
+    # Must come before HttpProxyMiddleware (750), which turns the credentials of
+    # meta['proxy'] into the Proxy-Authorization header.
+
+    def __init__(self, pool, stats, block_codes=(403, 429, 503)):
+        self.pool = pool
+        self.stats = stats
+        self.block_codes = set(block_codes)
+        # Request -> [session, start time, still counted in flight]
+        self.assigned = WeakKeyDictionary()
+        self.waiters = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('PROXY_POOL_ENABLED'):
+            raise NotConfigured
+        username = os.getenv("BRIGHT_DATA_USERNAME")
+        password = os.getenv("BRIGHT_DATA_PASSWORD")
+        host = os.getenv("BRIGHT_DATA_HOST")
+        if not all([username, password, host]):
+            raise NotConfigured("Missing proxy configuration, requests are sent without a proxy")
+        pool = ProxySessionPool(
+            username, password, host,
+            port=settings.getint('BRIGHT_DATA_PORT', 22225),
+            size=settings.getint('PROXY_POOL_SIZE', 8),
+            max_size=settings.getint('PROXY_POOL_MAX_SIZE', 16),
+            max_in_flight=settings.getint('PROXY_SESSION_MAX_IN_FLIGHT', 4),
+            window=settings.getint('PROXY_SESSION_WINDOW', 20),
+            max_error_rate=settings.getfloat('PROXY_SESSION_MAX_ERROR_RATE', 0.5),
+            max_block_rate=settings.getfloat('PROXY_SESSION_MAX_BLOCK_RATE', 0.2),
+            min_samples=settings.getint('PROXY_SESSION_MIN_SAMPLES', 5),
+        )
+        middleware = cls(pool, crawler.stats, settings.getlist('PROXY_SESSION_BLOCK_CODES', [403, 429, 503]))
+        crawler.signals.connect(middleware.request_left_downloader, signal=signals.request_left_downloader)
+        crawler.signals.connect(middleware.request_blocked, signal=project_signals.request_blocked)
+        return middleware
+
+    def uses_pool(self, request):
+        if 'proxy_session' not in request.meta and request.meta.get('proxy'):
+            return False
+        return urlparse_cached(request).scheme in ('http', 'https')
+
+    def can_send(self, request):
+        """Return whether a request would get a session right away, rather than wait for one."""
+        return not self.uses_pool(request) or self.pool.can_acquire(request.meta.get('proxy_session_avoid', ()))
+
+    def process_request(self, request, spider):
+        if not self.uses_pool(request):
+            return None
+        session = self.pool.acquire(request.meta.get('proxy_session_key'),
+                                    avoid=request.meta.get('proxy_session_avoid', ()))
+        if session is None:
+            # Every session is at PROXY_SESSION_MAX_IN_FLIGHT, wait for one to free up
+            self.stats.inc_value('proxy_pool/waits', spider=spider)
+            waiter = defer.Deferred()
+            waiter.addCallback(lambda _: self.process_request(request, spider))
+            self.waiters.append(waiter)
+            return waiter
+        self.assigned[request] = [session, time.monotonic(), True]
+        request.meta['proxy'] = session.url
+        request.meta['proxy_session'] = session.id
+        return None
+
+    def request_left_downloader(self, request, spider):
+        # Frees the session's slot as soon as the transfer is over
+        self.release(request)
+
+    def release(self, request):
+        entry = self.assigned.get(request)
+        if entry is None or not entry[2]:
+            return
+        entry[2] = False
+        self.pool.release(entry[0])
+        self.wake_waiters()
+
+    def wake_waiters(self):
+        # Wake waiting requests while the pool has room. One that still gets no session (it avoids the free ones)
+        # waits again at the end of the line, each waiter is woken at most once per call.
+        for _ in range(len(self.waiters)):
+            if not self.waiters or not self.pool.can_acquire():
+                return
+            self.waiters.pop(0).callback(None)
+
+    def process_response(self, request, response, spider):
+        if 'cached' in response.flags:
+            return response
+        if response.status in self.block_codes:
+            outcome = BLOCK
+        elif response.status >= 500 or response.status == 407:
+            outcome = ERROR
+        else:
+            outcome = OK
+        self.record(request, outcome, spider, request.meta.get('download_latency'))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.record(request, ERROR, spider)
+
+    def request_blocked(self, request, response, spider, signature):
+        # The response was recorded as a success before BlockDetectionMiddleware looked at its body
+        if response.status in self.block_codes:
+            return
+        session = self.pool.get(request.meta.get('proxy_session'))
+        if session is None or not session.reclassify(BLOCK):
+            return
+        self.stats.inc_value(f"proxy_pool/{OK}_count", -1, spider=spider)
+        self.stats.inc_value(f"proxy_pool/{BLOCK}_count", spider=spider)
+        if self.pool.check(session):
+            self.stats.inc_value('proxy_pool/sessions_retired', spider=spider)
+            # The fresh session that replaced it has room
+            self.wake_waiters()
+        self.update_stats(session, spider)
+
+    def record(self, request, outcome, spider, latency=None):
+        self.release(request)
+        entry = self.assigned.pop(request, None)
+        if entry is None:
+            return
+        session = entry[0]
+        if latency is None and outcome == OK:
+            latency = time.monotonic() - entry[1]
+        self.stats.inc_value(f"proxy_pool/{outcome}_count", spider=spider)
+        if self.pool.record(session, outcome, latency):
+            self.stats.inc_value('proxy_pool/sessions_retired', spider=spider)
+            self.wake_waiters()
+        self.update_stats(session, spider)
+
+    def update_stats(self, session, spider):
+        prefix = f"proxy_pool/session/{session.id}"
+        self.stats.set_value(f"{prefix}/requests", session.requests, spider=spider)
+        self.stats.set_value(f"{prefix}/error_rate", round(session.rate(ERROR), 3), spider=spider)
+        self.stats.set_value(f"{prefix}/block_rate", round(session.rate(BLOCK), 3), spider=spider)
+        if session.latency is not None:
+            self.stats.set_value(f"{prefix}/latency_ms", round(session.latency * 1000), spider=spider)
+
+
+class BlockDetectionMiddleware:
+    # Recognizes Amazon robot-check and captcha pages from byte signatures near the
+    # top of the body, before the spider parses them, and retries the request on a
+    # different proxy session right away. Once BLOCK_RETRY_TIMES retries are spent,
+    # the response is passed on with a 'blocked' flag so callbacks skip extraction.
+    #
+    # Must stay below HttpCompressionMiddleware (590) to see decompressed bodies.
+
+    def __init__(self, crawler, signatures, max_bytes=65536, max_retry_times=3, priority_adjust=0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.signatures = [signature.encode('utf-8') for signature in signatures]
+        self.max_bytes = max_bytes
+        self.max_retry_times = max_retry_times
+        self.priority_adjust = priority_adjust
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('BLOCK_DETECTION_ENABLED'):
+            raise NotConfigured
+        return cls(
+            crawler,
+            settings.getlist('BLOCK_SIGNATURES'),
+            max_bytes=settings.getint('BLOCK_DETECTION_MAX_BYTES', 65536),
+            max_retry_times=settings.getint('BLOCK_RETRY_TIMES', 3),
+            priority_adjust=settings.getint('BLOCK_RETRY_PRIORITY_ADJUST', 0),
+        )
+
+    def match(self, body):
+        for signature in self.signatures:
+            if body.find(signature, 0, self.max_bytes) != -1:
+                return signature
+        return None
+
+    def process_response(self, request, response, spider):
+        if 'cached' in response.flags or request.meta.get('dont_detect_blocks'):
+            return response
+        domain = urlparse_cached(request).hostname
+        self.stats.inc_value(f"block_detection/{domain}/response_count", spider=spider)
+        signature = self.match(response.body)
+        if signature is None:
+            self.update_block_rate(domain, spider)
+            return response
+        self.stats.inc_value('block_detection/blocked', spider=spider)
+        self.stats.inc_value(f"block_detection/{domain}/blocked", spider=spider)
+        self.update_block_rate(domain, spider)
+        self.crawler.signals.send_catch_log(project_signals.request_blocked, request=request, response=response,
+                                            spider=spider, signature=signature)
+        retry_request = get_retry_request(request, spider=spider, reason='blocked',
+                                          max_retry_times=self.max_retry_times,
+                                          priority_adjust=self.priority_adjust,
+                                          stats_base_key='block_detection/retry')
+        if retry_request is None:
+            return response.replace(flags=response.flags + ['blocked'])
+        # Send the retry through a different session than the one that got blocked
+        session = request.meta.get('proxy_session')
+        if session is not None:
+            retry_request.meta['proxy_session_avoid'] = list(request.meta.get('proxy_session_avoid', ())) + [session]
+        return retry_request
+
+    def update_block_rate(self, domain, spider):
+        blocked = self.stats.get_value(f"block_detection/{domain}/blocked", 0, spider=spider)
+        responses = self.stats.get_value(f"block_detection/{domain}/response_count", 0, spider=spider)
+        self.stats.set_value(f"block_detection/{domain}/block_rate", round(blocked / responses, 3), spider=spider)
+
+
+class CachedRobotsTxtMiddleware(RobotsTxtMiddleware):
+    # RobotsTxtMiddleware that keeps the robots.txt files it downloads in a SQLite
+    # database (ROBOTSTXT_CACHE_PATH, relative paths are inside the project's .scrapy
+    # directory) for ROBOTSTXT_CACHE_TTL seconds. Every process using the same file,
+    # e.g. the crawls of a worker or several workers on one host, reuses them instead
+    # of fetching robots.txt through the proxy before its first request.
+    # Server errors and block pages (flagged 'blocked' by BlockDetectionMiddleware,
+    # whatever their status) are not cached, so they are retried by the next crawl.
+    # Of a 4xx, which allows everything, only the status is kept.
+
+    def __init__(self, crawler):
+        super(CachedRobotsTxtMiddleware, self).__init__(crawler)
+        self.ttl = crawler.settings.getint('ROBOTSTXT_CACHE_TTL', 86400)
+        self.db = connect(data_path(crawler.settings.get('ROBOTSTXT_CACHE_PATH', 'robotstxt.db')))
+        self.db.execute('CREATE TABLE IF NOT EXISTS robotstxt ('
+                        ' netloc TEXT PRIMARY KEY, status INTEGER NOT NULL, body BLOB NOT NULL,'
+                        ' fetched_at REAL NOT NULL)')
+
+    def robot_parser(self, request, spider):
+        netloc = urlparse_cached(request).netloc
+        if netloc not in self._parsers:
+            row = self.db.execute('SELECT body FROM robotstxt WHERE netloc = ? AND fetched_at > ?',
+                                  (netloc, time.time() - self.ttl)).fetchone()
+            if row is not None:
+                self.crawler.stats.inc_value('robotstxt/cache_hit')
+                self._parsers[netloc] = self._parserimpl.from_crawler(self.crawler, row['body'])
+            else:
+                self.crawler.stats.inc_value('robotstxt/cache_miss')
+        return super(CachedRobotsTxtMiddleware, self).robot_parser(request, spider)
+
+    def _parse_robots(self, response, netloc, spider):
+        if response.status < 500 and 'blocked' not in response.flags:
+            body = response.body if response.status < 400 else b''
+            self.db.execute('INSERT OR REPLACE INTO robotstxt (netloc, status, body, fetched_at) VALUES (?, ?, ?, ?)',
+                            (netloc, response.status, body, time.time()))
+        return super(CachedRobotsTxtMiddleware, self)._parse_robots(response, netloc, spider)
+
+
+class DeadlineMiddleware:
+    # Keeps downloads within the deadline of their job. A request with
+    # meta['download_deadline'] (a time.monotonic() value) is given what is left
+    # of it as download_timeout, refreshed when it leaves its download slot queue,
+    # and is dropped with IgnoreRequest once the deadline has passed, retries
+    # included, so the spider can post the job without it.
+    #
+    # Must stay above DownloadTimeoutMiddleware (350), whose default timeout it
+    # lowers, and below RetryMiddleware (550), so retries go through it again.
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(crawler.stats)
+        crawler.signals.connect(middleware.request_reached_downloader, signal=signals.request_reached_downloader)
+        return middleware
+
+    @staticmethod
+    def time_left(request):
+        deadline = request.meta.get('download_deadline')
+        return None if deadline is None else deadline - time.monotonic()
+
+    def process_request(self, request, spider):
+        left = self.time_left(request)
+        if left is None:
+            return None
+        if left <= 0:
+            self.stats.inc_value('deadline/dropped', spider=spider)
+            raise IgnoreRequest("The deadline of the job has passed")
+        request.meta['download_timeout'] = min(request.meta.get('download_timeout', left), left)
+        return None
+
+    def request_reached_downloader(self, request, spider):
+        left = self.time_left(request)
+        if left is not None:
+            # Time spent in the slot queue counts, an expired request fails at once and its retry is dropped
+            request.meta['download_timeout'] = min(request.meta.get('download_timeout', left), max(left, 0.001))
+
+
+class HedgingMiddleware:
+    # Cuts the tail latency of slow proxy exits with hedged requests. Once a
+    # request has been downloading for longer than HEDGING_PERCENTILE of the
+    # latencies seen for its page type, a copy is sent through a different proxy
+    # session. Whichever of the two answers first is passed on; the other one is
+    # stopped as soon as it receives data, or dropped before it is sent.
+    #
+    # A failure or a given up block page of one copy only counts when the other
+    # one failed too, so each request still gets a single answer. Hedges are
+    # limited per job (request.meta['product_key'], or the spider's job id) to
+    # HEDGING_BUDGET_MIN plus HEDGING_BUDGET_RATIO of the job's requests, which
+    # bounds the extra proxy traffic.
+    #
+    # Must stay below RetryMiddleware (550) so it only sees final responses and
+    # failures, after the retries.
+
+    def __init__(self, crawler, percentile=95, min_samples=20, min_delay=1.0, budget_min=1, budget_ratio=0.1,
+                 priority_adjust=10):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.budget_min = budget_min
+        self.budget_ratio = budget_ratio
+        self.priority_adjust = priority_adjust
+        # Download latencies of final responses, by page type
+        self.latencies = {}
+        # hedge_key -> state of a request and its hedge
+        self.pairs = {}
+        self.next_key = 0
+        # Requests and hedges sent per job
+        self.requests = {}
+        self.hedges = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('HEDGING_ENABLED'):
+            raise NotConfigured
+        middleware = cls(
+            crawler,
+            percentile=settings.getfloat('HEDGING_PERCENTILE', 95),
+            min_samples=settings.getint('HEDGING_MIN_SAMPLES', 20),
+            min_delay=settings.getfloat('HEDGING_MIN_DELAY', 1.0),
+            budget_min=settings.getint('HEDGING_BUDGET_MIN', 1),
+            budget_ratio=settings.getfloat('HEDGING_BUDGET_RATIO', 0.1),
+            priority_adjust=settings.getint('HEDGING_PRIORITY_ADJUST', 10),
+        )
+        crawler.signals.connect(middleware.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(middleware.data_received, signal=signals.headers_received)
+        crawler.signals.connect(middleware.data_received, signal=signals.bytes_received)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_closed(self, spider):
+        for state in self.pairs.values():
+            self.cancel_timer(state)
+
+    def get_delay(self, request):
+        """Seconds after which a request is hedged, or None while its page type has too few latency samples."""
+        histogram = self.latencies.get(request.meta.get('page_type', 'other'))
+        if histogram is None or histogram.count < self.min_samples:
+            return None
+        return max(histogram.percentile(self.percentile), self.min_delay)
+
+    def get_job(self, request, spider):
+        return request.meta.get('product_key') or getattr(spider, 'job_id', None)
+
+    def request_reached_downloader(self, request, spider):
+        # Retries keep the key of their request and are not hedged again once it was
+        if request.method != 'GET' or request.meta.get('dont_hedge') or request.meta.get('hedge'):
+            return
+        if urlparse_cached(request).scheme not in ('http', 'https'):
+            return
+        key = request.meta.setdefault('hedge_key', self.next_key)
+        if key == self.next_key:
+            self.next_key += 1
+        state = self.pairs.setdefault(key, {'timer': None, 'hedged': False, 'done': False, 'winner': None,
+                                            'pending': 1})
+        if state['hedged']:
+            return
+        job = self.get_job(request, spider)
+        self.requests[job] = self.requests.get(job, 0) + 1
+        delay = self.get_delay(request)
+        if delay is not None:
+            from twisted.internet import reactor
+            self.cancel_timer(state)
+            state['timer'] = reactor.callLater(delay, self.hedge, request, spider)
+
+    def cancel_timer(self, state):
+        if state['timer'] is not None and state['timer'].active():
+            state['timer'].cancel()
+        state['timer'] = None
+
+    def hedge(self, request, spider):
+        state = self.pairs.get(request.meta['hedge_key'])
+        if state is None or state['done'] or state['hedged']:
+            return
+        self.cancel_timer(state)
+        job = self.get_job(request, spider)
+        if self.hedges.get(job, 0) >= self.budget_min + int(self.budget_ratio * self.requests.get(job, 0)):
+            self.stats.inc_value('hedging/over_budget', spider=spider)
+            return
+        self.hedges[job] = self.hedges.get(job, 0) + 1
+        state['hedged'] = True
+        state['pending'] = 2
+        meta = {key: value for key, value in request.meta.items() if key not in ('download_latency', 'download_slot')}
+        meta['hedge'] = True
+        session = request.meta.get('proxy_session')
+        if session is not None:
+            meta['proxy_session_avoid'] = list(request.meta.get('proxy_session_avoid', ())) + [session]
+        self.stats.inc_value('hedging/sent', spider=spider)
+        self.stats.inc_value(f"hedging/{request.meta.get('page_type', 'other')}/sent", spider=spider)
+        self.crawler.engine.crawl(request.replace(meta=meta, dont_filter=True,
+                                                  priority=request.priority + self.priority_adjust))
+
+    def data_received(self, request, spider, **kwargs):
+        state = self.pairs.get(request.meta.get('hedge_key'))
+        if state is not None and state['done'] and state['winner'] is not request:
+            raise StopDownload(fail=True)
+
+    def process_request(self, request, spider):
+        state = self.pairs.get(request.meta.get('hedge_key'))
+        if state is not None and state['done']:
+            # The other copy answered while this one was waiting to be sent
+            self.drop(request, state, spider)
+        return None
+
+    def process_response(self, request, response, spider):
+        key = request.meta.get('hedge_key')
+        state = self.pairs.get(key)
+        if 'cached' not in response.flags and request.meta.get('download_latency') is not None:
+            page_type = request.meta.get('page_type', 'other')
+            self.latencies.setdefault(page_type, Histogram()).observe(request.meta['download_latency'])
+        if state is None:
+            return response
+        if state['done']:
+            self.drop(request, state, spider)
+        if 'blocked' in response.flags and state['pending'] > 1:
+            # The other copy may still get through
+            self.drop(request, state, spider)
+        if state['hedged']:
+            self.stats.inc_value(f"hedging/won_by_{'hedge' if request.meta.get('hedge') else 'request'}",
+                                 spider=spider)
+        self.finish(key, state, request)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        key = request.meta.get('hedge_key')
+        state = self.pairs.get(key)
+        if state is None:
+            return None
+        if state['done'] or state['pending'] > 1:
+            self.drop(request, state, spider)
+        self.finish(key, state, request)
+        return None
+
+    def finish(self, key, state, request):
+        """Record the answer of a request, the other copy is stopped or dropped when it comes back."""
+        state['done'] = True
+        state['winner'] = request
+        state['pending'] -= 1
+        self.cancel_timer(state)
+        if state['pending'] <= 0:
+            del self.pairs[key]
+
+    def drop(self, request, state, spider):
+        """Drop a copy whose answer is not needed, without calling its errback."""
+        state['pending'] -= 1
+        if state['pending'] <= 0:
+            del self.pairs[request.meta['hedge_key']]
+        self.stats.inc_value('hedging/dropped', spider=spider)
+        request.errback = None
+        raise IgnoreRequest("The other copy of a hedged request answered first")
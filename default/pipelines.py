@@ -5,8 +5,17 @@
 import asyncio
 import json
 import logging
+import random
+import time
 from datetime import datetime
 import aiohttp
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.reactor import is_asyncio_reactor_installed
+
+from default.metrics import Histogram, write_stats
+
+logger = logging.getLogger(__name__)
 
 
 def datetime_serializer(obj):
@@ -16,30 +25,163 @@ def datetime_serializer(obj):
     raise TypeError(f"Type {type(obj)} not serializable")
 
 
+class RetryableError(Exception):
+    pass
+
+
 class HttpPipeline(object):
-    def __init__(self, endpoint_uri):
+    """
+    Deliver the scraped jobs to SERVICE_URL/api/v1/scrapy/update.
+
+    Delivery does not go through the downloader: it has its own HTTP session and connection pool, so results are
+    not held up by robots.txt, crawl concurrency slots or the downloader middlewares.
+
+    Items go through a bounded queue: once HTTP_PIPELINE_QUEUE_SIZE items wait for delivery, process_item blocks,
+    which holds back the spider instead of piling up posts. HTTP_PIPELINE_CONCURRENCY senders drain the queue in
+    batches of up to HTTP_PIPELINE_BATCH_SIZE items. Failed posts are retried with jittered exponential backoff,
+    and the queue is drained before the spider closes.
+
+    Once the service has acknowledged an item, the spider's close_job(item) is called. The time from enqueueing to
+    acknowledgement and the time of each POST are reported in the http_pipeline/delivery_latency and
+    http_pipeline/request_latency stats.
+    """
+
+    path = "/api/v1/scrapy/update"
+
+    def __init__(self, endpoint_uri, stats, batch_size=1, queue_size=100, max_retries=3, retry_backoff=0.5,
+                 timeout=30, concurrency=4):
         self.endpoint_uri = endpoint_uri
+        self.stats = stats
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.timeout = timeout
+        self.queue = None
+        self.session = None
+        self.senders = []
+        self.spider = None
+        self.delivery_latency = Histogram()
+        self.request_latency = Histogram()
 
     @classmethod
     def from_crawler(cls, crawler):
-        return cls(endpoint_uri=crawler.settings.get('BASE_URL'))
-
-    async def post_item(self, item):
-        # Asynchronous POST request using aiohttp
-        data = json.dumps(item, default=datetime_serializer)
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.endpoint_uri + "/api/v1/scrapy/update", data=data,
-                                        headers={"Content-Type": "application/json"}) as response:
-                    if response.status != 200:
-                        # You can adjust logging according to your needs
-                        response_text = await response.text()
-                        print(f"Failed to post item to endpoint: {response_text}")
-                        logging.error(f"Failed to post item to endpoint")
-        except Exception as e:
-            logging.error(f"Failed to post item to endpoint: {e}")
-
-    def process_item(self, item, spider):
-        # Convert the item to a dict and schedule the post_item coroutine
-        asyncio.create_task(self.post_item(dict(item)))
-        return {"status": "ok"}
+        settings = crawler.settings
+        endpoint_uri = settings.get('SERVICE_URL')
+        if not endpoint_uri:
+            logger.warning("SERVICE_URL is not set, the scraped jobs will not be delivered")
+            raise NotConfigured("SERVICE_URL is not set")
+        if not is_asyncio_reactor_installed():
+            raise NotConfigured("HttpPipeline requires the asyncio reactor")
+        return cls(
+            endpoint_uri=endpoint_uri.rstrip('/'),
+            stats=crawler.stats,
+            batch_size=settings.getint('HTTP_PIPELINE_BATCH_SIZE', 1),
+            queue_size=settings.getint('HTTP_PIPELINE_QUEUE_SIZE', 100),
+            max_retries=settings.getint('HTTP_PIPELINE_MAX_RETRIES', 3),
+            retry_backoff=settings.getfloat('HTTP_PIPELINE_RETRY_BACKOFF', 0.5),
+            timeout=settings.getfloat('HTTP_PIPELINE_TIMEOUT', 30),
+            concurrency=settings.getint('HTTP_PIPELINE_CONCURRENCY', 4),
+        )
+
+    def open_spider(self, spider):
+        self.spider = spider
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.senders = [asyncio.ensure_future(self.send_batches()) for _ in range(self.concurrency)]
+
+    def close_spider(self, spider):
+        return deferred_from_coro(self.drain())
+
+    async def process_item(self, item, spider):
+        # Waits while the queue is full
+        await self.queue.put((dict(item), time.perf_counter()))
+        return item
+
+    async def drain(self):
+        await self.queue.join()
+        for sender in self.senders:
+            sender.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        write_stats(self.stats, 'http_pipeline/delivery_latency', self.delivery_latency, self.spider)
+        write_stats(self.stats, 'http_pipeline/request_latency', self.request_latency, self.spider)
+
+    def get_session(self):
+        # Created lazily so that it binds to the running event loop
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"Content-Type": "application/json"},
+            )
+        return self.session
+
+    async def send_batches(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                items = [item for item, _ in batch]
+                delivered = await self.post_batch(items)
+            except Exception:
+                # e.g. an item that is not JSON serializable. The sender goes on with the next batch, so the queue
+                # still drains.
+                logger.exception(f"Failed to post {len(batch)} items to endpoint")
+                self.stats.inc_value('http_pipeline/items_failed', len(batch))
+            else:
+                if delivered:
+                    self.acknowledge(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def acknowledge(self, batch):
+        for item, enqueued_at in batch:
+            self.delivery_latency.observe(time.perf_counter() - enqueued_at)
+            close_job = getattr(self.spider, 'close_job', None)
+            if close_job is None:
+                continue
+            try:
+                close_job(item)
+            except Exception:
+                logger.exception(f"close_job failed for job {item.get('job_id')}")
+
+    async def post_batch(self, batch):
+        # A batch of one is posted as the job itself, larger batches as a JSON array of jobs
+        data = json.dumps(batch[0] if len(batch) == 1 else batch, default=datetime_serializer)
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                await self.post(data)
+            except RetryableError as e:
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            except Exception as e:
+                logger.error(f"Failed to post {len(batch)} items to endpoint: {e}")
+                self.stats.inc_value('http_pipeline/items_failed', len(batch))
+                return False
+            else:
+                self.request_latency.observe(time.perf_counter() - start)
+                self.stats.inc_value('http_pipeline/items_posted', len(batch))
+                self.stats.inc_value('http_pipeline/batches_posted')
+                return True
+            if attempt < self.max_retries:
+                self.stats.inc_value('http_pipeline/retries')
+                # Full jitter keeps workers that failed together from retrying together
+                await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+        logger.error(f"Failed to post {len(batch)} items to endpoint after {self.max_retries} retries: {error}")
+        self.stats.inc_value('http_pipeline/items_failed', len(batch))
+        return False
+
+    async def post(self, data):
+        async with self.get_session().post(self.endpoint_uri + self.path, data=data) as response:
+            if 200 <= response.status < 300:
+                return
+            response_text = await response.text()
+            if response.status >= 500 or response.status == 429:
+                raise RetryableError(f"{response.status} {response_text[:200]}")
+            raise ValueError(f"{response.status} {response_text[:200]}")
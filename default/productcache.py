@@ -0,0 +1,73 @@
+# Cache of parsed products, keyed by (domain, ASIN).
+#
+# Popular products are asked for many times an hour. Instead of downloading
+# and parsing their four pages again, the amazon spider keeps what it parsed
+# for each product in a SQLite database, split in field groups that go stale at
+# different rates: the offer (price, stock) within minutes, the listing (title,
+# specs, features) within a day, Q&A within a week. A job is served entirely
+# from the cache when every group is fresh, otherwise only the pages of the
+# stale groups are fetched again.
+import json
+import time
+
+from scrapy.utils.project import data_path
+
+from default.storage import connect, transaction
+
+
+class ProductCache(object):
+    """
+    Read-through cache of product field groups.
+    :param path: Path of the SQLite database.
+    :param ttls: Seconds each field group stays fresh, e.g. {'offer': 900, 'qa': 604800}.
+                 Groups without a TTL are never cached.
+    """
+
+    def __init__(self, path, ttls):
+        self.ttls = ttls
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS products ('
+                        ' domain TEXT NOT NULL, asin TEXT NOT NULL, field_group TEXT NOT NULL, data TEXT NOT NULL,'
+                        ' stored_at REAL NOT NULL, PRIMARY KEY (domain, asin, field_group))')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Return a cache when PRODUCT_CACHE_ENABLED is set, None otherwise."""
+        settings = crawler.settings
+        if not settings.getbool('PRODUCT_CACHE_ENABLED'):
+            return None
+        return cls(data_path(settings.get('PRODUCT_CACHE_PATH', 'products.db')), settings.getdict('PRODUCT_CACHE_TTL'))
+
+    def load(self, key):
+        """
+        Read the fresh field groups of a product.
+        :param key: (domain, ASIN) of the product.
+        :return: Dict of the field groups still within their TTL, by name.
+        """
+        domain, asin = key
+        now = time.time()
+        groups = {}
+        for row in self.db.execute('SELECT field_group, data, stored_at FROM products WHERE domain = ? AND asin = ?',
+                                   (domain, asin)):
+            ttl = self.ttls.get(row['field_group'])
+            if ttl and now - row['stored_at'] <= ttl:
+                groups[row['field_group']] = json.loads(row['data'])
+        return groups
+
+    def store(self, key, groups):
+        """
+        Store field groups of a product, replacing the previous ones.
+        :param key: (domain, ASIN) of the product.
+        :param groups: Dict of JSON serializable field groups, by name.
+        """
+        domain, asin = key
+        now = time.time()
+        with transaction(self.db):
+            for group, data in groups.items():
+                if not self.ttls.get(group):
+                    continue
+                self.db.execute('INSERT OR REPLACE INTO products (domain, asin, field_group, data, stored_at)'
+                                ' VALUES (?, ?, ?, ?, ?)', (domain, asin, group, json.dumps(data), now))
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,172 @@
+# Pool of sticky Bright Data proxy sessions.
+#
+# Bright Data keeps the same exit IP for every request sent with the same
+# `-session-<id>` suffix in the username. Instead of one session per crawl, the
+# pool keeps several of them, tracks how each one is doing over its recent
+# requests and replaces the ones that degrade, so a blocked exit IP only costs
+# the requests that were sent through it.
+from collections import deque
+from random import randint
+
+OK = 'ok'
+ERROR = 'error'
+BLOCK = 'block'
+
+
+class ProxySession(object):
+    """A proxy session and the outcome of its recent requests."""
+
+    def __init__(self, session_id, url, window=20, latency_alpha=0.3):
+        self.id = session_id
+        self.url = url
+        self.in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.blocks = 0
+        self.latency = None
+        self.latency_alpha = latency_alpha
+        self.outcomes = deque(maxlen=window)
+        self.retired = False
+
+    def record(self, outcome, latency=None):
+        self.requests += 1
+        if outcome == ERROR:
+            self.errors += 1
+        elif outcome == BLOCK:
+            self.blocks += 1
+        self.outcomes.append(outcome)
+        if latency is not None:
+            # Exponentially weighted, so the latency follows the current state of the exit IP
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += self.latency_alpha * (latency - self.latency)
+
+    def reclassify(self, outcome):
+        """Change the outcome of the latest successful request, e.g. when its response turns out to be a block page."""
+        for index in range(len(self.outcomes) - 1, -1, -1):
+            if self.outcomes[index] == OK:
+                self.outcomes[index] = outcome
+                if outcome == ERROR:
+                    self.errors += 1
+                elif outcome == BLOCK:
+                    self.blocks += 1
+                return True
+        return False
+
+    def rate(self, outcome):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(outcome) / len(self.outcomes)
+
+
+class ProxySessionPool(object):
+    """
+    Hands out proxy sessions for requests.
+    :param username: Bright Data zone username.
+    :param password: Bright Data zone password.
+    :param host: Bright Data super proxy host.
+    :param port: Bright Data super proxy port.
+    :param size: Number of sessions kept in the pool.
+    :param max_size: Sessions the pool grows to for requests that avoid every session (default: twice size).
+    :param max_in_flight: Maximum concurrent requests per session.
+    :param window: Number of recent requests the error and block rates are computed on.
+    :param max_error_rate: Error rate above which a session is replaced, once it has `min_samples` requests.
+    :param max_block_rate: Block rate above which a session is replaced. Blocks do not wait for `min_samples`:
+                           an exit IP that got a captcha keeps getting them.
+    :param min_samples: Requests needed before the error rate is trusted.
+    """
+
+    def __init__(self, username, password, host, port=22225, size=8, max_in_flight=4, window=20,
+                 max_error_rate=0.5, max_block_rate=0.2, min_samples=5, max_size=None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.max_size = max_size or 2 * size
+        self.max_in_flight = max_in_flight
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.max_block_rate = max_block_rate
+        self.min_samples = min_samples
+        self.sessions = {}
+        self.sticky = {}
+        self.retired = 0
+        for _ in range(size):
+            self.add_session()
+
+    def add_session(self):
+        session_id = randint(0, 1000000)
+        while session_id in self.sessions:
+            session_id = randint(0, 1000000)
+        url = f"http://{self.username}-session-{session_id}:{self.password}@{self.host}:{self.port}"
+        session = ProxySession(session_id, url, window=self.window)
+        self.sessions[session_id] = session
+        return session
+
+    def get(self, session_id):
+        return self.sessions.get(session_id)
+
+    def acquire(self, key=None, avoid=()):
+        """
+        Pick a session for a request and count it as in flight.
+        :param key: Sticky key: requests with the same key keep the same session while it is healthy and has room.
+        :param avoid: Ids of sessions not to use, e.g. the one a retried request was blocked on.
+        :return: The session, or None when every usable session is at max_in_flight.
+        """
+        session = self.sticky.get(key) if key is not None else None
+        if session is None or session.retired or session.id in avoid or session.in_flight >= self.max_in_flight:
+            usable = [candidate for candidate in self.sessions.values() if candidate.id not in avoid]
+            if not usable and len(self.sessions) < self.max_size:
+                # Every session is avoided, bring in a fresh one rather than waiting forever
+                usable = [self.add_session()]
+            elif not usable:
+                # The pool is full, go back to the session avoided longest ago
+                order = {session_id: index for index, session_id in enumerate(avoid)}
+                usable = [min(self.sessions.values(), key=lambda candidate: order[candidate.id])]
+            candidates = [candidate for candidate in usable if candidate.in_flight < self.max_in_flight]
+            if not candidates:
+                return None
+            # Least loaded first, then fastest. Sessions without latency yet are tried first.
+            session = min(candidates, key=lambda candidate: (candidate.in_flight, candidate.latency or 0.0))
+            if key is not None and (key not in self.sticky or self.sticky[key].retired or
+                                    self.sticky[key].id in avoid):
+                self.sticky[key] = session
+        session.in_flight += 1
+        return session
+
+    def can_acquire(self, avoid=()):
+        """Return whether acquire would hand out a session right away for a request avoiding `avoid`."""
+        usable = [candidate for candidate in self.sessions.values() if candidate.id not in avoid]
+        if not usable:
+            if len(self.sessions) < self.max_size:
+                return True
+            order = {session_id: index for index, session_id in enumerate(avoid)}
+            usable = [min(self.sessions.values(), key=lambda candidate: order[candidate.id])]
+        return any(candidate.in_flight < self.max_in_flight for candidate in usable)
+
+    def release(self, session):
+        session.in_flight = max(session.in_flight - 1, 0)
+
+    def record(self, session, outcome, latency=None):
+        """Record the outcome of a request. Returns True when the session was replaced because it degraded."""
+        session.record(outcome, latency)
+        return self.check(session)
+
+    def check(self, session):
+        if session.retired or not self.degraded(session):
+            return False
+        self.retire(session)
+        return True
+
+    def degraded(self, session):
+        if session.rate(BLOCK) > self.max_block_rate:
+            return True
+        return len(session.outcomes) >= self.min_samples and session.rate(ERROR) > self.max_error_rate
+
+    def retire(self, session):
+        """Replace a session with a fresh one. Requests in flight on it finish normally."""
+        session.retired = True
+        self.retired += 1
+        self.sessions.pop(session.id, None)
+        return self.add_session()
@@ -0,0 +1,102 @@
+# Byte-level HTML pruning applied before a response is parsed.
+#
+# Amazon pages carry megabytes of inline scripts, styles and SVG that no extractor
+# reads. Emptying those regions before lxml sees the body means a smaller DOM is
+# built and held in memory. Only the contents are dropped: every pruned element is
+# kept as an empty element with its original attributes (and comments as empty
+# comments) so the surrounding tree, sibling positions and text node boundaries
+# stay exactly the same.
+import re
+
+# Regions that can be pruned, mapped to the marker closing them
+PRUNABLE_REGIONS = {
+    'script': b'</script',
+    'style': b'</style',
+    'svg': b'</svg',
+    'iframe': b'</iframe',
+    'comment': b'-->',
+}
+
+_META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?([a-zA-Z0-9_-]+)', re.I)
+_openers = {}
+
+
+def _get_opener(regions):
+    key = tuple(sorted(regions))
+    opener = _openers.get(key)
+    if opener is None:
+        unknown = set(key) - set(PRUNABLE_REGIONS)
+        if unknown:
+            raise ValueError(f"Unknown prunable regions: {', '.join(sorted(unknown))}")
+        # A single alternation finds whichever region opens first, like the HTML tokenizer does
+        # (e.g. a <script> tag inside a comment stays part of the comment).
+        tags = [name.encode() for name in key if name != 'comment']
+        alternatives = [rb'<(?P<tag>' + b'|'.join(tags) + rb')[\s/>]'] if tags else []
+        if 'comment' in key:
+            alternatives.append(rb'<!--')
+        opener = re.compile(b'|'.join(alternatives))
+        _openers[key] = opener
+    return opener
+
+
+def prune_html(body, regions):
+    """
+    Empty the given regions of an HTML body.
+    :param body: Raw response body (bytes).
+    :param regions: Iterable of region names from PRUNABLE_REGIONS, e.g. ['script', 'style'].
+    :return: The pruned body.
+    """
+    if not regions:
+        return body
+    opener = _get_opener(regions)
+    # Tags are matched case-insensitively by scanning a lowercased copy; offsets are the same in both.
+    lowered = body.lower()
+    pieces = []
+    position = 0
+    match = opener.search(lowered)
+    while match is not None:
+        if match.lastgroup == 'tag':
+            name = match.group('tag')
+            content_start = lowered.find(b'>', match.end() - 1)
+            if content_start == -1:
+                break
+            content_start += 1
+            if lowered[content_start - 2:content_start] == b'/>':
+                # Self-closing tag, nothing to empty
+                match = opener.search(lowered, content_start)
+                continue
+            close = lowered.find(PRUNABLE_REGIONS[name.decode()], content_start)
+            region_end = lowered.find(b'>', close) + 1 if close != -1 else 0
+            # Keep the opening tag and its attributes, drop the contents
+            replacement = body[match.start():content_start] + b'</' + name + b'>'
+        else:
+            close = lowered.find(PRUNABLE_REGIONS['comment'], match.end())
+            region_end = close + 3
+            replacement = b'<!---->'
+        if close == -1 or region_end == 0:
+            # Unterminated region: leave the rest of the body alone
+            break
+        pieces.append(body[position:match.start()])
+        pieces.append(replacement)
+        position = region_end
+        match = opener.search(lowered, position)
+    if not pieces:
+        return body
+    pieces.append(body[position:])
+    return b''.join(pieces)
+
+
+def declared_encoding(body, content_type=None):
+    """
+    Return the charset declared in the Content-Type header or in a <meta> tag near the top of the body.
+    Returns None when nothing is declared, in which case the encoding still has to be sniffed.
+    """
+    if content_type:
+        for param in content_type.split(';')[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.lower() == 'charset' and value:
+                return value.strip('"\'')
+    match = _META_CHARSET_RE.search(body, 0, 4096)
+    if match:
+        return match.group(1).decode('ascii')
+    return None
@@ -0,0 +1,155 @@
+# Review aggregation shared by the product spiders.
+#
+# Reviews for a product arrive in several streams (critical, positive and the
+# reviews shown on the product page) that overlap. ReviewAggregator merges them
+# in one linear pass using a hash index instead of rescanning the merged list
+# for every review.
+#
+# ReviewStore remembers the reviews already seen for each product, so review
+# pages sorted by most recent only need to be paged through until a known
+# review shows up.
+import hashlib
+import json
+import re
+import time
+
+from scrapy.utils.project import data_path
+
+from default.storage import connect, transaction
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def review_fingerprint(review):
+    """
+    Return a fingerprint of a review's content (rating and text), independent of its author.
+    Text is compared case- and whitespace-insensitively.
+    """
+    text = review.get('text')
+    if isinstance(text, (list, tuple)):
+        text = ' '.join(str(part) for part in text)
+    text = _WHITESPACE_RE.sub(' ', str(text)).strip().lower()
+    content = f"{review.get('rating')}\x1f{text}"
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ReviewAggregator(object):
+    """
+    Merge review streams without duplicates.
+    Two reviews are the same review when both their author and content fingerprint match.
+    """
+
+    def __init__(self, reviews=None):
+        # The list is extended in place so callers can keep passing their own list around
+        self.reviews = reviews if reviews is not None else []
+        self._index = {self.key(review) for review in self.reviews}
+
+    @staticmethod
+    def key(review):
+        return review.get('author'), review_fingerprint(review)
+
+    def add(self, review):
+        """Add a review unless it was already seen. Returns True when it was added."""
+        key = self.key(review)
+        if key in self._index:
+            return False
+        self._index.add(key)
+        self.reviews.append(review)
+        return True
+
+    def merge(self, *streams):
+        """Add every review of every stream, in order, and return the merged list."""
+        for stream in streams:
+            for review in stream:
+                self.add(review)
+        return self.reviews
+
+    def strip_authors(self):
+        """Remove the author of every merged review in place, to keep reviewers anonymous."""
+        for review in self.reviews:
+            review.pop('author', None)
+        return self.reviews
+
+
+class ReviewStore(object):
+    """
+    Reviews already seen for each product and review stream, kept in a SQLite database so a crawl only has to
+    page through recent reviews until it reaches one it knows.
+    :param path: Path of the SQLite database.
+    :param max_reviews: Number of most recent reviews kept per product and stream.
+    """
+
+    def __init__(self, path, max_reviews=200):
+        self.max_reviews = max_reviews
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS reviews ('
+                        ' domain TEXT NOT NULL, asin TEXT NOT NULL, stream TEXT NOT NULL, fingerprint TEXT NOT NULL,'
+                        ' position INTEGER NOT NULL, data TEXT NOT NULL, seen_at REAL NOT NULL,'
+                        ' PRIMARY KEY (domain, asin, stream, fingerprint))')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """Return a store when REVIEW_STORE_ENABLED is set, None otherwise."""
+        settings = crawler.settings
+        if not settings.getbool('REVIEW_STORE_ENABLED'):
+            return None
+        return cls(data_path(settings.get('REVIEW_STORE_PATH', 'reviews.db')),
+                   settings.getint('REVIEW_STORE_MAX_REVIEWS', 200))
+
+    @staticmethod
+    def fingerprint(review):
+        """Fingerprint of a review's author and content, the same identity ReviewAggregator uses."""
+        author, content = ReviewAggregator.key(review)
+        return hashlib.blake2b(f"{author}\x1f{content}".encode('utf-8'), digest_size=16).hexdigest()
+
+    def count(self, key, stream):
+        domain, asin = key
+        return self.db.execute('SELECT COUNT(*) FROM reviews WHERE domain = ? AND asin = ? AND stream = ?',
+                               (domain, asin, stream)).fetchone()[0]
+
+    def split(self, key, stream, reviews):
+        """
+        Split a page of reviews, newest first, at the first review already in the store.
+        :param key: (domain, ASIN) of the product.
+        :param stream: Review stream, e.g. 'critical_reviews'.
+        :return: Tuple of the reviews before the first known one, and whether a known review was reached.
+        """
+        domain, asin = key
+        for index, review in enumerate(reviews):
+            known = self.db.execute('SELECT 1 FROM reviews WHERE domain = ? AND asin = ? AND stream = ?'
+                                    ' AND fingerprint = ?', (domain, asin, stream, self.fingerprint(review))).fetchone()
+            if known is not None:
+                return reviews[:index], True
+        return reviews, False
+
+    def add(self, key, stream, reviews):
+        """
+        Store new reviews, newest first, ahead of the stored ones, and drop the oldest past max_reviews.
+        :param key: (domain, ASIN) of the product.
+        :param stream: Review stream, e.g. 'critical_reviews'.
+        :param reviews: Reviews newer than every stored review, newest first.
+        """
+        domain, asin = key
+        top = self.db.execute('SELECT COALESCE(MAX(position), 0) FROM reviews WHERE domain = ? AND asin = ?'
+                              ' AND stream = ?', (domain, asin, stream)).fetchone()[0]
+        now = time.time()
+        with transaction(self.db):
+            for index, review in enumerate(reviews):
+                self.db.execute('INSERT OR IGNORE INTO reviews (domain, asin, stream, fingerprint, position, data,'
+                                ' seen_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                (domain, asin, stream, self.fingerprint(review), top + len(reviews) - index,
+                                 json.dumps(review), now))
+            self.db.execute('DELETE FROM reviews WHERE domain = ? AND asin = ? AND stream = ? AND position <= ('
+                            ' SELECT position FROM reviews WHERE domain = ? AND asin = ? AND stream = ?'
+                            ' ORDER BY position DESC LIMIT 1 OFFSET ?)',
+                            (domain, asin, stream, domain, asin, stream, self.max_reviews))
+
+    def load(self, key, stream):
+        """Return the stored reviews of a product and stream, newest first."""
+        domain, asin = key
+        rows = self.db.execute('SELECT data FROM reviews WHERE domain = ? AND asin = ? AND stream = ?'
+                               ' ORDER BY position DESC', (domain, asin, stream))
+        return [json.loads(row['data']) for row in rows]
+
+    def close(self):
+        self.db.close()
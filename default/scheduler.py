@@ -0,0 +1,91 @@
+# Scheduler that keeps request priorities meaningful when the crawl is saturated.
+#
+# The engine hands requests to the downloader as long as fewer than
+# CONCURRENT_REQUESTS are active, and the downloader queues them per download
+# slot, first in first out. With a single Amazon domain most of the active
+# requests wait in that queue, where their priority no longer counts: a product
+# page scheduled just after another job's review pages waits for all of them.
+# This scheduler only hands over a request when its slot has room for it, so
+# the waiting happens in the priority queues instead. Requests whose slot is
+# full are set aside per slot, still by priority, and those of the other slots
+# go on: a saturated host does not hold back the rest of the crawl.
+#
+# Downloader middlewares with a can_send(request) method hold requests back the
+# same way while it returns False, e.g. ProxySessionPoolMiddleware while every
+# proxy session is busy, so those requests do not take up the downloader's
+# CONCURRENT_REQUESTS waiting inside it.
+import heapq
+from itertools import count
+
+from scrapy.core.scheduler import Scheduler
+from scrapy.utils.httpobj import urlparse_cached
+
+
+class SlotAwareScheduler(Scheduler):
+    """
+    Settings:
+    SCHEDULER_SLOT_BACKLOG: Requests the downloader may queue per download slot, as a multiple of the slot's
+                            concurrency, so that a freed connection never waits for the engine.
+    """
+
+    def __init__(self, *args, backlog=1.0, **kwargs):
+        super(SlotAwareScheduler, self).__init__(*args, **kwargs)
+        self.backlog = backlog
+        # Requests set aside while their slot is full, by slot: heaps of (-priority, order, request)
+        self.held = {}
+        self.held_order = count()
+        # can_send methods of the downloader middlewares, read when the spider opens
+        self.gates = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super(SlotAwareScheduler, cls).from_crawler(crawler)
+        scheduler.backlog = crawler.settings.getfloat('SCHEDULER_SLOT_BACKLOG', 1.0)
+        return scheduler
+
+    def open(self, spider):
+        engine = self.crawler.engine if self.crawler is not None else None
+        manager = getattr(getattr(engine, 'downloader', None), 'middleware', None)
+        self.gates = [middleware.can_send for middleware in getattr(manager, 'middlewares', ())
+                      if hasattr(middleware, 'can_send')]
+        return super(SlotAwareScheduler, self).open(spider)
+
+    def __len__(self):
+        return super(SlotAwareScheduler, self).__len__() + sum(len(held) for held in self.held.values())
+
+    def next_request(self):
+        # Requests only go to the disk queues with a JOBDIR, those are handed over as they come
+        while self.mqs and self.held_back(self.mqs.peek()):
+            request = self.mqs.pop()
+            heapq.heappush(self.held.setdefault(self.slot_key(request), []),
+                           (-request.priority, next(self.held_order), request))
+            self.stats.inc_value('scheduler/held_back', spider=self.spider)
+        key = self.next_held_slot()
+        head = self.mqs.peek() if self.mqs else None
+        # Set aside before the head of the queue, held requests go first within a priority
+        if key is None or (head is not None and head.priority > -self.held[key][0][0]):
+            return super(SlotAwareScheduler, self).next_request()
+        request = heapq.heappop(self.held[key])[2]
+        if not self.held[key]:
+            del self.held[key]
+        self.stats.inc_value('scheduler/dequeued/memory', spider=self.spider)
+        self.stats.inc_value('scheduler/dequeued', spider=self.spider)
+        return request
+
+    def next_held_slot(self):
+        """Return the slot whose first held request comes first among the slots with room again, or None."""
+        ready = [(held[0][:2], key) for key, held in self.held.items() if not self.held_back(held[0][2])]
+        return min(ready)[1] if ready else None
+
+    def held_back(self, request):
+        return self.slot_is_full(request) or not all(gate(request) for gate in self.gates)
+
+    def slot_key(self, request):
+        return request.meta.get('download_slot') or urlparse_cached(request).hostname or ''
+
+    def slot_is_full(self, request):
+        engine = self.crawler.engine if self.crawler is not None else None
+        if request is None or engine is None:
+            return False
+        slot = engine.downloader.slots.get(self.slot_key(request))
+        return slot is not None and len(slot.queue) >= slot.concurrency * self.backlog
@@ -0,0 +1,91 @@
+# Process-wide registry of precompiled selectors.
+#
+# The extractors in default.spiders pass plain CSS/XPath strings around. Handing
+# those strings to parsel means every call translates the CSS and builds a new
+# Selector/SelectorList for every match. The helpers below translate and compile
+# each query exactly once per process into an lxml XPath object and evaluate it
+# directly against the lxml tree, returning raw lxml results.
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+
+_EXSLT_NAMESPACES = {
+    're': 'http://exslt.org/regular-expressions',
+    'set': 'http://exslt.org/sets',
+}
+
+_translator = HTMLTranslator()
+_registry = {}
+
+
+def compile_query(query, query_type='css'):
+    """
+    Return the compiled lxml XPath object for a CSS or XPath query.
+    Queries are translated and compiled on first use and cached for the lifetime of the process.
+    :param query: CSS or XPath query string.
+    :param query_type: 'css' for CSS queries, 'xpath' for XPath queries.
+    :return: lxml.etree.XPath object.
+    """
+    key = (query_type, query)
+    compiled = _registry.get(key)
+    if compiled is None:
+        if query_type == 'css':
+            xpath = _translator.css_to_xpath(query)
+        elif query_type == 'xpath':
+            xpath = query
+        else:
+            raise ValueError("Invalid query_type. Use 'css' or 'xpath'.")
+        namespaces = {prefix: uri for prefix, uri in _EXSLT_NAMESPACES.items() if f"{prefix}:" in xpath}
+        compiled = etree.XPath(xpath, namespaces=namespaces or None, smart_strings=False)
+        _registry[key] = compiled
+    return compiled
+
+
+def get_roots(response_or_selector):
+    """
+    Return the lxml nodes behind a Scrapy Response, parsel Selector/SelectorList,
+    lxml element or list of lxml elements.
+    """
+    if isinstance(response_or_selector, etree._Element):
+        return [response_or_selector]
+    if hasattr(response_or_selector, 'selector'):
+        # Scrapy Response
+        return [response_or_selector.selector.root]
+    if hasattr(response_or_selector, 'root'):
+        # parsel Selector
+        return [response_or_selector.root]
+    roots = []
+    for node in response_or_selector:
+        roots.extend(get_roots(node))
+    return roots
+
+
+def evaluate(response_or_selector, query, query_type='css'):
+    """
+    Evaluate a query against a response, selector or lxml node and return the flattened raw lxml results.
+    Elements are returned as lxml elements, text and attribute matches as plain strings.
+    """
+    compiled = compile_query(query, query_type)
+    results = []
+    for root in get_roots(response_or_selector):
+        if not isinstance(root, etree._Element):
+            # Text results of a previous query cannot be queried any further
+            continue
+        result = compiled(root)
+        if isinstance(result, list):
+            results.extend(result)
+        else:
+            results.append(result)
+    return results
+
+
+def node_to_text(node):
+    """Serialize a raw lxml result the same way parsel's Selector.get() does."""
+    if isinstance(node, str):
+        return node
+    if isinstance(node, etree._Element):
+        return etree.tostring(node, method='html', encoding='unicode', with_tail=False)
+    if node is True:
+        return '1'
+    if node is False:
+        return '0'
+    return str(node)
@@ -15,18 +15,44 @@ BOT_NAME = "scrapy"
 SPIDER_MODULES = ["default.spiders"]
 NEWSPIDER_MODULE = "spiders"
 SERVICE_URL = os.getenv("SERVICE_URL")
-# ITEM_PIPELINES = {
-#     'scraper.pipelines.HttpPipeline': 300,
-# }
+# Jobs yielded by the spiders are posted to SERVICE_URL by HttpPipeline
+ITEM_PIPELINES = {
+    'default.pipelines.HttpPipeline': 300,
+}
+# Concurrent result POSTs, independent of the crawl's CONCURRENT_REQUESTS
+HTTP_PIPELINE_CONCURRENCY = 4
+# Items posted per request; batches larger than 1 are posted as a JSON array of jobs
+HTTP_PIPELINE_BATCH_SIZE = 1
+# Items waiting for delivery before process_item blocks
+HTTP_PIPELINE_QUEUE_SIZE = 100
+HTTP_PIPELINE_MAX_RETRIES = 3
+# Base of the jittered exponential backoff between retries, in seconds
+HTTP_PIPELINE_RETRY_BACKOFF = 0.5
+HTTP_PIPELINE_TIMEOUT = 30
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
 # USER_AGENT = "projectname (+http://www.yourdomain.com)"
 
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
+# robots.txt files are cached in this SQLite database (inside .scrapy/) for ROBOTSTXT_CACHE_TTL seconds
+ROBOTSTXT_CACHE_PATH = "robotstxt.db"
+ROBOTSTXT_CACHE_TTL = 86400
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-# CONCURRENT_REQUESTS = 32
+# Per-domain concurrency is sized by AdaptiveConcurrency below, this is only the overall cap
+CONCURRENT_REQUESTS = 64
+
+# Requests wait in the scheduler's priority queues rather than in the downloader's per-slot queues, which are first
+# in first out (see default/scheduler.py). Within a priority, requests go in the order they were scheduled, so jobs
+# are served oldest first.
+SCHEDULER = "default.scheduler.SlotAwareScheduler"
+SCHEDULER_MEMORY_QUEUE = "scrapy.squeues.FifoMemoryQueue"
+SCHEDULER_SLOT_BACKLOG = 1.0
+# Priority of the requests of jobs already in flight (later review pages, retries, posting at the deadline), so
+# they finish before new jobs start
+IN_FLIGHT_PRIORITY = 10
+RETRY_PRIORITY_ADJUST = 10
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -48,6 +74,70 @@ ROBOTSTXT_OBEY = True
 #    "Accept-Language": "en",
 # }
 
+# Keep parsed products in this SQLite database (inside .scrapy/), see default/productcache.py
+PRODUCT_CACHE_ENABLED = True
+PRODUCT_CACHE_PATH = "products.db"
+# Seconds each field group of a cached product stays fresh. Jobs whose groups are all fresh are served
+# without any request, otherwise only the pages of the stale groups are fetched.
+PRODUCT_CACHE_TTL = {
+    "offer": 900,
+    "listing": 86400,
+    "reviews": 21600,
+    "qa": 604800,
+}
+
+# amazon_get_details posts its products in chunks of this many products and/or about this many bytes of JSON
+# as they are parsed, then a completion marker (spider arguments chunk_size and chunk_bytes). 0 and 0 post every
+# product in a single job once the last URL is done.
+DETAILS_CHUNK_SIZE = 0
+DETAILS_CHUNK_BYTES = 0
+# Requests amazon_get_details keeps in flight (spider argument read_ahead). URLs given in a file or a queue are only
+# read this far ahead of the crawl, so a run of any size starts at once in constant memory.
+DETAILS_READ_AHEAD = 128
+# Seconds a URL claimed from a urls_queue waits to be acknowledged as scraped. URLs claimed by a crawl that died are
+# handed out again once it runs out, 0 never hands them out again.
+DETAILS_QUEUE_LEASE = 3600
+
+# Pages of critical and positive reviews read per product (spider argument max_review_pages). Once page 1
+# is full (REVIEW_PAGE_SIZE reviews), the others are fetched concurrently.
+REVIEW_MAX_PAGES = 1
+REVIEW_PAGE_SIZE = 10
+
+# Seconds from the first request of a product to its job being posted (amazon spider argument deadline). Pages
+# still missing by then are given up on and the job is posted with a "partial" status. 0 waits for every page.
+JOB_DEADLINE = 120
+# Post the core product as soon as its page is parsed, then its reviews and Q&A as "patch" updates, in in_progress
+# jobs numbered by "sequence". Off by default, the service has to understand patches.
+PARTIAL_RESULTS_ENABLED = False
+
+# Distinct products returned by a search (spider argument max_results), read from at most SEARCH_MAX_PAGES
+# results pages fetched concurrently
+SEARCH_MAX_RESULTS = 15
+SEARCH_MAX_PAGES = 20
+
+# Remember the reviews already seen for each product in this SQLite database (inside .scrapy/), so review
+# pages sorted by most recent are only read until a known review, see default/reviews.py. Off by default: the
+# reviews of a job then include the stored ones, up to REVIEW_STORE_MAX_REVIEWS, and their authors are kept on disk.
+REVIEW_STORE_ENABLED = False
+REVIEW_STORE_PATH = "reviews.db"
+# Most recent review pages read per product and stream when looking for a known review
+REVIEW_STORE_MAX_PAGES = 5
+# Most recent reviews kept, and returned, per product and stream
+REVIEW_STORE_MAX_REVIEWS = 200
+
+# Parse product pages in a pool of worker processes instead of on the reactor thread
+# PARSE_EXECUTOR_ENABLED = True
+# Number of worker processes (default: number of CPUs)
+# PARSE_EXECUTOR_WORKERS = 4
+
+# Long-lived worker (python -m default.worker) replacing one scrapyd process per job
+WORKER_DB_PATH = os.getenv("WORKER_DB_PATH", "jobs.db")
+WORKER_CONCURRENT_JOBS = int(os.getenv("WORKER_CONCURRENT_JOBS", "4"))
+# Seconds between checks for jobs enqueued directly in the database
+WORKER_POLL_INTERVAL = 1.0
+WORKER_PORT = int(os.getenv("PORT", "6800"))
+WORKER_BIND_ADDRESS = "0.0.0.0"
+
 # Enable or disable spider middlewares
 # See https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 # SPIDER_MIDDLEWARES = {
@@ -56,15 +146,97 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
-# DOWNLOADER_MIDDLEWARES = {
-#    "projectname.middlewares.ProjectnameDownloaderMiddleware": 543,
-# }
+DOWNLOADER_MIDDLEWARES = {
+    # Replaced by a subclass that caches robots.txt on disk across crawls
+    "scrapy.downloadermiddlewares.robotstxt.RobotsTxtMiddleware": None,
+    "default.middlewares.CachedRobotsTxtMiddleware": 100,
+    # Must stay between DownloadTimeoutMiddleware (350) and RetryMiddleware (550)
+    "default.middlewares.DeadlineMiddleware": 530,
+    # Must stay below RetryMiddleware (550) so it only sees final responses and failures
+    "default.middlewares.HedgingMiddleware": 540,
+    # Moved below HtmlPruningMiddleware (570) and BlockDetectionMiddleware (580) so it stores
+    # decompressed, pruned bodies and never stores block pages
+    "scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware": 560,
+    # Must stay below HttpCompressionMiddleware (590) so it sees decompressed bodies
+    "default.middlewares.HtmlPruningMiddleware": 570,
+    # Must stay below HttpCompressionMiddleware (590) so it sees decompressed bodies
+    "default.middlewares.BlockDetectionMiddleware": 580,
+    # Must stay below HttpProxyMiddleware (750), which reads the proxy credentials it sets
+    "default.middlewares.ProxySessionPoolMiddleware": 610,
+}
+
+# Pool of sticky Bright Data sessions (BRIGHT_DATA_* environment variables), see default/proxies.py
+PROXY_POOL_ENABLED = True
+BRIGHT_DATA_PORT = 22225
+PROXY_POOL_SIZE = 8
+# Sessions the pool grows to for retries that avoid every session, past that they go back to the one avoided longest ago
+PROXY_POOL_MAX_SIZE = 16
+PROXY_SESSION_MAX_IN_FLIGHT = 4
+# A session is replaced once, over its last PROXY_SESSION_WINDOW requests, more than
+# PROXY_SESSION_MAX_ERROR_RATE of them failed (after PROXY_SESSION_MIN_SAMPLES requests)
+# or more than PROXY_SESSION_MAX_BLOCK_RATE of them were blocked
+PROXY_SESSION_WINDOW = 20
+PROXY_SESSION_MIN_SAMPLES = 5
+PROXY_SESSION_MAX_ERROR_RATE = 0.5
+PROXY_SESSION_MAX_BLOCK_RATE = 0.2
+PROXY_SESSION_BLOCK_CODES = [403, 429, 503]
+
+# Robot-check and captcha pages, recognized from byte signatures in the first
+# BLOCK_DETECTION_MAX_BYTES of the body and retried on another proxy session
+BLOCK_DETECTION_ENABLED = True
+BLOCK_DETECTION_MAX_BYTES = 65536
+BLOCK_SIGNATURES = [
+    "/errors/validateCaptcha",
+    "<title>Robot Check</title>",
+    "api-services-support@amazon.com",
+    "make sure you're not a robot",
+]
+BLOCK_RETRY_TIMES = 3
+BLOCK_RETRY_PRIORITY_ADJUST = 10
+
+# Hedged requests, see HedgingMiddleware in default/middlewares.py. A request still downloading after the
+# HEDGING_PERCENTILE latency of its page type (once HEDGING_MIN_SAMPLES were seen, and at least HEDGING_MIN_DELAY
+# seconds) is sent again through another proxy session. Each job may hedge HEDGING_BUDGET_MIN requests plus
+# HEDGING_BUDGET_RATIO of its requests. Off by default, every hedge is extra proxy traffic.
+HEDGING_ENABLED = False
+HEDGING_PERCENTILE = 95
+HEDGING_MIN_SAMPLES = 20
+HEDGING_MIN_DELAY = 1.0
+HEDGING_BUDGET_MIN = 1
+HEDGING_BUDGET_RATIO = 0.1
+HEDGING_PRIORITY_ADJUST = 10
+
+# Regions emptied from HTML responses before parsing, per request.meta['page_type']
+# See default/pruning.py for the available regions
+HTML_PRUNING_ENABLED = True
+HTML_PRUNING = {
+    "product": ["script", "style", "svg", "iframe", "comment"],
+    "reviews": ["script", "style", "svg", "iframe", "comment"],
+    "qa": ["script", "style", "svg", "iframe", "comment"],
+    "search": ["script", "style", "svg", "iframe", "comment"],
+}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-# EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-# }
+# LatencyMetrics only loads when ENABLE_TIMING=true and then writes the
+# timing/<function>/p50_ms, p95_ms and p99_ms stats at spider close
+EXTENSIONS = {
+   # "scrapy.extensions.telnet.TelnetConsole": None,
+   "default.extensions.LatencyMetrics": 500,
+   "default.extensions.AdaptiveConcurrency": 510,
+}
+
+# AIMD concurrency per domain, see default/extensions.py. The current window is
+# reported in the adaptive_concurrency/<domain>/window stat.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_CONCURRENCY_START = 8
+ADAPTIVE_CONCURRENCY_MIN = 1
+ADAPTIVE_CONCURRENCY_MAX = 32
+ADAPTIVE_CONCURRENCY_INCREASE = 1.0
+ADAPTIVE_CONCURRENCY_DECREASE = 0.5
+# Seconds; slower responses shrink the window
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 5.0
+ADAPTIVE_CONCURRENCY_COOLDOWN = 5.0
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -87,11 +259,23 @@ ROBOTSTXT_OBEY = True
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-# HTTPCACHE_ENABLED = True
-# HTTPCACHE_EXPIRATION_SECS = 0
-# HTTPCACHE_DIR = "httpcache"
-# HTTPCACHE_IGNORE_HTTP_CODES = []
-# HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+HTTPCACHE_ENABLED = True
+# Used for page types without an entry in HTTPCACHE_PAGE_TYPE_EXPIRATION, 0 means never expire
+HTTPCACHE_EXPIRATION_SECS = 3600
+# Seconds a response stays fresh, by request.meta['page_type']. Prices and stock change fast, Q&A does not.
+HTTPCACHE_PAGE_TYPE_EXPIRATION = {
+    "product": 1800,
+    "search": 900,
+    "reviews": 21600,
+    "qa": 604800,
+}
+HTTPCACHE_DIR = "httpcache"
+HTTPCACHE_IGNORE_HTTP_CODES = [403, 429, 500, 502, 503, 504]
+# Responses are kept zstd compressed in one SQLite database, see default/httpcache.py
+HTTPCACHE_STORAGE = "default.httpcache.SqliteCacheStorage"
+# Least recently used responses are evicted past this many compressed bytes
+HTTPCACHE_MAX_SIZE = 2 * 1024 ** 3
+HTTPCACHE_ZSTD_LEVEL = 3
 
 # Set settings whose default value is deprecated to a future-proof value
 REQUEST_FINGERPRINTER_IMPLEMENTATION = "2.7"
@@ -0,0 +1,5 @@
+# Signals sent by the project's middlewares and extensions, in addition to scrapy.signals.
+
+# Sent by BlockDetectionMiddleware when a response is a robot-check or captcha page.
+# Arguments: request, response, spider, signature (the bytes that matched)
+request_blocked = object()
@@ -1,36 +1,20 @@
 import datetime
-import functools
 import json
 import logging
-import os
 import re
 import time
-from random import randint
 import scrapy
-from scrapy import Spider
-
-# os.environ['ENABLE_TIMING'] = 'true'
-
-def timeit(method):
-    """Decorator to measure the execution time of a method."""
-    @functools.wraps(method)
-    def wrapper(*args, **kwargs):
-        if os.getenv('ENABLE_TIMING', 'false').lower() == 'true':
-            start_time = time.time()
-            result = method(*args, **kwargs)
-            end_time = time.time()
-            duration = end_time - start_time
-            if isinstance(args[0], Spider):
-                args[0].logger.info(f"{method.__name__} took {duration:.4f} seconds")
-            else:
-                print(f"{method.__name__} took {duration:.4f} seconds")
-        else:
-            result = method(*args, **kwargs)
-        return result
-    return wrapper
+from scrapy import signals
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet import task
+
+from default.executor import ParseExecutor
+from default.metrics import timeit
+from default.productcache import ProductCache
+from default.reviews import ReviewAggregator, ReviewStore
+from default.selectors import evaluate, get_roots, node_to_text
 
 
-@timeit
 def datetime_serializer(obj):
     """JSON serializer for objects not serializable by default json code."""
     if isinstance(obj, datetime.datetime):
@@ -56,30 +40,24 @@ def safe_extract(response_or_selector, queries, query_type='css', extract_first=
     """
     Safely extract data from a given set of queries on a response or selector.
     Tries each query until successful extraction.
-    :param response_or_selector: Scrapy Response or Selector object.
-    :param queries: List of strings representing the CSS or XPath queries.
+    :param response_or_selector: Scrapy Response, Selector object or lxml element.
+    :param queries: List of strings representing the CSS or XPath queries, compiled once through default.selectors.
     :param query_type: 'css' for CSS queries, 'xpath' for XPath queries. Assumes all queries are of the same type.
     :param extract_first: True to extract the first result, False to extract all results from the first successful query.
     :param default_value: Default value to return if no data is found. Can be of any type.
     :return: Extracted data from the first successful query or default value.
     """
+    roots = get_roots(response_or_selector)
     for query in queries:
-        if query_type == 'css':
-            data = response_or_selector.css(query)
-        elif query_type == 'xpath':
-            data = response_or_selector.xpath(query)
-        else:
-            raise ValueError("Invalid query_type. Use 'css' or 'xpath'.")
+        data = evaluate(roots, query, query_type)
 
         if data:
             if extract_first:
-                extracted = data.get()
+                extracted = node_to_text(data[0])
                 if extracted is not None:
                     return clean_text(extracted)
             else:
-                all_data = data.getall()
-                if all_data:
-                    return [clean_text(element) for element in all_data]
+                return [clean_text(node_to_text(element)) for element in data]
 
     # Return default value if none of the queries return data
     if not extract_first and isinstance(default_value, list):
@@ -87,14 +65,35 @@ def safe_extract(response_or_selector, queries, query_type='css', extract_first=
     return [default_value] if not extract_first else default_value
 
 
-@timeit
-def extract_table_data(response, table_selector):
-    table = response.xpath(table_selector)
-    data = {}
-    key_css_selectors = ["th::text"]
-    value_css_selectors = ["td::text"]
-    for row in table.xpath(".//tr"):
-        key = safe_extract(row, key_css_selectors, query_type='css', extract_first=True, default_value='Unknown Spec')
+# Every spec table get_product_specs reads, matched in a single pass over the document
+SPEC_TABLES_SELECTOR = ("//table[@id='productDetails_detailBullets_sections1' or @id='productDetails_techSpec_section_1'"
+                        " or @id='productDetails_techSpec_section_2']")
+
+
+def first_text(element, tag):
+    """
+    Return the first text node directly under any `tag` descendant of element, like the CSS query `tag::text`.
+    Walks the lxml tree directly instead of evaluating a selector.
+    """
+    for node in element.iter(tag):
+        if node.text is not None:
+            return node.text
+        for child in node:
+            if child.tail is not None:
+                return child.tail
+    return None
+
+
+def extract_table_rows(table, data):
+    """
+    Add the th/td pairs of every row of a spec table (lxml element) to data.
+    Rows are read straight from the tree; only the "Customer Reviews" and "Best Sellers Rank" rows need selectors.
+    """
+    for row in table.iter('tr'):
+        key = first_text(row, 'th')
+        if key is None:
+            continue
+        key = clean_text(key)
         if key == 'Customer Reviews':
             number_of_reviews_selectors = ['span#acrCustomerReviewText::text']
             average_rating_selectors = ["td.a-size-base span.a-size-base.a-color-base::text"]
@@ -117,49 +116,56 @@ def extract_table_data(response, table_selector):
             laptops_text = safe_extract(row, laptops_text_selector, query_type='css', extract_first=True,
                                         default_value='Not Available')
             value = f"{category_rank_computers} {top_100_text}, {category_rank_laptops} {laptops_text}"
-
         else:
-            value = safe_extract(row, value_css_selectors, query_type='css', extract_first=True,
-                                 default_value='Not Available')
-        # check if the value contains a span tag and check if the span tag has a text else get the text of the span tag
-        if key != 'Unknown Spec':
-            # replace all /n and strip out excess space from the font and end of the string
-            value = value.replace('\\n', '').strip()
-            data[key.strip()] = value
+            value = first_text(row, 'td')
+            value = clean_text(value) if value is not None else 'Not Available'
+        # replace all /n and strip out excess space from the font and end of the string
+        value = value.replace('\\n', '').strip()
+        data[key.strip()] = value
     return data
 
 
 @timeit
-def extract_product_details(response):
-    # Some pages don't have a table for product details, but they have a list of details
-    product_details = {}
-    detail_selector = response.css('#detailBullets_feature_div > ul.detail-bullet-list > li')
+def extract_table_data(response, table_selector):
+    data = {}
+    for table in evaluate(response, table_selector, query_type='xpath'):
+        extract_table_rows(table, data)
+    return data
+
 
-    for detail in detail_selector:
+def extract_detail_bullets(detail_list, product_details):
+    """Add the key/value pairs of a detailBullets list (lxml element) to product_details."""
+    for detail in detail_list.iterchildren('li'):
         key = safe_extract(detail, ['span.a-text-bold::text'], extract_first=True, default_value='')
         if key:
             key = key.replace(':', '').strip()
         value = safe_extract(detail, ['span:nth-child(2)::text'], extract_first=True, default_value='')
         if key and value:
             product_details[key] = value
+    return product_details
+
 
+@timeit
+def extract_product_details(response):
+    # Some pages don't have a table for product details, but they have a list of details
+    product_details = {}
+    for detail_list in evaluate(response, '#detailBullets_feature_div > ul.detail-bullet-list', query_type='css'):
+        extract_detail_bullets(detail_list, product_details)
     return product_details
 
 
 @timeit
 def get_product_specs(response):
-    product_specs = {}
-    # Identify the specs table by its ID
-    specs_table = response.xpath("//table[@id='productDetails_detailBullets_sections1']")
-    tech_specs_table1 = response.xpath("//table[@id='productDetails_techSpec_section_1']")
-    tech_spec_table2 = response.xpath("//table[@id='productDetails_techSpec_section_2']")
-    product_specs.update(extract_table_data(response, "//table[@id='productDetails_detailBullets_sections1']"))
+    # Match all spec tables at once, then read their rows straight from the tree
+    tables = {}
+    for table in evaluate(response, SPEC_TABLES_SELECTOR, query_type='xpath'):
+        extract_table_rows(table, tables.setdefault(table.get('id'), {}))
+
+    product_specs = dict(tables.get('productDetails_detailBullets_sections1', {}))
     if not product_specs:
         product_specs.update(extract_product_details(response))
-    tech_spec_1 = (extract_table_data(response, "//table[@id='productDetails_techSpec_section_1']"))
-    tech_spec_2 = (extract_table_data(response, "//table[@id='productDetails_techSpec_section_2']"))
-    product_specs.update(tech_spec_1)
-    product_specs.update(tech_spec_2)
+    product_specs.update(tables.get('productDetails_techSpec_section_1', {}))
+    product_specs.update(tables.get('productDetails_techSpec_section_2', {}))
 
     return product_specs
 
@@ -279,7 +285,7 @@ def get_stock(response):
 @timeit
 def get_reviews(response, product_reviews):
     reviews_selector = 'div[data-hook="review"]'
-    reviews = response.css(reviews_selector)
+    reviews = evaluate(response, reviews_selector, query_type='css')
 
     # Define variables for each selector
     rating_selectors = ['i[data-hook="review-star-rating"] > span::text']
@@ -288,6 +294,7 @@ def get_reviews(response, product_reviews):
     author_selectors = ['span.a-profile-name::text']
     collapsed_text_selectors = ['div[data-hook="review-collapsed"] > span::text']
 
+    aggregator = ReviewAggregator(product_reviews)
     for review in reviews:
         review_data = {
             'rating': safe_extract(review, rating_selectors, query_type='css', default_value='0'),
@@ -308,14 +315,12 @@ def get_reviews(response, product_reviews):
             logging.error(f"Failed to convert rating '{review_data['rating']}' to float.")
             review_data['rating'] = 0.0
 
-        # Check if the author already exists in the list of reviews to avoid duplicates
-        if not any(existing_review['author'] == review_data['author'] for existing_review in product_reviews):
-            product_reviews.append(review_data)
+        # Skip reviews already in the list (same author and content)
+        aggregator.add(review_data)
 
     return product_reviews
 
 
-@timeit
 def extract_asin_from_url(url):
     # Define the regular expression pattern to match an ASIN in the Amazon product URL
     pattern = r'/dp/([A-Z0-9]{10})'
@@ -437,145 +442,585 @@ def get_similar_products(product_asin, response):
     return products
 
 
+def parse_product_page(response, job_id):
+    """
+    Run every product page extractor on a response.
+    Kept at module level so it can be sent to a ParseExecutor worker process.
+    :return: Tuple of the product dict and the reviews shown on the product page.
+    """
+    product = {
+        "product_id": extract_asin_from_url(response.url),
+        "job_id": job_id,
+        "domain": response.url.split('/')[2],
+        "title": get_product_title(response),
+        "description": get_product_description(response),
+        "image_url": get_image_url(response),
+        "specs": get_product_specs(response),
+        "features": get_features(response),
+        "rating": get_rating(response),
+        "number_of_reviews": get_number_of_reviews(response),
+        "created_at": datetime.datetime.utcnow().isoformat(),
+        "updated_at": datetime.datetime.utcnow().isoformat(),
+        "variants": get_product_variants(response),
+        "stock": get_stock(response),
+        "generated_review": '',
+    }
+    product['price'], product['discount_percentage'] = get_price(response)
+    product['similar_products'] = get_similar_products(product["product_id"], response)
+    return product, get_reviews(response, [])
+
+
+def load_jobs(jobs=None, jobs_file=None):
+    """
+    Read the (url, job_id) pairs of a batch.
+    :param jobs: JSON list of [url, job_id] pairs or {"url": ..., "job_id": ...} objects.
+    :param jobs_file: Path of a file with one job per line, either as JSON or as "<url> <job_id>".
+    :return: List of (url, job_id) tuples.
+    """
+    entries = []
+    if jobs:
+        entries.extend(json.loads(jobs) if isinstance(jobs, str) else jobs)
+    if jobs_file:
+        with open(jobs_file, encoding='utf-8') as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                entries.append(json.loads(line) if line[0] in '[{' else line.split())
+    pairs = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = (entry.get('url'), entry.get('job_id'))
+        if len(entry) != 2 or not all(entry):
+            raise ValueError(f"Invalid job: {entry}")
+        pairs.append((entry[0], str(entry[1])))
+    return pairs
+
+
+class ProductJob(object):
+    """
+    Everything scraped so far for one product of the crawl, and the jobs waiting for it.
+    The product is complete once each of its pages has been parsed.
+    """
+    pages = ('product', 'qa', 'critical_reviews', 'positive_reviews')
+    # Field groups kept in the product cache, and the pages that refresh them
+    field_groups = {
+        'offer': ('product',),
+        'listing': ('product',),
+        'reviews': ('critical_reviews', 'positive_reviews'),
+        'qa': ('qa',),
+    }
+    # Product fields that change with the offer, the others belong to the listing
+    offer_fields = ('price', 'discount_percentage', 'stock', 'variants')
+
+    def __init__(self, url, job_id):
+        self.url = url
+        self.domain = url.split('/')[2]
+        self.asin = extract_asin_from_url(url)
+        self.job_ids = [job_id]
+        self.pending = set(self.pages)
+        # Pages requested by this crawl, the others were served from the product cache
+        self.fetched = set(self.pages)
+        self.product = {}
+        self.qa = []
+        self.critical_reviews = []
+        self.positive_reviews = []
+        self.default_reviews = []
+        # Reviews not in the review store yet, by stream, gathered over the pages of an incremental crawl
+        self.new_reviews = {}
+        # Review pages received so far, by stream and page number
+        self.review_pages = {}
+        self.errors = {}
+        if self.asin is None:
+            # The review and Q&A pages are addressed by ASIN, only the product page of such a link can be fetched
+            self.pending = {'product'}
+            self.fetched = {'product'}
+            self.errors = {page: 'no asin' for page in self.pages if page != 'product'}
+        self.start_time = datetime.datetime.utcnow().isoformat()
+        # time.monotonic() by which the product is posted with whatever was parsed, set once its pages are requested
+        self.deadline = None
+        # Whether its partial jobs were scheduled once the deadline passed
+        self.deadline_passed = False
+        # In-progress jobs posted so far with PARTIAL_RESULTS_ENABLED, and whether they included the core product
+        self.sequence = 0
+        self.product_posted = False
+
+    @property
+    def key(self):
+        # Links without a /dp/<ASIN> are told apart by URL
+        return self.domain, self.asin or self.url
+
+    def page_done(self, page):
+        """Mark a page as parsed. Returns True when it was the last pending one."""
+        self.pending.discard(page)
+        return not self.pending
+
+    def expire(self):
+        """Give up on the pages still pending at the deadline."""
+        for page in self.pending:
+            self.errors[page] = 'deadline'
+        self.pending.clear()
+
+    def restore(self, groups):
+        """
+        Fill in field groups read from the product cache, and only wait for the pages of the others.
+        :param groups: Dict of fresh field groups, by name, as returned by cached_groups.
+        """
+        for group, data in groups.items():
+            if group == 'offer':
+                self.product.update(data)
+            elif group == 'listing':
+                self.product.update(data['product'])
+                self.default_reviews = data['default_reviews']
+            elif group == 'reviews':
+                self.critical_reviews = data['critical_reviews']
+                self.positive_reviews = data['positive_reviews']
+            elif group == 'qa':
+                self.qa = data
+        self.fetched = {page for group, pages in self.field_groups.items() if group not in groups for page in pages}
+        self.pending = set(self.fetched)
+
+    def cached_groups(self):
+        """
+        Return the field groups this crawl refreshed, to store in the product cache.
+        Groups with a page that was blocked or not fetched are left out.
+        Must be called before generate_jobs, which strips the review authors.
+        """
+        groups = {}
+        for group, pages in self.field_groups.items():
+            if not self.fetched.issuperset(pages) or any(page in self.errors for page in pages):
+                continue
+            if group == 'offer':
+                groups[group] = {field: self.product.get(field) for field in self.offer_fields}
+            elif group == 'listing':
+                product = {field: value for field, value in self.product.items() if field not in self.offer_fields}
+                groups[group] = {'product': product, 'default_reviews': self.default_reviews}
+            elif group == 'reviews':
+                groups[group] = {'critical_reviews': self.critical_reviews,
+                                 'positive_reviews': self.positive_reviews}
+            elif group == 'qa':
+                groups[group] = self.qa
+        return groups
+
+    def anonymous_reviews(self):
+        """Merge the reviews parsed so far, without their authors, leaving the parsed reviews untouched."""
+        reviews = ReviewAggregator().merge(self.critical_reviews, self.positive_reviews, self.default_reviews)
+        return [{field: value for field, value in review.items() if field != 'author'} for review in reviews]
+
+    def progress_jobs(self, page):
+        """
+        Build the in_progress jobs of a page parsed before the last one of the product.
+        The core product is posted as soon as its page is parsed, with the reviews and Q&A parsed before it. Each
+        page parsed after it is posted as a patch of the fields it fills.
+        """
+        patch = None
+        if page == 'product':
+            self.product_posted = True
+            product = dict(self.product, reviews=self.anonymous_reviews(), qa=self.qa)
+        elif not self.product_posted:
+            # Posted along with the core product
+            return []
+        elif page == 'qa':
+            patch = {'qa': self.qa}
+        else:
+            patch = {'reviews': self.anonymous_reviews()}
+        self.sequence += 1
+        jobs = []
+        for job_id in self.job_ids:
+            job = {
+                "job_id": job_id,
+                "status": "in_progress",
+                "sequence": self.sequence,
+                "end_time": datetime.datetime.utcnow().isoformat(),
+                "start_time": self.start_time,
+                "result": [dict(product, job_id=job_id)] if patch is None else [],
+                "url": self.url,
+                "error": dict(self.errors)
+            }
+            if patch is not None:
+                job['patch'] = patch
+            jobs.append(job)
+        return jobs
+
+    def generate_jobs(self, status='completed'):
+        """
+        Build the finished job of every job id waiting for this product.
+        :param status: 'completed', or 'partial' when the deadline passed before every page was parsed.
+        """
+        aggregator = ReviewAggregator()
+        aggregator.merge(self.critical_reviews, self.positive_reviews, self.default_reviews)
+        # we remove the author to keep anonymity
+        reviews = aggregator.strip_authors()
+        product = self.product
+        product['reviews'] = reviews
+        product['qa'] = self.qa
+
+        jobs = []
+        for job_id in self.job_ids:
+            job = {
+                "job_id": job_id,
+                "status": status,
+                "end_time": datetime.datetime.utcnow().isoformat(),
+                "start_time": self.start_time,
+                "result": [dict(product, job_id=job_id)],
+                "url": self.url,
+                "error": dict(self.errors)
+            }
+            if self.sequence:
+                # Follows the in_progress jobs, which may be delivered out of order
+                job['sequence'] = self.sequence + 1
+            jobs.append(job)
+        return jobs
+
+
 class AmazonSpider(scrapy.Spider):
     name = 'amazon'
 
     @timeit
-    def __init__(self, url=None, job_id=None, *args, **kwargs):
+    def __init__(self, url=None, job_id=None, jobs=None, jobs_file=None, max_review_pages=None, deadline=None,
+                 *args, **kwargs):
+        """
+        Scrape one product (url and job_id) or a batch of them (jobs and/or jobs_file, see load_jobs).
+        The pages of every product are fetched concurrently and each job is posted as soon as its own product is
+        complete, or with a partial status once its deadline has passed.
+        With PARTIAL_RESULTS_ENABLED, the core product is also posted as soon as its page is parsed, and the reviews
+        and Q&A follow as patches.
+        :param max_review_pages: Pages of critical and positive reviews to read (default: REVIEW_MAX_PAGES).
+        :param deadline: Seconds from the first request of a product to its job being posted (default: JOB_DEADLINE).
+                         0 waits for every page.
+        """
         super(AmazonSpider, self).__init__(*args, **kwargs)
         self.job = {}
-        if not url or not job_id:
+        pairs = load_jobs(jobs, jobs_file)
+        if url or job_id:
+            if not url or not job_id:
+                logging.error("URL and Job ID are required")
+                raise ValueError("URL and Job ID are required")
+            pairs.insert(0, (url, job_id))
+        if not pairs:
             logging.error("URL and Job ID are required")
             raise ValueError("URL and Job ID are required")
-        self.start_urls = [url]  # This should be the URL you intend to scrape
-        self.job_id = job_id
-        self.critical_reviews = []
-        self.positive_reviews = []
-        self.default_reviews = []
-        self.requests_completed = 0
-        self.requests_needed = 4
-        self.product = {}
-        self.qa = []
-        username = os.getenv("BRIGHT_DATA_USERNAME")
-        password = os.getenv("BRIGHT_DATA_PASSWORD")
-        host = os.getenv("BRIGHT_DATA_HOST")
-        if not all([username, password, host]):
-            logging.error("Missing proxy configuration")
-            return
-        session_id = randint(0, 1000000)
-        proxy_user_pass = f"{username}-session-{session_id}:{password}"
-        proxy_url = f"http://{proxy_user_pass}@{host}:22225"
-        self.proxy = proxy_url
+        # Products being scraped, keyed by (domain, ASIN), or (domain, URL) for links without an ASIN. Jobs asking
+        # for the same product share its requests.
+        self.products = {}
+        for url, job_id in pairs:
+            product_job = ProductJob(url, job_id)
+            if product_job.key in self.products:
+                if job_id not in self.products[product_job.key].job_ids:
+                    self.products[product_job.key].job_ids.append(job_id)
+            else:
+                self.products[product_job.key] = product_job
+        self.start_urls = [product_job.url for product_job in self.products.values()]
+        self.jobs_needed = sum(len(product_job.job_ids) for product_job in self.products.values())
+        self.jobs_completed = 0
+        self.parse_executor = None
+        self.product_cache = None
+        self.review_store = None
+        self.review_store_max_pages = 1
+        self.max_review_pages = int(max_review_pages) if max_review_pages else 1
+        self.review_page_size = 10
+        self.job_deadline = float(deadline) if deadline else 0
+        self.partial_results = False
+        self.deadline_check = None
+        self.in_flight_priority = 10
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(AmazonSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.parse_executor = ParseExecutor.from_crawler(crawler)
+        spider.product_cache = ProductCache.from_crawler(crawler)
+        spider.review_store = ReviewStore.from_crawler(crawler)
+        spider.review_store_max_pages = crawler.settings.getint('REVIEW_STORE_MAX_PAGES', 5)
+        if not kwargs.get('max_review_pages'):
+            spider.max_review_pages = crawler.settings.getint('REVIEW_MAX_PAGES', 1)
+        spider.review_page_size = crawler.settings.getint('REVIEW_PAGE_SIZE', 10)
+        if kwargs.get('deadline') is None:
+            spider.job_deadline = crawler.settings.getfloat('JOB_DEADLINE', 0)
+        spider.partial_results = crawler.settings.getbool('PARTIAL_RESULTS_ENABLED')
+        spider.in_flight_priority = crawler.settings.getint('IN_FLIGHT_PRIORITY', 10)
+        crawler.signals.connect(spider.spider_opened, signal=signals.spider_opened)
+        return spider
+
+    def spider_opened(self, spider):
+        if self.job_deadline:
+            self.deadline_check = task.LoopingCall(self.check_deadlines)
+            self.deadline_check.start(min(1.0, self.job_deadline), now=False)
+
+    def closed(self, reason):
+        # Safe to call again, the stores are only closed once
+        if self.deadline_check is not None and self.deadline_check.running:
+            self.deadline_check.stop()
+        if self.product_cache is not None:
+            self.product_cache.close()
+            self.product_cache = None
+        if self.review_store is not None:
+            self.review_store.close()
+            self.review_store = None
 
     @timeit
     def start_requests(self):
-        for url in self.start_urls:
-            domain = url.split('/')[2]
-            product_id = extract_asin_from_url(url)
-            critical_reviews_url = f"https://{domain}/product-reviews/{product_id}/?filterByStar=critical&reviewerType=avp_only_reviews"
-            positive_reviews_url = f"https://{domain}/product-reviews/{product_id}/?filterByStar=positive&reviewerType=avp_only_reviews"
-            qa_url = f"https://{domain}/ask/questions/asin/{product_id}"
-            yield scrapy.Request(qa_url, callback=self.extract_questions_and_answers, meta={'proxy': self.proxy})
-            yield scrapy.Request(url, callback=self.parse, meta={'proxy': self.proxy})
-            yield scrapy.Request(critical_reviews_url, callback=self.parse_critical_reviews,
-                                 meta={'proxy': self.proxy})
-            yield scrapy.Request(positive_reviews_url, callback=self.parse_positive_reviews,
-                                 meta={'proxy': self.proxy})
-
-    @timeit
-    def generate_job(self) -> dict or None:
-        if self.requests_completed != self.requests_needed:
+        for product_job in list(self.products.values()):
+            url = product_job.url
+            domain = product_job.domain
+            product_id = product_job.asin
+            key = product_job.key
+            # The cache is keyed by ASIN, a product URL without one is always fetched
+            if self.product_cache is not None and product_id is not None:
+                groups = self.product_cache.load(key)
+                for group in product_job.field_groups:
+                    self.crawler.stats.inc_value(f"product_cache/{group}/{'hit' if group in groups else 'miss'}")
+                product_job.restore(groups)
+                if not product_job.pending:
+                    # Every field group is fresh. A data: request is answered locally, so the jobs
+                    # are emitted from its callback without touching the network, ahead of the pages to download.
+                    self.crawler.stats.inc_value('product_cache/served')
+                    yield scrapy.Request('data:,', callback=self.parse_cached, dont_filter=True,
+                                         priority=self.in_flight_priority,
+                                         meta={'product_key': key, 'dont_cache': True, 'dont_detect_blocks': True})
+                    continue
+                if self.partial_results and 'product' not in product_job.pending:
+                    # The core product is fresh, it is posted right away as its parsed page would have been
+                    yield scrapy.Request('data:,', callback=self.parse_cached_core, dont_filter=True,
+                                         priority=self.in_flight_priority,
+                                         meta={'product_key': key, 'dont_cache': True, 'dont_detect_blocks': True})
+            if self.job_deadline:
+                product_job.deadline = time.monotonic() + self.job_deadline
+            # The scheduler is first in first out within a priority: products are scraped in the order of their
+            # jobs, each starting with its product page, the largest page and the one partial results wait for
+            if 'product' in product_job.pending:
+                yield scrapy.Request(url, callback=self.parse, errback=self.page_failed,
+                                     meta=self.page_meta(product_job, 'product', page_type='product'))
+            if 'critical_reviews' in product_job.pending:
+                yield self.reviews_request(product_job, 'critical_reviews')
+            if 'positive_reviews' in product_job.pending:
+                yield self.reviews_request(product_job, 'positive_reviews')
+            if 'qa' in product_job.pending:
+                qa_url = f"https://{domain}/ask/questions/asin/{product_id}"
+                yield scrapy.Request(qa_url, callback=self.extract_questions_and_answers, errback=self.page_failed,
+                                     meta=self.page_meta(product_job, 'qa', page_type='qa'))
+
+    def reviews_request(self, product_job, stream, page_number=1):
+        """
+        Build the request of a page of critical or positive reviews.
+        With a review store, pages are sorted by most recent so a crawl can stop at the first known review.
+        """
+        star = 'critical' if stream == 'critical_reviews' else 'positive'
+        url = (f"https://{product_job.domain}/product-reviews/{product_job.asin}/"
+               f"?filterByStar={star}&reviewerType=avp_only_reviews")
+        if self.review_store is not None:
+            url += f"&sortBy=recent&pageNumber={page_number}"
+        elif page_number > 1:
+            url += f"&pageNumber={page_number}"
+        callback = self.parse_critical_reviews if stream == 'critical_reviews' else self.parse_positive_reviews
+        # Later pages belong to a product in flight, they go before the products still to start
+        priority = self.in_flight_priority if page_number > 1 else 0
+        return scrapy.Request(url, callback=callback, errback=self.page_failed, priority=priority,
+                              meta=self.page_meta(product_job, stream, page_type='reviews', review_page=page_number))
+
+    def page_meta(self, product_job, page, **meta):
+        """Build the meta of a request for one of the pages of a product."""
+        # The pages of a product share a proxy session while it stays healthy
+        meta.update(product_key=product_job.key, product_page=page,
+                    proxy_session_key='/'.join(product_job.key))
+        if product_job.deadline is not None:
+            # DeadlineMiddleware bounds each attempt by the time left and drops those left once it has passed
+            meta['download_deadline'] = product_job.deadline
+        return meta
+
+    def page_parsed(self, product_job, page):
+        """
+        Record that a page of a product was parsed and emit its jobs once it was the last one.
+        With PARTIAL_RESULTS_ENABLED, the pages before the last one are emitted as in_progress jobs.
+        """
+        if self.products.get(product_job.key) is not product_job:
+            # The product was already posted at its deadline
             return
-        reviews = self.critical_reviews
-        for review in self.positive_reviews:
-            if review['author'] not in [r['author'] for r in reviews]:
-                reviews.append(review)
-        for review in self.default_reviews:
-            if review['author'] not in [r['author'] for r in reviews]:
-                reviews.append(review)
-        for review in reviews:
-            # we remove the author to keep anonymity
-            if 'author' in review:
-                review.pop('author', None)
-        qa = self.qa
-        product = self.product
-        product['reviews'] = reviews
-        product['qa'] = qa
-
-        job = {
-            "job_id": self.job_id,
-            "status": "completed",
-            "end_time": datetime.datetime.utcnow().isoformat(),
-            "start_time": datetime.datetime.utcnow().isoformat(),
-            "result": [product],
-            "url": self.start_urls[0],
-            "error": {}
-        }
-        return job
+        if not product_job.page_done(page):
+            if self.partial_results and page not in product_job.errors:
+                yield from product_job.progress_jobs(page)
+            return
+        yield from self.product_done(product_job)
+
+    def product_done(self, product_job, status='completed'):
+        # The product is done, its state is no longer needed once the jobs are built
+        self.products.pop(product_job.key, None)
+        if self.product_cache is not None and product_job.asin is not None:
+            self.product_cache.store(product_job.key, product_job.cached_groups())
+        for job in product_job.generate_jobs(status):
+            # Delivered to SERVICE_URL by HttpPipeline, which calls close_job once the service acknowledged it
+            yield job
+
+    def page_blocked(self, product_job, page):
+        """Record a page that was still a robot-check page after its retries, without parsing it."""
+        product_job.errors[page] = 'blocked'
+        yield from self.page_parsed(product_job, page)
+
+    def page_failed(self, failure):
+        """Record a page that could not be downloaded, so that it does not hold up its product."""
+        request = failure.request
+        product_job = self.products.get(request.meta['product_key'])
+        page = request.meta['product_page']
+        if product_job is None or page not in product_job.pending:
+            return
+        if product_job.deadline is not None and time.monotonic() >= product_job.deadline:
+            # Timed out at the deadline, or dropped by DeadlineMiddleware: the job is posted without the page rather
+            # than when check_deadlines next runs, which could be after the spider went idle and closed
+            yield from self.product_expired(product_job)
+            return
+        self.crawler.stats.inc_value(f"pages_failed/{failure.type.__name__}")
+        review_page = request.meta.get('review_page', 1)
+        if review_page > 1:
+            # Later pages only add reviews, the stream ends before a failed one
+            yield from self.reviews_received(product_job, page, review_page, [])
+            return
+        product_job.errors[page] = failure.type.__name__
+        yield from self.page_parsed(product_job, page)
+
+    def check_deadlines(self):
+        """Schedule the partial jobs of the products whose deadline has passed."""
+        now = time.monotonic()
+        for product_job in self.products.values():
+            if product_job.deadline is not None and not product_job.deadline_passed and now >= product_job.deadline:
+                product_job.deadline_passed = True
+                # Jobs can only be emitted from a callback, a data: request is answered without the network
+                self.crawler.engine.crawl(scrapy.Request('data:,', callback=self.parse_expired, dont_filter=True,
+                                                         priority=self.in_flight_priority,
+                                                         meta={'product_key': product_job.key, 'dont_cache': True,
+                                                               'dont_detect_blocks': True}))
+
+    def parse_expired(self, response):
+        """Emit the jobs of a product whose deadline has passed, with the pages parsed so far."""
+        product_job = self.products.get(response.meta['product_key'])
+        if product_job is None or not product_job.pending:
+            return
+        yield from self.product_expired(product_job)
+
+    def product_expired(self, product_job):
+        """Emit the jobs of a product with the pages parsed so far, as partial."""
+        self.crawler.stats.inc_value('jobs/partial', len(product_job.job_ids))
+        product_job.expire()
+        yield from self.product_done(product_job, status='partial')
+
+    def parse_cached(self, response):
+        """Emit the jobs of a product served entirely from the product cache."""
+        yield from self.product_done(self.products[response.meta['product_key']])
+
+    def parse_cached_core(self, response):
+        """Emit the in_progress job of a core product restored from the product cache, while its other pages load."""
+        product_job = self.products.get(response.meta['product_key'])
+        if product_job is None or product_job.product_posted:
+            # Its other pages were all parsed first, the product was posted whole
+            return
+        yield from product_job.progress_jobs('product')
 
     @timeit
-    def close_job(self, response):
-        # Logic to handle the response and close the job
-        self.close(self, reason="Job completed successfully")
+    def close_job(self, job):
+        # Logic to handle the response and close the job. In-progress jobs are only acknowledged, a job is closed
+        # once its completed (or partial) job is.
+        if job.get('status') == 'in_progress':
+            return
+        self.jobs_completed += 1
+        if self.jobs_completed == self.jobs_needed:
+            # The engine closes the spider, which calls closed() through the spider_closed signal
+            self.crawler.engine.close_spider(self, reason="Job completed successfully")
 
     @timeit
     def parse(self, response: scrapy.http.Response):
-        selector = response.selector
-        self.product = {
-            "product_id": extract_asin_from_url(response.url),
-            "job_id": self.job_id,
-            "domain": response.url.split('/')[2],
-            "title": get_product_title(response),
-            "description": get_product_description(response),
-            "image_url": get_image_url(response),
-            "specs": get_product_specs(response),
-            "features": get_features(response),
-            "rating": get_rating(response),
-            "number_of_reviews": get_number_of_reviews(response),
-            "created_at": datetime.datetime.utcnow().isoformat(),
-            "updated_at": datetime.datetime.utcnow().isoformat(),
-            "variants": get_product_variants(response),
-            "stock": get_stock(response),
-            "generated_review": '',
-        }
-        self.product['price'], self.product['discount_percentage'] = get_price(response)
-        similar_products = get_similar_products(self.product["product_id"], response)
-        self.product['similar_products'] = similar_products
-        self.default_reviews = get_reviews(response, [])
-        self.requests_completed += 1
-        if self.requests_completed == self.requests_needed:
-            job = self.generate_job()
-            data = json.dumps(job, default=datetime_serializer)
-            endpoint = os.getenv("SERVICE_URL")
-            yield scrapy.Request(url=endpoint + "/api/v1/scrapy/update", callback=self.close_job, body=data,
-                                 method='POST')
+        product_job = self.products.get(response.meta['product_key'])
+        if product_job is None:
+            # Arrived after the product was posted at its deadline
+            return None
+        if 'blocked' in response.flags:
+            return self.page_blocked(product_job, 'product')
+        if self.parse_executor is not None:
+            return self.parse_in_executor(product_job, response)
+        return self.handle_product_page(product_job, *parse_product_page(response, product_job.job_ids[0]))
+
+    async def parse_in_executor(self, product_job, response):
+        product, default_reviews = await maybe_deferred_to_future(
+            self.parse_executor.submit(parse_product_page, response, product_job.job_ids[0]))
+        for request in self.handle_product_page(product_job, product, default_reviews):
+            yield request
+
+    def handle_product_page(self, product_job, product, default_reviews):
+        product_job.product = product
+        product_job.default_reviews = default_reviews
+        yield from self.page_parsed(product_job, 'product')
 
     @timeit
     def parse_critical_reviews(self, response):
-        critical_reviews = get_reviews(response, [])
-        self.critical_reviews = critical_reviews
-        self.requests_completed += 1
-        if self.requests_completed == self.requests_needed:
-            job = self.generate_job()
-            data = json.dumps(job, default=datetime_serializer)
-            endpoint = os.getenv("SERVICE_URL")
-            yield scrapy.Request(url=endpoint + "/api/v1/scrapy/update", callback=self.close_job, body=data,
-                                 method='POST')
+        yield from self.handle_reviews_page(response, 'critical_reviews')
 
     @timeit
     def parse_positive_reviews(self, response):
-        positive_reviews = get_reviews(response, [])
-        self.positive_reviews = positive_reviews
-        self.requests_completed += 1
-        if self.requests_completed == self.requests_needed:
-            job = self.generate_job()
-            data = json.dumps(job, default=datetime_serializer)
-            endpoint = os.getenv("SERVICE_URL")
-            yield scrapy.Request(url=endpoint + "/api/v1/scrapy/update", callback=self.close_job, body=data,
-                                 method='POST')
+        yield from self.handle_reviews_page(response, 'positive_reviews')
+
+    def handle_reviews_page(self, response, stream):
+        product_job = self.products.get(response.meta['product_key'])
+        if product_job is None or stream not in product_job.pending:
+            # A page past the last page of its stream, arriving after the stream was done
+            return
+        page_number = response.meta.get('review_page', 1)
+        if 'blocked' in response.flags:
+            if page_number == 1:
+                yield from self.page_blocked(product_job, stream)
+                return
+            # Later pages only add reviews, the stream ends before a blocked one
+            self.crawler.stats.inc_value('reviews/pages_blocked')
+            reviews = []
+        else:
+            reviews = get_reviews(response, [])
+        yield from self.reviews_received(product_job, stream, page_number, reviews)
+
+    def reviews_received(self, product_job, stream, page_number, reviews):
+        """Add a page of reviews to its stream, and complete the stream once its last page is in."""
+        if self.review_store is not None and self.review_store.count(product_job.key, stream):
+            yield from self.handle_recent_reviews_page(product_job, stream, page_number, reviews)
+            return
+
+        # Page 1 tells whether there is more than one page: once it is full, pages 2..max_review_pages are
+        # fetched concurrently. The stream ends at the first page with fewer reviews than a full one.
+        pages = product_job.review_pages.setdefault(stream, {})
+        pages[page_number] = reviews
+        if page_number == 1 and len(reviews) >= self.review_page_size:
+            for number in range(2, self.max_review_pages + 1):
+                yield self.reviews_request(product_job, stream, number)
+        last_page = next((number for number in sorted(pages) if len(pages[number]) < self.review_page_size),
+                         self.max_review_pages)
+        if any(number not in pages for number in range(1, last_page + 1)):
+            return
+        del product_job.review_pages[stream]
+        reviews = ReviewAggregator().merge(*(pages[number] for number in range(1, last_page + 1)))
+        if self.review_store is not None:
+            # First crawl of the product, everything read is new
+            self.review_store.add(product_job.key, stream, reviews)
+            reviews = self.review_store.load(product_job.key, stream)
+        setattr(product_job, stream, reviews)
+        yield from self.page_parsed(product_job, stream)
+
+    def handle_recent_reviews_page(self, product_job, stream, page_number, reviews):
+        """Read review pages sorted by most recent one after the other, until a review the store knows."""
+        new_reviews, reached_known = self.review_store.split(product_job.key, stream, reviews)
+        product_job.new_reviews.setdefault(stream, []).extend(new_reviews)
+        if (not reached_known and len(reviews) >= self.review_page_size
+                and page_number < self.review_store_max_pages):
+            yield self.reviews_request(product_job, stream, page_number + 1)
+            return
+        self.crawler.stats.inc_value('review_store/pages', page_number)
+        self.crawler.stats.inc_value('review_store/new_reviews', len(product_job.new_reviews[stream]))
+        self.review_store.add(product_job.key, stream, product_job.new_reviews.pop(stream))
+        setattr(product_job, stream, self.review_store.load(product_job.key, stream))
+        yield from self.page_parsed(product_job, stream)
 
     @timeit
     def extract_questions_and_answers(self, response):
+        product_job = self.products.get(response.meta['product_key'])
+        if product_job is None:
+            # Arrived after the product was posted at its deadline
+            return
+        if 'blocked' in response.flags:
+            yield from self.page_blocked(product_job, 'qa')
+            return
         qa_pairs = []
 
         # Select elements with an id containing 'question'
@@ -606,11 +1051,5 @@ class AmazonSpider(scrapy.Spider):
                 answer_text = ''
                 question_text = ''
 
-        self.qa = qa_pairs
-        self.requests_completed += 1
-        if self.requests_completed == self.requests_needed:
-            job = self.generate_job()
-            data = json.dumps(job, default=datetime_serializer)
-            endpoint = os.getenv("SERVICE_URL")
-            yield scrapy.Request(url=endpoint + "/api/v1/scrapy/update", callback=self.close_job, body=data,
-                                 method='POST')
+        product_job.qa = qa_pairs
+        yield from self.page_parsed(product_job, 'qa')
@@ -1,39 +1,18 @@
 import datetime
-import functools
 import json
 import logging
-import os
 import re
-import time
-from random import randint
+from urllib.parse import urlsplit
 import scrapy
-from scrapy import Spider
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 
+from default.inputs import UrlQueue, normalize_product_url, read_urls_file
+from default.metrics import timeit
+from default.reviews import ReviewAggregator
+from default.selectors import evaluate, get_roots, node_to_text
 
-# os.environ['ENABLE_TIMING'] = 'true'
 
-def timeit(method):
-    """Decorator to measure the execution time of a method."""
-
-    @functools.wraps(method)
-    def wrapper(*args, **kwargs):
-        if os.getenv('ENABLE_TIMING', 'false').lower() == 'true':
-            start_time = time.time()
-            result = method(*args, **kwargs)
-            end_time = time.time()
-            duration = end_time - start_time
-            if isinstance(args[0], Spider):
-                args[0].logger.info(f"{method.__name__} took {duration:.4f} seconds")
-            else:
-                print(f"{method.__name__} took {duration:.4f} seconds")
-        else:
-            result = method(*args, **kwargs)
-        return result
-
-    return wrapper
-
-
-@timeit
 def datetime_serializer(obj):
     """JSON serializer for objects not serializable by default json code."""
     if isinstance(obj, datetime.datetime):
@@ -59,30 +38,24 @@ def safe_extract(response_or_selector, queries, query_type='css', extract_first=
     """
     Safely extract data from a given set of queries on a response or selector.
     Tries each query until successful extraction.
-    :param response_or_selector: Scrapy Response or Selector object.
-    :param queries: List of strings representing the CSS or XPath queries.
+    :param response_or_selector: Scrapy Response, Selector object or lxml element.
+    :param queries: List of strings representing the CSS or XPath queries, compiled once through default.selectors.
     :param query_type: 'css' for CSS queries, 'xpath' for XPath queries. Assumes all queries are of the same type.
     :param extract_first: True to extract the first result, False to extract all results from the first successful query.
     :param default_value: Default value to return if no data is found. Can be of any type.
     :return: Extracted data from the first successful query or default value.
     """
+    roots = get_roots(response_or_selector)
     for query in queries:
-        if query_type == 'css':
-            data = response_or_selector.css(query)
-        elif query_type == 'xpath':
-            data = response_or_selector.xpath(query)
-        else:
-            raise ValueError("Invalid query_type. Use 'css' or 'xpath'.")
+        data = evaluate(roots, query, query_type)
 
         if data:
             if extract_first:
-                extracted = data.get()
+                extracted = node_to_text(data[0])
                 if extracted is not None:
                     return clean_text(extracted)
             else:
-                all_data = data.getall()
-                if all_data:
-                    return [clean_text(element) for element in all_data]
+                return [clean_text(node_to_text(element)) for element in data]
 
     # Return default value if none of the queries return data
     if not extract_first and isinstance(default_value, list):
@@ -90,14 +63,35 @@ def safe_extract(response_or_selector, queries, query_type='css', extract_first=
     return [default_value] if not extract_first else default_value
 
 
-@timeit
-def extract_table_data(response, table_selector):
-    table = response.xpath(table_selector)
-    data = {}
-    key_css_selectors = ["th::text"]
-    value_css_selectors = ["td::text"]
-    for row in table.xpath(".//tr"):
-        key = safe_extract(row, key_css_selectors, query_type='css', extract_first=True, default_value='Unknown Spec')
+# Every spec table get_product_specs reads, matched in a single pass over the document
+SPEC_TABLES_SELECTOR = ("//table[@id='productDetails_detailBullets_sections1' or @id='productDetails_techSpec_section_1'"
+                        " or @id='productDetails_techSpec_section_2']")
+
+
+def first_text(element, tag):
+    """
+    Return the first text node directly under any `tag` descendant of element, like the CSS query `tag::text`.
+    Walks the lxml tree directly instead of evaluating a selector.
+    """
+    for node in element.iter(tag):
+        if node.text is not None:
+            return node.text
+        for child in node:
+            if child.tail is not None:
+                return child.tail
+    return None
+
+
+def extract_table_rows(table, data):
+    """
+    Add the th/td pairs of every row of a spec table (lxml element) to data.
+    Rows are read straight from the tree; only the "Customer Reviews" and "Best Sellers Rank" rows need selectors.
+    """
+    for row in table.iter('tr'):
+        key = first_text(row, 'th')
+        if key is None:
+            continue
+        key = clean_text(key)
         if key == 'Customer Reviews':
             number_of_reviews_selectors = ['span#acrCustomerReviewText::text']
             average_rating_selectors = ["td.a-size-base span.a-size-base.a-color-base::text"]
@@ -120,49 +114,56 @@ def extract_table_data(response, table_selector):
             laptops_text = safe_extract(row, laptops_text_selector, query_type='css', extract_first=True,
                                         default_value='Not Available')
             value = f"{category_rank_computers} {top_100_text}, {category_rank_laptops} {laptops_text}"
-
         else:
-            value = safe_extract(row, value_css_selectors, query_type='css', extract_first=True,
-                                 default_value='Not Available')
-        # check if the value contains a span tag and check if the span tag has a text else get the text of the span tag
-        if key != 'Unknown Spec':
-            # replace all /n and strip out excess space from the font and end of the string
-            value = value.replace('\\n', '').strip()
-            data[key.strip()] = value
+            value = first_text(row, 'td')
+            value = clean_text(value) if value is not None else 'Not Available'
+        # replace all /n and strip out excess space from the font and end of the string
+        value = value.replace('\\n', '').strip()
+        data[key.strip()] = value
     return data
 
 
 @timeit
-def extract_product_details(response):
-    # Some pages don't have a table for product details, but they have a list of details
-    product_details = {}
-    detail_selector = response.css('#detailBullets_feature_div > ul.detail-bullet-list > li')
+def extract_table_data(response, table_selector):
+    data = {}
+    for table in evaluate(response, table_selector, query_type='xpath'):
+        extract_table_rows(table, data)
+    return data
+
 
-    for detail in detail_selector:
+def extract_detail_bullets(detail_list, product_details):
+    """Add the key/value pairs of a detailBullets list (lxml element) to product_details."""
+    for detail in detail_list.iterchildren('li'):
         key = safe_extract(detail, ['span.a-text-bold::text'], extract_first=True, default_value='')
         if key:
             key = key.replace(':', '').strip()
         value = safe_extract(detail, ['span:nth-child(2)::text'], extract_first=True, default_value='')
         if key and value:
             product_details[key] = value
+    return product_details
+
 
+@timeit
+def extract_product_details(response):
+    # Some pages don't have a table for product details, but they have a list of details
+    product_details = {}
+    for detail_list in evaluate(response, '#detailBullets_feature_div > ul.detail-bullet-list', query_type='css'):
+        extract_detail_bullets(detail_list, product_details)
     return product_details
 
 
 @timeit
 def get_product_specs(response):
-    product_specs = {}
-    # Identify the specs table by its ID
-    specs_table = response.xpath("//table[@id='productDetails_detailBullets_sections1']")
-    tech_specs_table1 = response.xpath("//table[@id='productDetails_techSpec_section_1']")
-    tech_spec_table2 = response.xpath("//table[@id='productDetails_techSpec_section_2']")
-    product_specs.update(extract_table_data(response, "//table[@id='productDetails_detailBullets_sections1']"))
+    # Match all spec tables at once, then read their rows straight from the tree
+    tables = {}
+    for table in evaluate(response, SPEC_TABLES_SELECTOR, query_type='xpath'):
+        extract_table_rows(table, tables.setdefault(table.get('id'), {}))
+
+    product_specs = dict(tables.get('productDetails_detailBullets_sections1', {}))
     if not product_specs:
         product_specs.update(extract_product_details(response))
-    tech_spec_1 = (extract_table_data(response, "//table[@id='productDetails_techSpec_section_1']"))
-    tech_spec_2 = (extract_table_data(response, "//table[@id='productDetails_techSpec_section_2']"))
-    product_specs.update(tech_spec_1)
-    product_specs.update(tech_spec_2)
+    product_specs.update(tables.get('productDetails_techSpec_section_1', {}))
+    product_specs.update(tables.get('productDetails_techSpec_section_2', {}))
 
     return product_specs
 
@@ -282,7 +283,7 @@ def get_stock(response):
 @timeit
 def get_reviews(response, product_reviews):
     reviews_selector = 'div[data-hook="review"]'
-    reviews = response.css(reviews_selector)
+    reviews = evaluate(response, reviews_selector, query_type='css')
 
     # Define variables for each selector
     rating_selectors = ['i[data-hook="review-star-rating"] > span::text']
@@ -291,6 +292,7 @@ def get_reviews(response, product_reviews):
     author_selectors = ['span.a-profile-name::text']
     collapsed_text_selectors = ['div[data-hook="review-collapsed"] > span::text']
 
+    aggregator = ReviewAggregator(product_reviews)
     for review in reviews:
         review_data = {
             'rating': safe_extract(review, rating_selectors, query_type='css', default_value='0'),
@@ -311,14 +313,12 @@ def get_reviews(response, product_reviews):
             logging.error(f"Failed to convert rating '{review_data['rating']}' to float.")
             review_data['rating'] = 0.0
 
-        # Check if the author already exists in the list of reviews to avoid duplicates
-        if not any(existing_review['author'] == review_data['author'] for existing_review in product_reviews):
-            product_reviews.append(review_data)
+        # Skip reviews already in the list (same author and content)
+        aggregator.add(review_data)
 
     return product_reviews
 
 
-@timeit
 def extract_asin_from_url(url):
     # Define the regular expression pattern to match an ASIN in the Amazon product URL
     pattern = r'/dp/([A-Z0-9]{10})'
@@ -402,45 +402,154 @@ class AmazonGetDetailsSpider(scrapy.Spider):
     name = 'amazon_get_details'
 
     @timeit
-    def __init__(self, url=None, job_id=None, *args, **kwargs):
+    def __init__(self, url=None, job_id=None, urls_file=None, urls_queue=None, domain='www.amazon.com',
+                 read_ahead=None, chunk_size=None, chunk_bytes=None, *args, **kwargs):
+        """
+        Scrape the product pages of a JSON list of URLs, or of the URLs read lazily from a file or a queue.
+        By default every product is posted in a single job once the last URL is done. In streaming mode, enabled by
+        chunk_size and/or chunk_bytes, products are posted in chunks as soon as they are parsed, followed by a
+        completion marker, so memory stays bounded whatever the number of URLs.
+        :param url: JSON list of product URLs, requested as given.
+        :param urls_file: Path of a file of product URLs or ASINs, one per line (plain text or JSON lines).
+        :param urls_queue: Path of a SQLite URL queue (default.inputs.UrlQueue), consumed until it is empty. Each URL
+                           is acknowledged once scraped, those still in flight when the crawl stops are released.
+        :param domain: Amazon domain of bare ASINs.
+        :param read_ahead: Maximum requests in flight, only that many URLs are read ahead of the crawl
+                           (default: DETAILS_READ_AHEAD).
+        :param chunk_size: Products per chunk (default: DETAILS_CHUNK_SIZE).
+        :param chunk_bytes: Approximate JSON size of a chunk, in bytes (default: DETAILS_CHUNK_BYTES).
+        """
         super(AmazonGetDetailsSpider, self).__init__(*args, **kwargs)
         self.job = {}
-        if not url or not job_id:
+        if not (url or urls_file or urls_queue) or not job_id:
             logging.error("URL and Job ID are required")
             raise ValueError("URL and Job ID are required")
-        url = json.loads(url)
-        if not isinstance(url, list):
-            url = [url]
-        self.start_urls = url  # This should be the URL you intend to scrape
+        if url:
+            url = json.loads(url)
+            if not isinstance(url, list):
+                url = [url]
+        self.start_urls = url or []  # This should be the URL you intend to scrape
+        self.urls_file = urls_file
+        self.urls_queue = urls_queue
+        self.queue = None
+        self.queue_lease = 3600
+        self.domain = domain
         self.job_id = job_id
         self.default_reviews = []
-        self.requests_completed = 0
-        self.requests_needed = len(self.start_urls)
+        # Normalized URLs still to request, read lazily from the input by start_requests
+        self.urls = None
+        self.urls_exhausted = False
+        self.read_ahead = int(read_ahead) if read_ahead else 128
+        self.in_flight = 0
+        # Products not posted yet: every product, or those of the current chunk in streaming mode
         self.products = []
-        username = os.getenv("BRIGHT_DATA_USERNAME")
-        password = os.getenv("BRIGHT_DATA_PASSWORD")
-        host = os.getenv("BRIGHT_DATA_HOST")
-        if not all([username, password, host]):
-            logging.error("Missing proxy configuration")
+        # Errors of the URLs not posted yet, by URL. In streaming mode they go with the chunk, see add_error.
+        self.errors = {}
+        self.chunk_size = int(chunk_size) if chunk_size else 0
+        self.chunk_bytes = int(chunk_bytes) if chunk_bytes else 0
+        self.chunk = {'bytes': 0, 'urls': [], 'errors': {}}
+        self.sequence = 0
+        self.products_posted = 0
+        self.errors_posted = 0
+        self.start_time = datetime.datetime.utcnow().isoformat()
+        self.finished = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(AmazonGetDetailsSpider, cls).from_crawler(crawler, *args, **kwargs)
+        if not kwargs.get('read_ahead'):
+            spider.read_ahead = crawler.settings.getint('DETAILS_READ_AHEAD', 128)
+        spider.queue_lease = crawler.settings.getint('DETAILS_QUEUE_LEASE', 3600)
+        if not kwargs.get('chunk_size'):
+            spider.chunk_size = crawler.settings.getint('DETAILS_CHUNK_SIZE', 0)
+        if not kwargs.get('chunk_bytes'):
+            spider.chunk_bytes = crawler.settings.getint('DETAILS_CHUNK_BYTES', 0)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(spider.request_dropped, signal=signals.request_dropped)
+        return spider
+
+    @property
+    def streaming(self):
+        return bool(self.chunk_size or self.chunk_bytes)
+
+    @property
+    def source(self):
+        """The input of the job, as posted in the `url` field of the job."""
+        if self.urls_file:
+            return self.urls_file
+        if self.urls_queue:
+            return self.urls_queue
+        return json.dumps(self.start_urls)
+
+    def iter_urls(self):
+        """
+        Yield the URLs of the input, reading it as the crawl goes, with the queue entry each one was read from.
+        URLs and ASINs read from a file or a queue are normalized, those of the JSON list are requested as given,
+        with their variant query and whatever link form they use.
+        """
+        if self.urls_queue:
+            # Claim no more than the requests kept in flight, the rest of the queue stays free for other crawls
+            self.queue = UrlQueue(self.urls_queue, lease=self.queue_lease, batch=self.read_ahead)
+        if self.urls_file or self.queue is not None:
+            values = read_urls_file(self.urls_file) if self.urls_file else self.queue
+            for value in values:
+                url = normalize_product_url(value, self.domain)
+                if url is None:
+                    self.add_error(value, 'invalid url')
+                    if self.queue is not None:
+                        self.queue.ack(value)
+                    continue
+                if self.queue is not None:
+                    yield url, value
+                else:
+                    yield url, None
             return
-        session_id = randint(0, 1000000)
-        proxy_user_pass = f"{username}-session-{session_id}:{password}"
-        proxy_url = f"http://{proxy_user_pass}@{host}:22225"
-        self.proxy = proxy_url
+        for url in self.start_urls:
+            if not isinstance(url, str) or urlsplit(url.strip()).scheme not in ('http', 'https'):
+                self.add_error(str(url), 'invalid url')
+                continue
+            yield url.strip(), None
 
     @timeit
     def start_requests(self):
-        for url in self.start_urls:
-            yield scrapy.Request(url, callback=self.parse, meta={'proxy': self.proxy})
-
+        self.urls = self.iter_urls()
+        yield from self.next_requests()
+
+    def next_requests(self):
+        """Yield requests for the next URLs of the input, keeping at most read_ahead requests in flight."""
+        while not self.urls_exhausted and self.in_flight < self.read_ahead:
+            url, queue_url = next(self.urls, (None, None))
+            if url is None:
+                self.urls_exhausted = True
+                break
+            self.in_flight += 1
+            meta = {'page_type': 'product'}
+            if queue_url is not None:
+                meta['queue_url'] = queue_url
+            yield scrapy.Request(url, callback=self.parse, errback=self.page_failed, meta=meta)
+
+    def closed(self, reason):
+        if self.queue is not None:
+            # URLs claimed by this crawl but not scraped, requested or still in the claimed batch, go back to the
+            # queue for the next one
+            self.queue.release_claimed()
+            self.queue.close()
+            self.queue = None
 
     @timeit
-    def close_job(self, response):
-        # Logic to handle the response and close the job
-        self.close(self, reason="Job completed successfully")
+    def close_job(self, job):
+        # Logic to handle the response and close the job. Chunks are acknowledged one by one, the crawl is over
+        # once the job (or the completion marker in streaming mode) is.
+        if job.get('status') == 'completed':
+            self.crawler.engine.close_spider(self, reason="Job completed successfully")
 
     @timeit
     def parse(self, response: scrapy.http.Response):
+        if 'blocked' in response.flags:
+            # Still a robot-check page after the retries, there is nothing to parse
+            self.add_error(response.url, 'blocked')
+            yield from self.page_done(response.request)
+            return
         selector = response.selector
         product = {
             "product_id": extract_asin_from_url(response.url),
@@ -462,17 +571,128 @@ class AmazonGetDetailsSpider(scrapy.Spider):
         product['price'], product['discount_percentage'] = get_price(response)
         product['reviews'] = get_reviews(response, [])
         self.products.append(product)
-        self.requests_completed += 1
-        if self.requests_completed == self.requests_needed:
+        if self.streaming:
+            self.chunk['urls'].append(response.url)
+            if self.chunk_bytes:
+                self.chunk['bytes'] += len(json.dumps(product))
+        yield from self.page_done(response.request)
+
+    def page_failed(self, failure):
+        """Count a URL that could not be downloaded as done, so it does not hold up the job."""
+        self.add_error(failure.request.url, failure.type.__name__)
+        yield from self.page_done(failure.request)
+
+    def add_error(self, url, error):
+        if not self.streaming:
+            self.errors[url] = error
+            return
+        # Sent with the current chunk and forgotten, so memory stays bounded however many URLs fail
+        self.chunk['errors'][url] = error
+        if self.chunk_bytes:
+            self.chunk['bytes'] += len(url) + len(error)
+
+    def page_done(self, request):
+        self.in_flight -= 1
+        queue_url = request.meta.get('queue_url')
+        if queue_url is not None:
+            self.queue.ack(queue_url)
+        if self.streaming and (self.products or self.chunk['errors']) and (
+                (self.chunk_size and len(self.products) + len(self.chunk['errors']) >= self.chunk_size) or
+                (self.chunk_bytes and self.chunk['bytes'] >= self.chunk_bytes)):
+            yield self.flush_chunk()
+        # Each URL done makes room for the next one of the input
+        yield from self.next_requests()
+        if self.urls_exhausted and self.in_flight <= 0:
+            yield from self.finish()
+
+    def flush_chunk(self):
+        """Build the job of the products parsed since the previous chunk."""
+        self.sequence += 1
+        self.products_posted += len(self.products)
+        self.errors_posted += len(self.chunk['errors'])
+        job = {
+            "job_id": self.job_id,
+            "status": "in_progress",
+            "sequence": self.sequence,
+            "start_time": self.start_time,
+            "end_time": datetime.datetime.utcnow().isoformat(),
+            "result": self.products,
+            "url": json.dumps(self.chunk['urls']),
+            "error": self.chunk['errors']
+        }
+        # The chunk is handed over to the pipeline, only the next one is kept in memory
+        self.products = []
+        self.chunk = {'bytes': 0, 'urls': [], 'errors': {}}
+        return job
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        if not self.streaming:
             job = {
                 "job_id": self.job_id,
                 "status": "completed",
                 "end_time": datetime.datetime.utcnow().isoformat(),
                 "result": self.products,
-                "url": json.dumps(self.start_urls),
-                "error": {}
+                "url": self.source,
+                "error": dict(self.errors)
             }
-            data = json.dumps(job, default=datetime_serializer)
-            endpoint = os.getenv("SERVICE_URL")
-            yield scrapy.Request(url=endpoint + "/api/v1/scrapy/update", callback=self.close_job, body=data,
-                                 method='POST')
+            # Delivered to SERVICE_URL by HttpPipeline, which calls close_job once the service acknowledged it
+            yield job
+            return
+        if self.products or self.chunk['errors']:
+            yield self.flush_chunk()
+        # Completion marker. Chunks may be delivered out of order, `chunks` tells the service how many to expect.
+        # The errors were posted with their chunks, only their count is repeated here.
+        yield {
+            "job_id": self.job_id,
+            "status": "completed",
+            "sequence": self.sequence + 1,
+            "chunks": self.sequence,
+            "products": self.products_posted,
+            "errors": self.errors_posted,
+            "start_time": self.start_time,
+            "end_time": datetime.datetime.utcnow().isoformat(),
+            "result": [],
+            "url": self.source,
+            "error": {}
+        }
+
+    def request_dropped(self, request, spider):
+        """
+        Count a product request the scheduler dropped (a duplicate URL) as done: it reaches no callback or errback,
+        and would otherwise hold its place among the requests in flight for the rest of the crawl.
+        """
+        if spider is not self or request.meta.get('page_type') != 'product' or self.finished:
+            return
+        self.in_flight -= 1
+        queue_url = request.meta.get('queue_url')
+        if queue_url is not None:
+            # The same product is requested from another queue entry
+            self.queue.ack(queue_url)
+        # Nothing was parsed, there is no chunk to flush. Once the input is exhausted the job is finished when the
+        # spider goes idle.
+        for next_request in self.next_requests():
+            self.crawler.engine.crawl(next_request)
+
+    def spider_idle(self, spider):
+        # Nothing is in flight once the spider is idle. Go on with the input, or finish the job with what was parsed
+        # rather than closing without posting it.
+        if self.finished:
+            return
+        if self.in_flight:
+            # A request was lost without reaching a callback, errback or the request_dropped signal
+            self.logger.warning("%d requests lost in flight", self.in_flight)
+            self.crawler.stats.inc_value('details/lost_requests', self.in_flight)
+            self.in_flight = 0
+        requests = list(self.next_requests())
+        if not requests:
+            requests = [scrapy.Request('data:,', callback=self.finish_remaining, dont_filter=True,
+                                       meta={'dont_cache': True, 'dont_detect_blocks': True})]
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        raise DontCloseSpider
+
+    def finish_remaining(self, response):
+        yield from self.finish()
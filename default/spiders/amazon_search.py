@@ -1,35 +1,14 @@
 import datetime
-import functools
 import json
 import logging
-import os
+import math
 import re
-import time
-from random import randint
 import scrapy
-from scrapy import Spider
-
-
-# os.environ['ENABLE_TIMING'] = 'true'
-def timeit(method):
-    """Decorator to measure the execution time of a method."""
-
-    @functools.wraps(method)
-    def wrapper(*args, **kwargs):
-        if os.getenv('ENABLE_TIMING', 'false').lower() == 'true':
-            start_time = time.time()
-            result = method(*args, **kwargs)
-            end_time = time.time()
-            duration = end_time - start_time
-            if isinstance(args[0], Spider):
-                args[0].logger.info(f"{method.__name__} took {duration:.4f} seconds")
-            else:
-                print(f"{method.__name__} took {duration:.4f} seconds")
-        else:
-            result = method(*args, **kwargs)
-        return result
+from lxml import etree
+from w3lib.url import add_or_replace_parameter
 
-    return wrapper
+from default.metrics import timeit
+from default.selectors import evaluate, get_roots, node_to_text
 
 
 def clean_text(text):
@@ -50,30 +29,24 @@ def safe_extract(response_or_selector, queries, query_type='css', extract_first=
     """
     Safely extract data from a given set of queries on a response or selector.
     Tries each query until successful extraction.
-    :param response_or_selector: Scrapy Response or Selector object.
-    :param queries: List of strings representing the CSS or XPath queries.
+    :param response_or_selector: Scrapy Response, Selector object or lxml element.
+    :param queries: List of strings representing the CSS or XPath queries, compiled once through default.selectors.
     :param query_type: 'css' for CSS queries, 'xpath' for XPath queries. Assumes all queries are of the same type.
     :param extract_first: True to extract the first result, False to extract all results from the first successful query.
     :param default_value: Default value to return if no data is found. Can be of any type.
     :return: Extracted data from the first successful query or default value.
     """
+    roots = get_roots(response_or_selector)
     for query in queries:
-        if query_type == 'css':
-            data = response_or_selector.css(query)
-        elif query_type == 'xpath':
-            data = response_or_selector.xpath(query)
-        else:
-            raise ValueError("Invalid query_type. Use 'css' or 'xpath'.")
+        data = evaluate(roots, query, query_type)
 
         if data:
             if extract_first:
-                extracted = data.get()
+                extracted = node_to_text(data[0])
                 if extracted is not None:
                     return clean_text(extracted)
             else:
-                all_data = data.getall()
-                if all_data:
-                    return [clean_text(element) for element in all_data]
+                return [clean_text(node_to_text(element)) for element in data]
 
     # Return default value if none of the queries return data
     if not extract_first and isinstance(default_value, list):
@@ -81,49 +54,141 @@ def safe_extract(response_or_selector, queries, query_type='css', extract_first=
     return [default_value] if not extract_first else default_value
 
 
-def extract_price(response):
-    price_selector = ".a-price-whole::text"
-    price = safe_extract(response, [price_selector], extract_first=True, default_value='0')
-    try:
-        price = price.replace(',', '').replace('$', '')
-        price = float(price)
-    except ValueError:
-        price = 0
-    return price
-
-
-def extract_title(response):
-    title_selector = ['.a-size-medium.a-color-base.a-text-normal::text', 'div[data-cy="title-recipe"] span.a-text-normal::text']
-    title = safe_extract(response, title_selector, extract_first=True)
-    return title
+def own_text(element):
+    """Return the first text node directly under element, like the CSS query `element::text`."""
+    if element.text is not None:
+        return element.text
+    for child in element:
+        if child.tail is not None:
+            return child.tail
+    return None
 
 
-def extract_rating(response):
-    rating_selector = ".a-icon-alt::text"
-    rating = safe_extract(response, [rating_selector], extract_first=True, default_value='0')
-    try:
-        rating = float(rating.split(' ')[0])
-    except ValueError:
-        rating = 0
-    return rating
+def has_classes(element, classes):
+    tokens = (element.get('class') or '').split()
+    return all(name in tokens for name in classes)
 
 
-def extract_image_url(response):
-    image_selector = ".s-image::attr(src)"
-    image_url = safe_extract(response, [image_selector], extract_first=True)
-    return image_url
+def inside(element, card, matches):
+    """Whether an ancestor of element, up to and including the card, satisfies matches."""
+    if element is card:
+        return False
+    for ancestor in element.iterancestors():
+        if matches(ancestor):
+            return True
+        if ancestor is card:
+            return False
+    return False
 
 
-def extract_brand(response):
-    brand_selector = ".a-row.a-color-secondary h2 .a-size-medium::text"
-    brand = safe_extract(response, [brand_selector], extract_first=True)
-    return brand
-
-
-def extract_stock(response):
-    stock_selector = ".a-size-base.a-color-price::text"
-    stock = safe_extract(response, [stock_selector], extract_first=True)
-    return stock
+class CardIndex(object):
+    """
+    Elements of a search result card by class name, built in one pass over the card.
+    The card fields are read from it instead of evaluating one CSS query per field and card, which walked the card
+    once per query and made the cost of a page grow with its number of cards times its number of fields.
+    """
+    classes = {'s-image', 'a-size-medium', 'a-color-base', 'a-text-normal', 'a-price-whole', 'a-icon-alt',
+               'a-row', 'a-color-secondary', 'a-size-base', 'a-color-price', 'a-link-normal', 's-coupon-clipped',
+               's-coupon-unclipped'}
+
+    def __init__(self, card):
+        self.card = card
+        self.by_class = {}
+        for element in card.iter(etree.Element):
+            names = element.get('class')
+            if names:
+                for name in names.split():
+                    if name in self.classes:
+                        self.by_class.setdefault(name, []).append(element)
+
+    def select(self, *classes, tag=None):
+        """Elements with every one of the classes (and the tag), in document order, like `tag.class1.class2`."""
+        for element in self.by_class.get(classes[0], ()):
+            if (tag is None or element.tag == tag) and has_classes(element, classes[1:]):
+                yield element
+
+    def text(self, elements):
+        """First text of the elements, like `query::text` with safe_extract."""
+        for element in elements:
+            text = own_text(element)
+            if text is not None:
+                return clean_text(text)
+        return None
+
+    def attribute(self, elements, name):
+        """First value of an attribute of the elements, like `query::attr(name)` with safe_extract."""
+        for element in elements:
+            value = element.get(name)
+            if value is not None:
+                return clean_text(value)
+        return None
+
+
+def parse_numbers(texts, clean):
+    """Convert a column of texts to floats, with 0 for the ones that are not numbers."""
+    numbers = []
+    for text in texts:
+        try:
+            numbers.append(float(clean(text)))
+        except ValueError:
+            numbers.append(0)
+    return numbers
+
+
+def extract_prices(indexes):
+    # .a-price-whole::text
+    prices = [index.text(index.select('a-price-whole')) or '0' for index in indexes]
+    return parse_numbers(prices, lambda price: price.replace(',', '').replace('$', ''))
+
+
+def is_title_recipe(element):
+    return element.tag == 'div' and element.get('data-cy') == 'title-recipe'
+
+
+def extract_titles(indexes):
+    titles = []
+    for index in indexes:
+        # .a-size-medium.a-color-base.a-text-normal::text
+        title = index.text(index.select('a-size-medium', 'a-color-base', 'a-text-normal'))
+        if title is None:
+            # div[data-cy="title-recipe"] span.a-text-normal::text
+            title = index.text(span for span in index.select('a-text-normal', tag='span')
+                               if inside(span, index.card, is_title_recipe))
+        titles.append(title)
+    return titles
+
+
+def extract_ratings(indexes):
+    # .a-icon-alt::text
+    ratings = [index.text(index.select('a-icon-alt')) or '0' for index in indexes]
+    return parse_numbers(ratings, lambda rating: rating.split(' ')[0])
+
+
+def extract_image_urls(indexes):
+    # .s-image::attr(src)
+    return [index.attribute(index.select('s-image'), 'src') for index in indexes]
+
+
+def extract_brands(indexes):
+    brands = []
+    for index in indexes:
+        # .a-row.a-color-secondary h2 .a-size-medium::text
+        card = index.card
+
+        def is_row(element):
+            return has_classes(element, ('a-row', 'a-color-secondary'))
+
+        def is_heading(element):
+            return element.tag == 'h2' and inside(element, card, is_row)
+
+        brands.append(index.text(element for element in index.select('a-size-medium')
+                                 if inside(element, card, is_heading)))
+    return brands
+
+
+def extract_stocks(indexes):
+    # .a-size-base.a-color-price::text
+    return [index.text(index.select('a-size-base', 'a-color-price')) for index in indexes]
 
 
 def extract_asin_from_url(url):
@@ -131,59 +196,81 @@ def extract_asin_from_url(url):
     return asin.group(1) if asin else None
 
 
-def extract_asin_from_response(response):
-    product_link_selector = "a.a-link-normal::attr(href)"
-    product_link = safe_extract(response, [product_link_selector], extract_first=True, default_value='')
-    return extract_asin_from_url(product_link)
-
-def extract_discount(response):
+def extract_asins(indexes):
+    """
+    Read the ASIN of every card from the data-asin attribute of its result item, or failing that from its first
+    product link.
+    """
+    asins = []
+    for index in indexes:
+        card = index.card
+        asin = card.get('data-asin')
+        if not asin:
+            asin = next((ancestor.get('data-asin') for ancestor in card.iterancestors()
+                         if ancestor.get('data-asin') is not None), None)
+        if not asin:
+            # a.a-link-normal::attr(href)
+            asin = extract_asin_from_url(index.attribute(index.select('a-link-normal', tag='a'), 'href') or '')
+        asins.append(asin)
+    return asins
+
+
+def extract_discounts(indexes):
     # Extract discount information, if available. This will look for any visible discount percentage or coupon application.
-    discount = safe_extract(response, [
-        'span.s-coupon-clipped::text',  # Extracting if coupon already applied
-        'span.s-coupon-unclipped::text',
-        's-coupon-clipped aok-hidden'# Extracting if coupon is available to be applied
-    ], extract_first=True)
-    if not discount:
-        discount = "No discount information"  # Default text if no discount is found
-    return discount
-
-
-def parse_products(response):
-    max_products = 15
+    discounts = []
+    for index in indexes:
+        # span.s-coupon-clipped::text if coupon already applied, else span.s-coupon-unclipped::text
+        discount = index.text(index.select('s-coupon-clipped', tag='span'))
+        if discount is None:
+            discount = index.text(index.select('s-coupon-unclipped', tag='span'))
+        # Default text if no discount is found
+        discounts.append(discount or "No discount information")
+    return discounts
+
+
+def parse_products(response, max_products=15):
     products_selector = "div.puis-card-container > div.a-section > div.puisg-row"
     products_selector2 = "div.puis-card-container > div.a-section"
-    product_cards = response.css(products_selector)
+    product_cards = evaluate(response, products_selector, query_type='css')
     if not product_cards:
-        product_cards = response.css(products_selector2)
-    product_data = {
-        "image_url": '',
-        "title": '',
-        "price": '',
-        "rating": '',
-        'brand': '',
-        'stock': '',
-        'discount': ''
-    }
+        product_cards = evaluate(response, products_selector2, query_type='css')
+    if max_products is not None:
+        product_cards = product_cards[:max_products]
+    indexes = [CardIndex(card) for card in product_cards]
+    # One column per field, zipped into one row per card
+    columns = zip(extract_asins(indexes), extract_image_urls(indexes), extract_titles(indexes),
+                  extract_prices(indexes), extract_ratings(indexes), extract_brands(indexes), extract_stocks(indexes),
+                  extract_discounts(indexes))
     products = []
-    count = 0
-    for product in product_cards:
-        count += 1
-        if count > max_products:
-            break
-        product_data['product_id'] = extract_asin_from_response(product)
-        product_data['image_url'] = extract_image_url(product)
-        product_data['title'] = extract_title(product)
-        product_data['price'] = extract_price(product)
-        product_data['rating'] = extract_rating(product)
-        product_data['brand'] = extract_brand(product)
-        product_data['stock'] = extract_stock(product)
-        product_data['discount'] = extract_discount(product)
-        products.append(product_data)
-        product_data = {}
+    for product_id, image_url, title, price, rating, brand, stock, discount in columns:
+        products.append({
+            'product_id': product_id,
+            'image_url': image_url,
+            'title': title,
+            'price': price,
+            'rating': rating,
+            'brand': brand,
+            'stock': stock,
+            'discount': discount,
+        })
     return products
 
 
-@timeit
+# "1-48 of 122 results for", or "1-16 of over 1,000 results for" when Amazon only gives a lower bound
+RESULT_COUNT_RE = re.compile(r'of\s+(over\s+)?([\d,.]+)\s+results')
+
+
+def parse_result_count(response):
+    """
+    Return the number of results a search page reports, or None when it reports none or only a lower bound.
+    """
+    for text in evaluate(response, '//span[contains(text(), " results")]/text()', query_type='xpath'):
+        match = RESULT_COUNT_RE.search(text)
+        if match is not None:
+            return None if match.group(1) else int(re.sub(r'[,.]', '', match.group(2)))
+    return None
+
+
 def datetime_serializer(obj):
     """JSON serializer for objects not serializable by default json code."""
     if isinstance(obj, datetime.datetime):
@@ -195,7 +282,12 @@ class AmazonSearchSpider(scrapy.Spider):
     name = 'amazon_search'
 
     @timeit
-    def __init__(self, url=None, job_id=None, *args, **kwargs):
+    def __init__(self, url=None, job_id=None, max_results=None, *args, **kwargs):
+        """
+        Scrape the results of a search.
+        :param max_results: Number of distinct products to return (default: SEARCH_MAX_RESULTS). Once page 1 shows
+                            how many results a page holds, the pages needed to reach it are fetched concurrently.
+        """
         super(AmazonSearchSpider, self).__init__(*args, **kwargs)
         self.job = {}
         if not url or not job_id:
@@ -204,41 +296,138 @@ class AmazonSearchSpider(scrapy.Spider):
         self.start_urls = [url]  # This should be the URL you intend to scrape
         self.job_id = job_id
         self.products = []
-        username = os.getenv("BRIGHT_DATA_USERNAME")
-        password = os.getenv("BRIGHT_DATA_PASSWORD")
-        host = os.getenv("BRIGHT_DATA_HOST")
-        if not all([username, password, host]):
-            logging.error("Missing proxy configuration")
-            return
-        session_id = randint(0, 1000000)
-        proxy_user_pass = f"{username}-session-{session_id}:{password}"
-        proxy_url = f"http://{proxy_user_pass}@{host}:22225"
-        self.proxy = proxy_url
+        self.max_results = int(max_results) if max_results else 15
+        self.max_pages = 20
+        # Products of every results page received so far, by page number
+        self.pages = {}
+        self.scheduled = 1
+        self.per_page = None
+        # Number of results page 1 reports, when it gives an exact one
+        self.result_count = None
+        self.errors = {}
+        self.start_time = datetime.datetime.now().isoformat()
+        self.job_posted = False
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(AmazonSearchSpider, cls).from_crawler(crawler, *args, **kwargs)
+        if not kwargs.get('max_results'):
+            spider.max_results = crawler.settings.getint('SEARCH_MAX_RESULTS', 15)
+        spider.max_pages = crawler.settings.getint('SEARCH_MAX_PAGES', 20)
+        return spider
 
     @timeit
     def start_requests(self):
         for url in self.start_urls:
-            yield scrapy.Request(url, callback=self.parse, meta={'proxy': self.proxy})
+            yield scrapy.Request(url, callback=self.parse, errback=self.page_failed,
+                                 meta={'page_type': 'search', 'search_page': 1})
+
+    def page_request(self, page_number):
+        url = add_or_replace_parameter(self.start_urls[0], 'page', str(page_number))
+        return scrapy.Request(url, callback=self.parse, errback=self.page_failed,
+                              meta={'page_type': 'search', 'search_page': page_number})
 
     @timeit
-    def close_job(self, response):
+    def close_job(self, job):
         # Logic to handle the response and close the job
-        self.close(self, reason="Job completed successfully")
+        self.crawler.engine.close_spider(self, reason="Job completed successfully")
 
     def parse(self, response):
-        selector = response.selector
-        products = parse_products(selector)
+        if self.job_posted:
+            # A trailing page, the results were complete without it
+            return
+        page_number = response.meta.get('search_page', 1)
+        if 'blocked' in response.flags:
+            # Still a robot-check page after the retries, there is nothing to parse. The results end before it.
+            self.errors[self.page_key(page_number)] = 'blocked'
+            yield from self.page_received(page_number, [])
+            return
+        if page_number == 1:
+            self.result_count = parse_result_count(response.selector)
+        yield from self.page_received(page_number, parse_products(response.selector, max_products=None))
 
+    def page_failed(self, failure):
+        """Count a page that could not be downloaded as an empty one, the results end before it."""
+        if self.job_posted:
+            return
+        page_number = failure.request.meta.get('search_page', 1)
+        self.errors[self.page_key(page_number)] = failure.type.__name__
+        yield from self.page_received(page_number, [])
+
+    @staticmethod
+    def page_key(page_number):
+        return 'search' if page_number == 1 else f'search_page_{page_number}'
+
+    def page_received(self, page_number, products):
+        """Add the products of a results page, then request the pages still needed or post the job."""
+        self.pages[page_number] = products
+        if page_number == 1 and products:
+            self.per_page = len(products)
+            yield from self.schedule_pages(self.max_results - len(products))
+
+        results, state = self.collect()
+        if state == 'exhausted' and self.scheduled < self.page_limit():
+            # Duplicates across pages left the results short, fetch the pages still missing
+            yield from self.schedule_pages(self.max_results - len(results))
+        elif state != 'waiting':
+            yield self.post_job(results)
+
+    def page_limit(self):
+        """Return the number of pages worth requesting: SEARCH_MAX_PAGES, or fewer when they hold every result."""
+        if self.result_count is None:
+            return self.max_pages
+        return min(self.max_pages, math.ceil(self.result_count / self.per_page))
+
+    def schedule_pages(self, missing):
+        """Request, all at once, the pages expected to hold `missing` more results."""
+        page_count = max(min(math.ceil(missing / self.per_page), self.page_limit() - self.scheduled), 0)
+        for page_number in range(self.scheduled + 1, self.scheduled + page_count + 1):
+            yield self.page_request(page_number)
+        self.scheduled += page_count
+
+    def collect(self):
+        """
+        Take distinct products from the pages received so far, in page order, up to max_results.
+        :return: Tuple of the results and their state: 'complete' when max_results was reached or a page came back
+                 empty or only repeated products already seen (the end of the results: past its last page, Amazon
+                 serves the last one again), 'waiting' when an earlier page is still missing, 'exhausted' when every
+                 scheduled page is in but they hold fewer than max_results products.
+        """
+        results = []
+        seen = set()
+        page_number = 1
+        while page_number in self.pages:
+            products = self.pages[page_number]
+            if not products:
+                return results, 'complete'
+            found = len(results)
+            for product in products:
+                # Cards without an ASIN (e.g. sponsored ones) are told apart by title
+                key = product.get('product_id') or product.get('title')
+                if key in seen:
+                    continue
+                seen.add(key)
+                results.append(product)
+                if len(results) >= self.max_results:
+                    return results, 'complete'
+            if len(results) == found:
+                return results, 'complete'
+            page_number += 1
+        if page_number <= self.scheduled:
+            return results, 'waiting'
+        return results, 'exhausted'
+
+    def post_job(self, results):
+        self.job_posted = True
+        self.products = results
         job = {
             'job_id': self.job_id,
             'status': 'completed',
-            "start_time": datetime.datetime.now().isoformat(),
+            "start_time": self.start_time,
             "end_time": datetime.datetime.now().isoformat(),
-            'result': products,
-            'url': response.url,
-            'error': {}
+            'result': results,
+            'url': self.start_urls[0],
+            'error': dict(self.errors)
         }
-        data = json.dumps(job, default=datetime_serializer)
-        endpoint = os.getenv("SERVICE_URL")
-        yield scrapy.Request(url=endpoint + "/api/v1/scrapy/update", callback=self.close_job, body=data,
-                             method='POST')
+        # Delivered to SERVICE_URL by HttpPipeline, which calls close_job once the service acknowledged it
+        return job
@@ -0,0 +1,39 @@
+# SQLite helpers shared by the components that keep local state on disk.
+import contextlib
+import os
+import sqlite3
+
+
+def connect(path):
+    """
+    Open a SQLite database in autocommit mode, creating its directory if needed.
+    WAL journaling lets other processes read (and enqueue) while the crawl writes.
+    :param path: Path of the database file, or ':memory:'.
+    :return: A sqlite3 connection whose rows can be read by column name.
+    """
+    directory = os.path.dirname(path)
+    if directory and path != ':memory:':
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+@contextlib.contextmanager
+def transaction(connection, mode=''):
+    """
+    Run the statements of a with block in one transaction, rolled back if the block raises.
+    Connections opened by connect are in autocommit mode, so a transaction left open by an error would make every
+    later BEGIN on the connection fail.
+    :param connection: Connection returned by connect.
+    :param mode: '', 'IMMEDIATE' or 'EXCLUSIVE'.
+    """
+    connection.execute(f'BEGIN {mode}'.strip())
+    try:
+        yield connection
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    connection.execute('COMMIT')
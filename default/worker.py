@@ -0,0 +1,265 @@
+# Long-lived crawl worker.
+#
+# Run with `python -m default.worker`. Scrapy, Twisted and the reactor are started
+# once per container instead of once per job: jobs are queued in a local SQLite
+# database and run through CrawlerRunner, up to WORKER_CONCURRENT_JOBS at a time,
+# in this same process.
+#
+# Jobs are scheduled over HTTP with the same endpoints scrapyd exposes, so
+# existing clients keep working:
+#   POST /schedule.json     spider=<name>, optional jobid and setting=K=V, the
+#                           other parameters are passed to the spider
+#   GET  /listjobs.json     pending, running and last finished jobs
+#   GET  /daemonstatus.json job counts
+# Other processes can also enqueue straight into the database with JobQueue.put.
+import json
+import logging
+import socket
+import time
+import uuid
+
+from scrapy.crawler import Crawler, CrawlerRunner
+from scrapy.utils.log import configure_logging
+from scrapy.utils.project import get_project_settings
+from scrapy.utils.reactor import install_reactor
+from twisted.web import resource
+
+from default.storage import connect, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue(object):
+    """
+    Jobs waiting for, or being run by, a worker. A database file is meant to be consumed by a single worker.
+    """
+
+    def __init__(self, path):
+        self.db = connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY,'
+            ' spider TEXT NOT NULL,'
+            ' args TEXT NOT NULL,'
+            ' settings TEXT NOT NULL,'
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            ' enqueued_at REAL NOT NULL,'
+            ' started_at REAL,'
+            ' finished_at REAL,'
+            ' error TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, enqueued_at)')
+
+    def put(self, spider, args=None, settings=None, job_id=None):
+        """
+        Queue a crawl.
+        :param spider: Name of the spider to run.
+        :param args: Spider arguments.
+        :param settings: Settings overriding the project settings for this crawl only.
+        :param job_id: Id of the job, generated when not given.
+        :return: The job id.
+        """
+        job_id = job_id or uuid.uuid4().hex
+        self.db.execute('INSERT INTO jobs (id, spider, args, settings, enqueued_at) VALUES (?, ?, ?, ?, ?)',
+                        (job_id, spider, json.dumps(args or {}), json.dumps(settings or {}), time.time()))
+        return job_id
+
+    def claim(self):
+        """Mark the oldest pending job as running and return it, or None when nothing is pending."""
+        with transaction(self.db, 'IMMEDIATE'):
+            row = self.db.execute("SELECT * FROM jobs WHERE status = 'pending' ORDER BY enqueued_at LIMIT 1").fetchone()
+            if row is not None:
+                self.db.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE id = ?",
+                                (time.time(), row['id']))
+        if row is None:
+            return None
+        job = dict(row)
+        job['args'] = json.loads(job['args'])
+        job['settings'] = json.loads(job['settings'])
+        return job
+
+    def finish(self, job_id, error=None):
+        status = 'failed' if error else 'finished'
+        self.db.execute('UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?',
+                        (status, time.time(), error, job_id))
+
+    def requeue_running(self):
+        """Put back the jobs a previous worker was running when it stopped. Returns how many there were."""
+        return self.db.execute("UPDATE jobs SET status = 'pending', started_at = NULL WHERE status = 'running'").rowcount
+
+    def counts(self):
+        rows = self.db.execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status')
+        return {row['status']: row['count'] for row in rows}
+
+    def list(self, status, limit=100):
+        order = 'finished_at DESC' if status in ('finished', 'failed') else 'enqueued_at'
+        rows = self.db.execute(f'SELECT * FROM jobs WHERE status = ? ORDER BY {order} LIMIT ?', (status, limit))
+        return [dict(row) for row in rows]
+
+
+class Worker(object):
+    """
+    Runs the queued jobs through a single CrawlerRunner, WORKER_CONCURRENT_JOBS at a time.
+    """
+
+    def __init__(self, settings, queue):
+        self.settings = settings
+        self.queue = queue
+        self.runner = CrawlerRunner(settings)
+        self.max_jobs = settings.getint('WORKER_CONCURRENT_JOBS', 4)
+        self.poll_interval = settings.getfloat('WORKER_POLL_INTERVAL', 1.0)
+        self.running = {}
+        self.poller = None
+
+    def start(self):
+        from twisted.internet import task
+
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logger.info(f"Requeued {requeued} jobs left running by the previous worker")
+        # Polling picks up jobs enqueued by other processes; jobs scheduled over HTTP start right away
+        self.poller = task.LoopingCall(self.poll)
+        self.poller.start(self.poll_interval)
+
+    def stop(self):
+        if self.poller is not None and self.poller.running:
+            self.poller.stop()
+        return self.runner.stop()
+
+    def poll(self):
+        while len(self.running) < self.max_jobs:
+            try:
+                job = self.queue.claim()
+            except Exception:
+                # The poller's LoopingCall stops for good once poll raises, e.g. "database is locked"
+                logger.exception("Could not claim a job, retrying at the next poll")
+                return
+            if job is None:
+                return
+            self.run(job)
+
+    def create_crawler(self, job):
+        spidercls = self.runner.spider_loader.load(job['spider'])
+        settings = self.settings.copy()
+        settings.setdict(job['settings'], priority='cmdline')
+        return Crawler(spidercls, settings)
+
+    def run(self, job):
+        job_id = job['id']
+        try:
+            crawler = self.create_crawler(job)
+            # _job is the argument scrapyd passes to the spiders it runs
+            deferred = self.runner.crawl(crawler, _job=job_id, **job['args'])
+        except Exception as e:
+            logger.exception(f"Could not start job {job_id}")
+            self.queue.finish(job_id, error=repr(e))
+            return
+        self.running[job_id] = crawler
+        logger.info(f"Started job {job_id} ({job['spider']}), {len(self.running)} running")
+        deferred.addCallbacks(self.job_finished, self.job_failed, callbackArgs=(job_id,), errbackArgs=(job_id,))
+
+    def job_finished(self, _, job_id):
+        self.running.pop(job_id, None)
+        self.queue.finish(job_id)
+        logger.info(f"Finished job {job_id}")
+        self.poll()
+
+    def job_failed(self, failure, job_id):
+        self.running.pop(job_id, None)
+        self.queue.finish(job_id, error=failure.getErrorMessage() or repr(failure.value))
+        logger.error(f"Job {job_id} failed", exc_info=(failure.type, failure.value, failure.getTracebackObject()))
+        self.poll()
+
+
+class JsonResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, worker):
+        super(JsonResource, self).__init__()
+        self.worker = worker
+
+    def render(self, request):
+        request.setHeader(b'Content-Type', b'application/json')
+        try:
+            data = super(JsonResource, self).render(request)
+        except ValueError as e:
+            request.setResponseCode(400)
+            data = {'status': 'error', 'message': str(e)}
+        data.setdefault('node_name', socket.gethostname())
+        return json.dumps(data).encode('utf-8') + b'\n'
+
+
+class ScheduleResource(JsonResource):
+
+    def render_POST(self, request):
+        args = {key.decode('utf-8'): [value.decode('utf-8') for value in values]
+                for key, values in request.args.items()}
+        args.pop('project', None)
+        spider = args.pop('spider', [None])[0]
+        if not spider:
+            raise ValueError("'spider' is required")
+        if spider not in self.worker.runner.spider_loader.list():
+            raise ValueError(f"Unknown spider: {spider}")
+        settings = dict(setting.split('=', 1) for setting in args.pop('setting', []))
+        job_id = args.pop('jobid', [None])[0]
+        spider_args = {key: values[0] for key, values in args.items()}
+        job_id = self.worker.queue.put(spider, spider_args, settings, job_id=job_id)
+        self.worker.poll()
+        return {'status': 'ok', 'jobid': job_id}
+
+
+class ListJobsResource(JsonResource):
+
+    def render_GET(self, request):
+        def describe(job):
+            return {'id': job['id'], 'spider': job['spider'], 'start_time': job['started_at'],
+                    'end_time': job['finished_at'], 'error': job['error']}
+
+        queue = self.worker.queue
+        finished = queue.list('finished') + queue.list('failed')
+        return {
+            'status': 'ok',
+            'pending': [describe(job) for job in queue.list('pending')],
+            'running': [describe(job) for job in queue.list('running')],
+            'finished': [describe(job) for job in sorted(finished, key=lambda job: job['finished_at'], reverse=True)],
+        }
+
+
+class DaemonStatusResource(JsonResource):
+
+    def render_GET(self, request):
+        counts = self.worker.queue.counts()
+        return {
+            'status': 'ok',
+            'pending': counts.get('pending', 0),
+            'running': counts.get('running', 0),
+            'finished': counts.get('finished', 0) + counts.get('failed', 0),
+        }
+
+
+def create_site(worker):
+    from twisted.web import server
+
+    root = resource.Resource()
+    root.putChild(b'schedule.json', ScheduleResource(worker))
+    root.putChild(b'listjobs.json', ListJobsResource(worker))
+    root.putChild(b'daemonstatus.json', DaemonStatusResource(worker))
+    return server.Site(root)
+
+
+def main():
+    settings = get_project_settings()
+    configure_logging(settings)
+    # The reactor has to be installed before anything imports twisted.internet.reactor
+    install_reactor(settings['TWISTED_REACTOR'])
+    from twisted.internet import reactor
+
+    worker = Worker(settings, JobQueue(settings['WORKER_DB_PATH']))
+    reactor.listenTCP(settings.getint('WORKER_PORT'), create_site(worker), interface=settings['WORKER_BIND_ADDRESS'])
+    reactor.addSystemEventTrigger('before', 'shutdown', worker.stop)
+    reactor.callWhenRunning(worker.start)
+    logger.info(f"Worker listening on {settings['WORKER_BIND_ADDRESS']}:{settings.getint('WORKER_PORT')}")
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
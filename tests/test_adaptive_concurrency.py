@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+from scrapy.http import Request, Response
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from default.extensions import AdaptiveConcurrency
+
+
+def downloaded(extension, status=200, latency=0.5, spider=None):
+    request = Request('https://www.amazon.com/dp/B000000001',
+                      meta={'download_slot': 'www.amazon.com', 'download_latency': latency})
+    extension.response_downloaded(Response(request.url, status=status, request=request), request, spider)
+    return request
+
+
+def test_adaptive_concurrency():
+    """
+    Tests that the window grows additively on healthy responses and shrinks multiplicatively on 503s and blocks.
+    """
+    crawler = get_crawler(Spider)
+    slot = SimpleNamespace(concurrency=4)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={'www.amazon.com': slot}))
+    extension = AdaptiveConcurrency(crawler, start=4, maximum=6, target_latency=2.0, cooldown=0)
+
+    for _ in range(4):
+        downloaded(extension)
+    # One window of healthy responses adds about one
+    assert slot.concurrency == 4
+    for _ in range(5):
+        downloaded(extension)
+    assert slot.concurrency == 5
+    for _ in range(20):
+        downloaded(extension)
+    assert slot.concurrency == 6
+
+    downloaded(extension, status=503)
+    assert slot.concurrency == 3
+    request = downloaded(extension)
+    extension.request_blocked(request, None, None, b'/errors/validateCaptcha')
+    assert slot.concurrency == 1
+    downloaded(extension, latency=3.0)
+    assert slot.concurrency == 1
+
+    stats = crawler.stats
+    assert stats.get_value('adaptive_concurrency/www.amazon.com/window') == 1
+    assert stats.get_value('adaptive_concurrency/www.amazon.com/max_window') == 6
+    assert stats.get_value('adaptive_concurrency/www.amazon.com/decreases/status') == 1
+    assert stats.get_value('adaptive_concurrency/www.amazon.com/decreases/blocked') == 1
+
+    # Within the cooldown, a burst of errors only counts once
+    extension.cooldown = 60
+    state = extension.windows['www.amazon.com']
+    state[0], state[1] = 8.0, 0.0
+    downloaded(extension, status=503)
+    downloaded(extension, status=503)
+    assert slot.concurrency == 4
@@ -2,14 +2,22 @@
 import json
 import os
 import pytest
+from scrapy.exceptions import IgnoreRequest
 from scrapy.http import Response, Request, TextResponse
+from scrapy.utils.test import get_crawler
 import cProfile
 import pstats
+import time
+from types import SimpleNamespace
 
 # Import the spider functions you want to test
 from default.spiders.amazon import get_product_title, extract_table_data, extract_product_details, get_product_specs, \
     get_rating, get_image_url, get_product_description, get_features, get_price, get_reviews, get_number_of_reviews, \
-    get_product_variants, get_similar_products, get_stock
+    get_product_variants, get_similar_products, get_stock, parse_product_page, load_jobs, AmazonSpider
+from default.executor import get_pool, run_parser, shutdown_pool
+from default.productcache import ProductCache
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
 
 
 def mock_response(file_name, url='http://example.com'):
@@ -86,6 +94,20 @@ def test_get_product_specs(html_file):
     print(json.dumps(specs, indent=4))
 
 
+@pytest.mark.parametrize('html_file', get_all_html_files('fixtures/product_pages'))
+def test_get_product_specs_single_pass(html_file):
+    """
+    Tests that the single pass over all spec tables gives the same specs as reading each table on its own.
+    """
+    response = mock_response(html_file)
+    expected = extract_table_data(response, "//table[@id='productDetails_detailBullets_sections1']")
+    if not expected:
+        expected = extract_product_details(response)
+    expected.update(extract_table_data(response, "//table[@id='productDetails_techSpec_section_1']"))
+    expected.update(extract_table_data(response, "//table[@id='productDetails_techSpec_section_2']"))
+    assert get_product_specs(response) == expected
+
+
 @pytest.mark.parametrize('html_file', get_all_html_files('fixtures/product_pages'))
 def test_get_rating(html_file):
     """
@@ -226,4 +248,340 @@ def test_get_stock_status(html_file):
     response = mock_response(html_file)
     stock_status = get_stock(response)
     assert stock_status != '', f"Failed to extract stock status from {html_file}"
-    print(stock_status)
\ No newline at end of file
+    print(stock_status)
+
+@pytest.mark.parametrize('html_file', get_all_html_files(single_file='fixtures/product_pages/test1.html'))
+def test_parse_product_page_in_worker(html_file):
+    """
+    Tests that parsing a product page in a ParseExecutor worker process gives the same result as parsing it inline.
+    """
+    response = mock_response(html_file, url='https://www.amazon.com/dp/B08YKHGKTV')
+    product, default_reviews = parse_product_page(response, '123')
+    try:
+        future = get_pool(1).submit(run_parser, parse_product_page, response.url, response.body, response.encoding,
+                                    '123')
+        worker_product, worker_reviews = future.result(timeout=60)
+    finally:
+        shutdown_pool()
+    for key in ('created_at', 'updated_at'):
+        product.pop(key)
+        worker_product.pop(key)
+    assert worker_product == product
+    assert worker_reviews == default_reviews
+
+
+def test_load_jobs(tmp_path):
+    """
+    Tests that batch jobs are read from JSON pairs, JSON objects and "<url> <job_id>" lines.
+    """
+    jobs_file = tmp_path / 'jobs.txt'
+    jobs_file.write_text('https://www.amazon.com/dp/B000000003 3\n\n{"url": "https://www.amazon.com/dp/B000000004", "job_id": 4}\n')
+    jobs = '[["https://www.amazon.com/dp/B000000001", "1"], {"url": "https://www.amazon.com/dp/B000000002", "job_id": "2"}]'
+    assert load_jobs(jobs, str(jobs_file)) == [('https://www.amazon.com/dp/B000000001', '1'),
+                                               ('https://www.amazon.com/dp/B000000002', '2'),
+                                               ('https://www.amazon.com/dp/B000000003', '3'),
+                                               ('https://www.amazon.com/dp/B000000004', '4')]
+    with pytest.raises(ValueError):
+        load_jobs('[["https://www.amazon.com/dp/B000000001"]]')
+
+
+def test_batch_posts_each_job_when_its_product_is_complete():
+    """
+    Tests that a batch crawl fans out the four pages of every product and emits a job as soon as its own pages are in.
+    """
+    jobs = json.dumps([['https://www.amazon.com/dp/B08YKHGKT1', '1'], ['https://www.amazon.com/dp/B08YKHGKT2', '2'],
+                       ['https://www.amazon.com/dp/B08YKHGKT1', '3']])
+    spider = AmazonSpider(jobs=jobs)
+    requests = list(spider.start_requests())
+    assert len(requests) == 8
+    assert spider.jobs_needed == 3
+
+    pages = {'qa': 'fixtures/qa.html', 'product': 'fixtures/product_pages/test1.html',
+             'reviews': 'fixtures/critical_reviews.html'}
+    posted = []
+    posted_after_page = []
+    for request in sorted(requests, key=lambda request: request.meta['product_key'][1]):
+        file_content = mock_response(pages[request.meta['page_type']]).body
+        response = TextResponse(url=request.url, request=request, body=file_content, encoding='utf-8')
+        posted.extend(request.callback(response) or [])
+        posted_after_page.append(len(posted))
+    assert posted_after_page == [0, 0, 0, 2, 2, 2, 2, 3]
+    assert [job['job_id'] for job in posted] == ['1', '3', '2']
+    assert [job['result'][0]['job_id'] for job in posted] == ['1', '3', '2']
+    assert posted[0]['result'][0]['qa'] and posted[0]['result'][0]['reviews']
+    assert spider.products == {}
+
+
+def test_products_without_asin():
+    """
+    Tests that links without a /dp/ ASIN are scraped as distinct products, from their product page only.
+    """
+    jobs = json.dumps([['https://www.amazon.com/gp/product/B08YKHGKT1', '1'],
+                       ['https://www.amazon.com/gp/product/B08YKHGKT2', '2']])
+    spider = AmazonSpider(jobs=jobs)
+    requests = list(spider.start_requests())
+    assert [request.url for request in requests] == ['https://www.amazon.com/gp/product/B08YKHGKT1',
+                                                     'https://www.amazon.com/gp/product/B08YKHGKT2']
+    body = mock_response('fixtures/product_pages/test1.html').body
+    posted = []
+    for request in requests:
+        posted.extend(request.callback(TextResponse(url=request.url, request=request, body=body, encoding='utf-8')))
+    assert [job['job_id'] for job in posted] == ['1', '2']
+    assert posted[0]['error'] == {'qa': 'no asin', 'critical_reviews': 'no asin', 'positive_reviews': 'no asin'}
+
+
+def crawl_from_fixtures(spider):
+    """Answer every start request of the spider with the fixture of its page type and return the emitted jobs."""
+    pages = {'qa': 'fixtures/qa.html', 'product': 'fixtures/product_pages/test1.html',
+             'reviews': 'fixtures/critical_reviews.html'}
+    requests = list(spider.start_requests())
+    jobs = []
+    for request in requests:
+        page_type = request.meta.get('page_type')
+        body = mock_response(pages[page_type]).body if page_type else b''
+        response = TextResponse(url=request.url, request=request, body=body, encoding='utf-8')
+        jobs.extend(request.callback(response) or [])
+    return requests, jobs
+
+
+def test_product_cache(tmp_path):
+    """
+    Tests that repeat jobs are served from the product cache, and that only the pages of stale field groups are fetched.
+    """
+    settings = {'PRODUCT_CACHE_ENABLED': True, 'PRODUCT_CACHE_PATH': str(tmp_path / 'products.db'),
+                'PRODUCT_CACHE_TTL': {'offer': 900, 'listing': 86400, 'reviews': 21600, 'qa': 604800}}
+
+    def crawl(job_id):
+        crawler = get_crawler(AmazonSpider, settings)
+        spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id=job_id)
+        requests, jobs = crawl_from_fixtures(spider)
+        spider.closed('finished')
+        return [request.meta.get('page_type') for request in requests], jobs, crawler.stats
+
+    page_types, jobs, _ = crawl('1')
+    assert len(page_types) == 4 and len(jobs) == 1
+    fetched = jobs[0]['result'][0]
+
+    page_types, jobs, stats = crawl('2')
+    assert page_types == [None]
+    assert stats.get_value('product_cache/served') == 1
+    assert jobs[0]['job_id'] == '2'
+    assert jobs[0]['result'][0] == dict(fetched, job_id='2')
+
+    ProductCache(settings['PRODUCT_CACHE_PATH'], {}).db.execute(
+        "UPDATE products SET stored_at = 0 WHERE field_group = 'offer'")
+    page_types, jobs, stats = crawl('3')
+    assert page_types == ['product']
+    assert stats.get_value('product_cache/offer/miss') == 1
+    assert stats.get_value('product_cache/qa/hit') == 1
+    cached = jobs[0]['result'][0]
+    assert cached['qa'] == fetched['qa'] and cached['reviews'] == fetched['reviews']
+
+
+def test_product_cache_partial_results(tmp_path):
+    """
+    Tests that with partial results, a core product restored from the product cache is posted before the pages of
+    the stale field groups, which follow as patches.
+    """
+    settings = {'PRODUCT_CACHE_ENABLED': True, 'PRODUCT_CACHE_PATH': str(tmp_path / 'products.db'),
+                'PRODUCT_CACHE_TTL': {'offer': 900, 'listing': 86400, 'reviews': 21600, 'qa': 604800},
+                'PARTIAL_RESULTS_ENABLED': True, 'JOB_DEADLINE': 0}
+    crawler = get_crawler(AmazonSpider, settings)
+    spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id='1')
+    crawl_from_fixtures(spider)
+    spider.closed('finished')
+    ProductCache(settings['PRODUCT_CACHE_PATH'], {}).db.execute(
+        "UPDATE products SET stored_at = 0 WHERE field_group = 'reviews'")
+
+    crawler = get_crawler(AmazonSpider, settings)
+    spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id='2')
+    requests, jobs = crawl_from_fixtures(spider)
+    assert [request.meta.get('page_type') for request in requests] == [None, 'reviews', 'reviews']
+    assert [(job['status'], job['sequence']) for job in jobs] == [('in_progress', 1), ('in_progress', 2),
+                                                                  ('completed', 3)]
+    assert jobs[0]['result'][0]['title'] and jobs[0]['result'][0]['qa']
+    assert jobs[1]['patch']['reviews']
+    spider.closed('finished')
+
+
+def test_product_cache_without_asin(tmp_path):
+    """
+    Tests that a product URL without /dp/<ASIN> is scraped and posted without going through the product cache.
+    """
+    settings = {'PRODUCT_CACHE_ENABLED': True, 'PRODUCT_CACHE_PATH': str(tmp_path / 'products.db'),
+                'PRODUCT_CACHE_TTL': {'offer': 900, 'listing': 86400, 'reviews': 21600, 'qa': 604800}}
+    for job_id in ('1', '2'):
+        crawler = get_crawler(AmazonSpider, settings)
+        spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/gp/product/B08YKHGKT1', job_id=job_id)
+        requests, jobs = crawl_from_fixtures(spider)
+        assert [job['job_id'] for job in jobs] == [job_id]
+        assert 'product' in [request.meta.get('page_type') for request in requests]
+        assert spider.products == {}
+        spider.closed('finished')
+    assert ProductCache(settings['PRODUCT_CACHE_PATH'], {}).db.execute('SELECT COUNT(*) FROM products').fetchone()[0] == 0
+
+
+def test_incremental_reviews(tmp_path):
+    """
+    Tests that review pages sorted by most recent are only read until a known review, and merged with the stored ones.
+    """
+    settings = {'REVIEW_STORE_ENABLED': True, 'REVIEW_STORE_PATH': str(tmp_path / 'reviews.db'),
+                'REVIEW_STORE_MAX_PAGES': 3}
+    reviews_page = mock_response('fixtures/critical_reviews.html').body
+
+    def crawl(job_id):
+        crawler = get_crawler(AmazonSpider, settings)
+        spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id=job_id)
+        requests = [request for request in spider.start_requests()
+                    if 'filterByStar=critical' in request.url]
+        urls = []
+        while requests:
+            request = requests.pop()
+            urls.append(request.url)
+            response = TextResponse(url=request.url, request=request, body=reviews_page, encoding='utf-8')
+            requests.extend(output for output in request.callback(response) if isinstance(output, Request))
+        return urls, spider
+
+    urls, spider = crawl('1')
+    # Nothing stored yet: a single page, sorted by most recent
+    assert len(urls) == 1 and 'sortBy=recent&pageNumber=1' in urls[0]
+    product_job = spider.products[('www.amazon.com', 'B08YKHGKT1')]
+    assert len(product_job.critical_reviews) == 10
+
+    store = spider.review_store
+    key, stream = product_job.key, 'critical_reviews'
+    newest = store.load(key, stream)
+    # The three newest reviews are unknown to the next crawl, which stops at the fourth
+    store.db.execute('DELETE FROM reviews WHERE position > 7')
+    urls, spider = crawl('2')
+    assert len(urls) == 1
+    assert spider.products[key].critical_reviews == newest
+    assert spider.crawler.stats.get_value('review_store/new_reviews') == 3
+
+    # No known review on the page: the next ones are read, up to REVIEW_STORE_MAX_PAGES
+    store.db.execute('UPDATE reviews SET fingerprint = fingerprint || position')
+    urls, spider = crawl('3')
+    assert [url[-1] for url in urls] == ['1', '2', '3']
+    assert len(spider.products[key].critical_reviews) == 20
+
+
+def test_review_pages_fetched_concurrently():
+    """
+    Tests that pages 2..max_review_pages are requested together once page 1 is full, and that the stream ends at the
+    first short page whatever order the pages arrive in.
+    """
+    spider = AmazonSpider(url='https://www.amazon.com/dp/B08YKHGKT1', job_id='1', max_review_pages=4)
+    request = next(request for request in spider.start_requests() if 'filterByStar=critical' in request.url)
+    full_page = mock_response('fixtures/critical_reviews.html').body
+
+    def reply(request, body):
+        response = TextResponse(url=request.url, request=request, body=body, encoding='utf-8')
+        return list(request.callback(response))
+
+    requests = reply(request, full_page)
+    assert [request.meta['review_page'] for request in requests] == [2, 3, 4]
+    # The product is in flight, its later pages go before the products still to start
+    assert all(request.priority == 10 for request in requests)
+    assert requests[0].url.endswith('&pageNumber=2')
+    product_job = spider.products[('www.amazon.com', 'B08YKHGKT1')]
+    assert reply(requests[2], full_page) == []
+    assert reply(requests[1], b'<html><body></body></html>') == []
+    assert 'critical_reviews' in product_job.pending
+    # Page 2 was the last one missing before the short page 3, page 4 is ignored
+    reply(requests[0], full_page.replace(b'class="a-profile-name">', b'class="a-profile-name">Page 2 '))
+    assert 'critical_reviews' not in product_job.pending
+    assert len(product_job.critical_reviews) == 20
+
+
+def test_partial_results():
+    """
+    Tests that the core product is posted as soon as its page is parsed, then patches, and that a failed page does not
+    hold up the job.
+    """
+    crawler = get_crawler(AmazonSpider, {'PARTIAL_RESULTS_ENABLED': True, 'JOB_DEADLINE': 0})
+    spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id='1')
+    requests = {request.meta['product_page']: request for request in spider.start_requests()}
+    pages = {'qa': 'fixtures/qa.html', 'product': 'fixtures/product_pages/test1.html',
+             'critical_reviews': 'fixtures/critical_reviews.html'}
+
+    def reply(page):
+        request = requests[page]
+        body = mock_response(pages[page]).body
+        return list(request.callback(TextResponse(url=request.url, request=request, body=body, encoding='utf-8')))
+
+    # Nothing to patch before the core product is posted
+    assert reply('critical_reviews') == []
+    core, = reply('product')
+    assert core['status'] == 'in_progress' and core['sequence'] == 1
+    assert core['result'][0]['title'] and core['result'][0]['reviews'] and core['result'][0]['qa'] == []
+    assert all('author' not in review for review in core['result'][0]['reviews'])
+    patch, = reply('qa')
+    assert patch['sequence'] == 2 and patch['result'] == [] and patch['patch']['qa']
+
+    failure = Failure(TimeoutError())
+    failure.request = requests['positive_reviews']
+    job, = failure.request.errback(failure)
+    assert job['status'] == 'completed' and job['sequence'] == 3
+    assert job['error'] == {'positive_reviews': 'TimeoutError'}
+    assert crawler.stats.get_value('pages_failed/TimeoutError') == 1
+    # Only the completed job closes it
+    spider.close_job(core)
+    assert spider.jobs_completed == 0
+
+
+def test_deadline():
+    """
+    Tests that a product is posted with a partial status once its deadline has passed, and that late pages are ignored.
+    """
+    crawler = get_crawler(AmazonSpider)
+    spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id='1', deadline='30')
+    requests = {request.meta['product_page']: request for request in spider.start_requests()}
+    product_job = spider.products[('www.amazon.com', 'B08YKHGKT1')]
+    assert requests['product'].meta['download_deadline'] == product_job.deadline
+
+    def reply(request, file_name):
+        body = mock_response(file_name).body
+        return list(request.callback(TextResponse(url=request.url, request=request, body=body, encoding='utf-8')))
+
+    assert reply(requests['product'], 'fixtures/product_pages/test1.html') == []
+    expired = Request('data:,', meta={'product_key': product_job.key})
+    job, = spider.parse_expired(TextResponse(url=expired.url, request=expired, body=b''))
+    assert job['status'] == 'partial' and job['result'][0]['title']
+    assert job['error'] == {'qa': 'deadline', 'critical_reviews': 'deadline', 'positive_reviews': 'deadline'}
+    assert crawler.stats.get_value('jobs/partial') == 1
+    assert spider.products == {}
+    assert reply(requests['qa'], 'fixtures/qa.html') == []
+
+
+def test_page_dropped_at_deadline():
+    """
+    Tests that a page dropped or timed out at the deadline posts the partial job at once, without recording an error.
+    """
+    spider = AmazonSpider.from_crawler(get_crawler(AmazonSpider), url='https://www.amazon.com/dp/B08YKHGKT1',
+                                       job_id='1', deadline='30')
+    requests = {request.meta['product_page']: request for request in spider.start_requests()}
+    spider.products[('www.amazon.com', 'B08YKHGKT1')].deadline = time.monotonic() - 1
+    failure = Failure(IgnoreRequest())
+    failure.request = requests['qa']
+    job, = requests['qa'].errback(failure)
+    assert job['status'] == 'partial'
+    assert set(job['error'].values()) == {'deadline'}
+    assert spider.products == {}
+
+
+def test_close_job_closes_through_engine(tmp_path):
+    """
+    Tests that the last completed job closes the spider through the engine, and that closed() can run again.
+    """
+    settings = {'PRODUCT_CACHE_ENABLED': True, 'PRODUCT_CACHE_PATH': str(tmp_path / 'products.db'),
+                'REVIEW_STORE_ENABLED': True, 'REVIEW_STORE_PATH': str(tmp_path / 'reviews.db')}
+    crawler = get_crawler(AmazonSpider, settings)
+    closes = []
+    crawler.engine = SimpleNamespace(close_spider=lambda spider, reason: closes.append(reason))
+    spider = AmazonSpider.from_crawler(crawler, url='https://www.amazon.com/dp/B08YKHGKT1', job_id='1')
+    spider.close_job({'job_id': '1', 'status': 'completed'})
+    assert closes == ['Job completed successfully']
+    # Once from the engine's spider_closed signal, and again by whatever closes it a second time
+    spider.closed('finished')
+    spider.closed('finished')
+    assert spider.product_cache is None and spider.review_store is None
@@ -9,7 +9,13 @@ import pstats
 # Import the spider functions you want to test
 from default.spiders.amazon_get_details import get_product_title, extract_table_data, extract_product_details, get_product_specs, \
     get_rating, get_image_url, get_product_description, get_features, get_price, get_reviews, get_number_of_reviews, \
-    get_product_variants, get_stock
+    get_product_variants, get_stock, AmazonGetDetailsSpider
+from default.inputs import UrlQueue
+from scrapy import signals
+from scrapy.utils.test import get_crawler
+from types import SimpleNamespace
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
 
 
 def mock_response(file_name, url='http://example.com'):
@@ -213,4 +219,139 @@ def test_get_stock_status(html_file):
     response = mock_response(html_file)
     stock_status = get_stock(response)
     assert stock_status != '', f"Failed to extract stock status from {html_file}"
-    print(stock_status)
\ No newline at end of file
+    print(stock_status)
+
+def test_streaming_chunks():
+    """
+    Tests that streaming mode posts products in numbered chunks as they are parsed, then a completion marker.
+    """
+    urls = [f'https://www.amazon.com/dp/B00000000{i}' for i in range(5)]
+    spider = AmazonGetDetailsSpider(url=json.dumps(urls), job_id='1', chunk_size=2)
+    requests = list(spider.start_requests())
+    body = mock_response('fixtures/product_pages/test1.html').body
+    jobs = []
+    for request in requests[:4]:
+        jobs.extend(request.callback(TextResponse(url=request.url, request=request, body=body, encoding='utf-8')))
+    assert [job['sequence'] for job in jobs] == [1, 2]
+    assert len(jobs[0]['result']) == 2 and json.loads(jobs[1]['url']) == urls[2:4]
+    assert spider.products == []
+
+    failure = Failure(TimeoutError())
+    failure.request = requests[4]
+    jobs = list(requests[4].errback(failure))
+    assert [(job['sequence'], job['status']) for job in jobs] == [(3, 'in_progress'), (4, 'completed')]
+    assert jobs[0]['result'] == [] and jobs[0]['error'] == {urls[4]: 'TimeoutError'}
+    assert jobs[1]['chunks'] == 3 and jobs[1]['products'] == 4
+    assert jobs[1]['errors'] == 1 and jobs[1]['error'] == {}
+
+
+def test_streaming_errors_are_chunked():
+    """
+    Tests that in streaming mode failed URLs fill chunks like products, and are not kept once their chunk is posted.
+    """
+    urls = [f'https://www.amazon.com/dp/B00000000{i}' for i in range(5)]
+    spider = AmazonGetDetailsSpider(url=json.dumps(urls), job_id='1', chunk_size=2)
+    pending, jobs = list(spider.start_requests()), []
+    while pending:
+        request = pending.pop(0)
+        failure = Failure(TimeoutError())
+        failure.request = request
+        for output in request.errback(failure):
+            (pending if isinstance(output, Request) else jobs).append(output)
+    assert [len(job['error']) for job in jobs] == [2, 2, 1, 0]
+    assert jobs[-1]['errors'] == 5 and jobs[-1]['products'] == 0
+    assert spider.errors == {} and spider.chunk['errors'] == {}
+
+
+def test_single_job_without_chunks():
+    """
+    Tests that without chunking every product is posted in one job, and that a failed URL does not hold it up.
+    """
+    urls = ['https://www.amazon.com/dp/B000000001', 'https://www.amazon.com/dp/B000000002']
+    spider = AmazonGetDetailsSpider(url=json.dumps(urls), job_id='1')
+    first, second = spider.start_requests()
+    body = mock_response('fixtures/product_pages/test1.html').body
+    assert list(first.callback(TextResponse(url=first.url, request=first, body=body, encoding='utf-8'))) == []
+    failure = Failure(TimeoutError())
+    failure.request = second
+    job, = second.errback(failure)
+    assert job['status'] == 'completed' and len(job['result']) == 1
+    assert job['error'] == {urls[1]: 'TimeoutError'}
+
+
+def test_json_urls_requested_as_given():
+    """
+    Tests that the URLs of the JSON list keep their variant query and link form, and that only non-URLs are rejected.
+    """
+    urls = ['https://www.amazon.com/dp/B000000001?th=1&psc=1', 'https://amzn.to/3xYzAbC', 'B000000002', None]
+    spider = AmazonGetDetailsSpider(url=json.dumps(urls), job_id='1')
+    assert [request.url for request in spider.start_requests()] == urls[:2]
+    assert spider.errors == {'B000000002': 'invalid url', 'None': 'invalid url'}
+
+
+def test_lazy_url_file(tmp_path):
+    """
+    Tests that URLs are read from a file as requests complete, never more than read_ahead ahead of the crawl.
+    """
+    path = tmp_path / 'urls.txt'
+    path.write_text('B000000001\nhttps://www.amazon.com/gp/product/B000000002?th=1\nnot a url\n{"url": null}\n'
+                    '{bad json\nB000000003\n')
+    spider = AmazonGetDetailsSpider(urls_file=str(path), job_id='1', read_ahead=2)
+    requests = list(spider.start_requests())
+    assert [request.url for request in requests] == ['https://www.amazon.com/dp/B000000001',
+                                                     'https://www.amazon.com/dp/B000000002']
+    assert not spider.urls_exhausted
+
+    body = mock_response('fixtures/product_pages/test1.html').body
+    first = requests[0]
+    third, = first.callback(TextResponse(url=first.url, request=first, body=body, encoding='utf-8'))
+    assert third.url == 'https://www.amazon.com/dp/B000000003'
+    assert spider.in_flight == 2
+
+    for request in (requests[1], third):
+        failure = Failure(TimeoutError())
+        failure.request = request
+        jobs = list(request.errback(failure))
+    job, = jobs
+    assert job['status'] == 'completed' and len(job['result']) == 1 and job['url'] == str(path)
+    assert job['error'] == {'not a url': 'invalid url', '{"url": null}': 'invalid url', '{bad json': 'invalid url',
+                            requests[1].url: 'TimeoutError', third.url: 'TimeoutError'}
+
+
+def test_url_queue_acknowledged(tmp_path):
+    """
+    Tests that queue URLs are acknowledged once scraped or rejected, and that those in flight when the crawl stops
+    go back to the queue.
+    """
+    path = str(tmp_path / 'queue.db')
+    queue = UrlQueue(path)
+    queue.put(['B000000001', 'not a url', 'B000000002'])
+    spider = AmazonGetDetailsSpider(urls_queue=path, job_id='1')
+    first, second = spider.start_requests()
+    body = mock_response('fixtures/product_pages/test1.html').body
+    assert list(first.callback(TextResponse(url=first.url, request=first, body=body, encoding='utf-8'))) == []
+    assert [row['url'] for row in queue.db.execute('SELECT url FROM urls')] == ['B000000002']
+    spider.closed('shutdown')
+    assert queue.claim(10) == ['B000000002']
+    queue.close()
+
+
+def test_dropped_requests_are_done(tmp_path):
+    """
+    Tests that a product request dropped by the scheduler makes room for the next URL and is acknowledged.
+    """
+    path = str(tmp_path / 'queue.db')
+    queue = UrlQueue(path)
+    queue.put(['B000000001', 'https://www.amazon.com/dp/B000000001', 'B000000002'])
+    crawler = get_crawler(AmazonGetDetailsSpider)
+    requests = []
+    crawler.engine = SimpleNamespace(crawl=requests.append)
+    spider = AmazonGetDetailsSpider.from_crawler(crawler, urls_queue=path, job_id='1', read_ahead=2)
+    first, duplicate = spider.start_requests()
+    crawler.signals.send_catch_log(signals.request_dropped, request=duplicate, spider=spider)
+    assert spider.in_flight == 2
+    assert [request.url for request in requests] == ['https://www.amazon.com/dp/B000000002']
+    assert [row['url'] for row in queue.db.execute('SELECT url FROM urls')] == ['B000000001', 'B000000002']
+    spider.closed('shutdown')
+    queue.close()
+
@@ -5,7 +5,9 @@ from scrapy.http import Response, Request, TextResponse
 import cProfile
 import pstats
 
-from default.spiders.amazon_search import parse_products
+from default.spiders.amazon_search import parse_products, AmazonSearchSpider
+from twisted.internet.error import TimeoutError
+from twisted.python.failure import Failure
 
 
 def mock_response(file_name, url='http://example.com'):
@@ -46,3 +48,108 @@ def test_parse_products(html_file):
     assert len(products) > 0, f"Failed to extract products from {html_file}"
     print(json.dumps(products, indent=4))
 
+
+
+def test_search_pages_fetched_concurrently():
+    """
+    Tests that the pages needed for max_results are requested together, and that the job is posted in page order as
+    soon as the earliest pages hold enough distinct products.
+    """
+    spider = AmazonSearchSpider(url='https://www.amazon.com/s?k=laptop', job_id='1', max_results=40)
+    first_page = mock_response('fixtures/search_pages/test0.html').body
+    other_page = mock_response('fixtures/search_pages/test1.html').body
+
+    def reply(request, body):
+        response = TextResponse(url=request.url, request=request, body=body, encoding='utf-8')
+        return list(spider.parse(response))
+
+    requests = reply(next(spider.start_requests()), first_page)
+    # 16 results on page 1, 24 more needed
+    assert [request.url for request in requests] == ['https://www.amazon.com/s?k=laptop&page=2',
+                                                     'https://www.amazon.com/s?k=laptop&page=3']
+    # Page 3 cannot be used before page 2
+    assert reply(requests[1], other_page) == []
+    jobs = reply(requests[0], other_page)
+    assert len(jobs) == 1
+    results = jobs[0]['result']
+    product_ids = [product['product_id'] for product in results if product['product_id']]
+    assert len(results) == 40 and len(set(product_ids)) == len(product_ids)
+    assert results[0]['product_id'] == 'B0CFSBT85B'
+
+
+def test_search_stops_at_end_of_results():
+    """
+    Tests that pagination stops at a page that only repeats products already seen, and does not go past the pages
+    holding the number of results page 1 reports.
+    """
+    first_page = mock_response('fixtures/search_pages/test0.html').body
+    other_page = mock_response('fixtures/search_pages/test1.html').body
+
+    def reply(spider, request, body):
+        response = TextResponse(url=request.url, request=request, body=body, encoding='utf-8')
+        return list(spider.parse(response))
+
+    # Past the last page, Amazon serves the last page again
+    spider = AmazonSearchSpider(url='https://www.amazon.com/s?k=laptop', job_id='1', max_results=40)
+    requests = reply(spider, next(spider.start_requests()), first_page)
+    job, = reply(spider, requests[0], first_page)
+    assert len(job['result']) == 16
+    assert reply(spider, requests[1], other_page) == []
+
+    # "1-48 of 122 results": three pages at most, however many results are asked for
+    spider = AmazonSearchSpider(url='https://www.amazon.com/s?k=fish+bowl', job_id='2', max_results=200)
+    requests = reply(spider, next(spider.start_requests()), other_page)
+    assert spider.result_count == 122
+    assert [request.meta['search_page'] for request in requests] == [2, 3]
+    assert reply(spider, requests[0], first_page) == []
+    job, = reply(spider, requests[1], CARDS_PAGE.encode('utf-8'))
+    assert len(job['result']) == 48 + 16 + 2
+
+
+def test_failed_page_ends_results():
+    """
+    Tests that a results page that could not be downloaded ends the results like a blocked one, and the job is posted.
+    """
+    spider = AmazonSearchSpider(url='https://www.amazon.com/s?k=laptop', job_id='1', max_results=40)
+    first_page = mock_response('fixtures/search_pages/test0.html').body
+    first = next(spider.start_requests())
+    requests = list(spider.parse(TextResponse(url=first.url, request=first, body=first_page, encoding='utf-8')))
+    failure = Failure(TimeoutError())
+    failure.request = requests[0]
+    job, = requests[0].errback(failure)
+    assert len(job['result']) == 16 and job['error'] == {'search_page_2': 'TimeoutError'}
+    # Page 3 arrives after the job was posted
+    failure.request = requests[1]
+    assert list(requests[1].errback(failure)) == []
+
+
+CARDS_PAGE = '''<html><body><div class="s-main-slot">
+<div data-asin="B000000001"><div class="puis-card-container"><div class="a-section"><div class="puisg-row">
+  <img class="s-image" src="https://m.media-amazon.com/1.jpg">
+  <div data-cy="title-recipe"><h2><a class="a-link-normal" href="/dp/B000000009/"><span class="a-text-normal">First
+  laptop</span></a></h2></div>
+  <span class="a-price-whole">1,299.</span><span class="a-icon-alt">4.5 out of 5 stars</span>
+  <span class="s-coupon-unclipped">Save 5%</span>
+</div></div></div></div>
+<div data-asin=""><div class="puis-card-container"><div class="a-section"><div class="puisg-row">
+  <div class="a-row a-color-secondary"><h2><span class="a-size-medium">Lenovo</span></h2></div>
+  <a class="a-link-normal" href="/Second-Laptop/dp/B000000002/ref=sr_1_2">
+    <span class="a-size-medium a-color-base a-text-normal">Second laptop</span></a>
+  <span class="a-size-medium">Not the brand</span>
+  <span class="a-size-base a-color-price">Only 2 left in stock.</span>
+  <span class="s-coupon-clipped">Coupon applied</span><span class="s-coupon-unclipped">Save 5%</span>
+</div></div></div></div>
+</div></body></html>'''
+
+
+def test_parse_products_card_fields():
+    """
+    Tests the fields read from the one-pass index of each card, including the fallback queries.
+    """
+    response = TextResponse(url='https://www.amazon.com/s?k=laptop', body=CARDS_PAGE, encoding='utf-8')
+    first, second = parse_products(response)
+    assert first == {'product_id': 'B000000001', 'image_url': 'https://m.media-amazon.com/1.jpg',
+                     'title': 'First laptop', 'price': 1299.0, 'rating': 4.5, 'brand': None, 'stock': None,
+                     'discount': 'Save 5%'}
+    assert second == {'product_id': 'B000000002', 'image_url': None, 'title': 'Second laptop', 'price': 0,
+                      'rating': 0, 'brand': 'Lenovo', 'stock': 'Only 2 left in stock.', 'discount': 'Coupon applied'}
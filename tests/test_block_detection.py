@@ -0,0 +1,47 @@
+import os
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from default import signals
+from default.middlewares import BlockDetectionMiddleware
+from default.settings import BLOCK_SIGNATURES
+
+CAPTCHA_PAGE = b'''<html><head><title>Amazon.com</title></head><body>
+<p class="a-last">Sorry, we just need to make sure you're not a robot.</p>
+<form method="get" action="/errors/validateCaptcha"></form></body></html>'''
+
+
+def test_block_detection():
+    """
+    Tests that block pages are retried on another proxy session until the budget is spent, then flagged.
+    """
+    crawler = get_crawler(Spider)
+    spider = Spider.from_crawler(crawler, 'test')
+    blocked = []
+
+    def request_blocked(request, signature, **kwargs):
+        blocked.append(signature)
+
+    crawler.signals.connect(request_blocked, signal=signals.request_blocked)
+    middleware = BlockDetectionMiddleware(crawler, BLOCK_SIGNATURES, max_retry_times=1)
+
+    request = Request('https://www.amazon.com/dp/B000000001', meta={'proxy_session': 1})
+    response = HtmlResponse(request.url, body=CAPTCHA_PAGE, request=request)
+    retry_request = middleware.process_response(request, response, spider)
+    assert isinstance(retry_request, Request)
+    assert retry_request.dont_filter and retry_request.meta['proxy_session_avoid'] == [1]
+    assert blocked == [b'/errors/validateCaptcha']
+
+    retry_request.meta['proxy_session'] = 2
+    response = HtmlResponse(request.url, body=CAPTCHA_PAGE, request=retry_request)
+    given_up = middleware.process_response(retry_request, response, spider)
+    assert 'blocked' in given_up.flags
+
+    file_path = os.path.join(os.path.dirname(__file__), 'fixtures/product_pages/test1.html')
+    with open(file_path, 'rb') as file:
+        response = HtmlResponse(request.url, body=file.read(), request=request)
+    assert middleware.process_response(request, response, spider) is response
+    assert crawler.stats.get_value('block_detection/www.amazon.com/blocked') == 2
+    assert crawler.stats.get_value('block_detection/www.amazon.com/block_rate') == round(2 / 3, 3)
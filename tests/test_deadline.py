@@ -0,0 +1,40 @@
+import time
+
+import pytest
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from default.middlewares import DeadlineMiddleware
+
+
+def test_deadline_bounds_downloads():
+    """
+    Tests that each attempt of a request only gets the time left before its deadline, and that attempts left once it
+    has passed, retries included, are dropped.
+    """
+    crawler = get_crawler(Spider)
+    spider = Spider('test')
+    middleware = DeadlineMiddleware.from_crawler(crawler)
+    request = Request('https://www.amazon.com/dp/B000000001', errback=lambda failure: None,
+                      meta={'download_timeout': 180, 'download_deadline': time.monotonic() + 5})
+    middleware.process_request(request, spider)
+    assert 4 < request.meta['download_timeout'] <= 5
+    # Two seconds waiting in the slot queue
+    request.meta['download_deadline'] -= 2
+    middleware.request_reached_downloader(request, spider)
+    assert 2 < request.meta['download_timeout'] <= 3
+
+    # RetryMiddleware copies the meta of the request it retries
+    retry = request.replace(dont_filter=True)
+    retry.meta['download_deadline'] = time.monotonic() - 1
+    middleware.request_reached_downloader(retry, spider)
+    assert retry.meta['download_timeout'] == 0.001
+    with pytest.raises(IgnoreRequest):
+        middleware.process_request(retry, spider)
+    assert crawler.stats.get_value('deadline/dropped') == 1
+
+    plain = Request('https://www.amazon.com/dp/B000000002', meta={'download_timeout': 180})
+    middleware.process_request(plain, spider)
+    assert plain.meta['download_timeout'] == 180
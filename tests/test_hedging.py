@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+from scrapy.exceptions import IgnoreRequest, StopDownload
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet.error import TimeoutError
+
+from default.middlewares import HedgingMiddleware
+
+
+def download(middleware, spider, request, latency=0.5):
+    request.meta['download_latency'] = latency
+    return middleware.process_response(request, HtmlResponse(request.url, body=b'<html></html>', request=request),
+                                       spider)
+
+
+def test_hedging():
+    """
+    Tests that a slow request is sent again through another session, that the first answer wins and the other copy
+    is stopped, and that hedges stay within the budget of their job.
+    """
+    crawler = get_crawler(Spider, {'HEDGING_ENABLED': True, 'HEDGING_MIN_SAMPLES': 3})
+    spider = Spider.from_crawler(crawler, 'test')
+    hedges = []
+    crawler.engine = SimpleNamespace(crawl=hedges.append)
+    middleware = HedgingMiddleware.from_crawler(crawler)
+
+    def reach(asin, key=None):
+        request = Request(f'https://www.amazon.com/dp/{asin}',
+                          meta={'page_type': 'product', 'product_key': key or asin, 'proxy_session': 1})
+        middleware.request_reached_downloader(request, spider)
+        return request
+
+    # Nothing is hedged before enough latencies were seen
+    for i in range(3):
+        request = reach(f'B00000000{i}')
+        assert middleware.pairs[request.meta['hedge_key']]['timer'] is None
+        download(middleware, spider, request)
+    assert middleware.pairs == {}
+
+    request = reach('B000000005')
+    assert middleware.pairs[request.meta['hedge_key']]['timer'].active()
+    middleware.hedge(request, spider)
+    hedge, = hedges
+    assert hedge.meta['hedge'] and hedge.meta['proxy_session_avoid'] == [1]
+    assert hedge.dont_filter and hedge.priority == 10
+    # The hedge answers first, the request is stopped and dropped without calling its errback
+    assert download(middleware, spider, hedge, latency=0.2).request is hedge
+    with pytest.raises(StopDownload):
+        middleware.data_received(request=request, spider=spider, data=b'')
+    with pytest.raises(IgnoreRequest):
+        middleware.process_exception(request, StopDownload(fail=True), spider)
+    assert middleware.pairs == {}
+
+    # One hedge plus 10% of its requests per job
+    other = reach('B000000005?th=1', key='B000000005')
+    middleware.hedge(other, spider)
+    assert len(hedges) == 1
+    download(middleware, spider, other)
+
+    # A failed copy only counts once the other one failed too
+    request = reach('B000000006')
+    middleware.hedge(request, spider)
+    with pytest.raises(IgnoreRequest):
+        middleware.process_exception(request, TimeoutError(), spider)
+    assert middleware.process_exception(hedges[1], TimeoutError(), spider) is None
+    assert middleware.pairs == {}
+
+    stats = crawler.stats
+    assert stats.get_value('hedging/sent') == 2
+    assert stats.get_value('hedging/over_budget') == 1
+    assert stats.get_value('hedging/won_by_hedge') == 1
+    assert stats.get_value('hedging/dropped') == 2
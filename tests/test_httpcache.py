@@ -0,0 +1,103 @@
+import time
+
+from scrapy.http import HtmlResponse, Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from default.httpcache import SqliteCacheStorage
+
+PAGE = b'<html><body>' + b'<div class="a-section">Product details</div>' * 200 + b'</body></html>'
+
+
+def open_storage(tmp_path, **settings):
+    settings = dict({'HTTPCACHE_DIR': str(tmp_path), 'HTTPCACHE_EXPIRATION_SECS': 0,
+                     'HTTPCACHE_PAGE_TYPE_EXPIRATION': {'product': 60, 'qa': 3600}}, **settings)
+    crawler = get_crawler(Spider, settings)
+    spider = Spider.from_crawler(crawler, 'test')
+    storage = SqliteCacheStorage(crawler.settings)
+    storage.open_spider(spider)
+    return storage, spider
+
+
+def store(storage, spider, url, page_type, flags=None):
+    request = Request(url, meta={'page_type': page_type})
+    response = HtmlResponse(url, body=PAGE, headers={'Content-Type': 'text/html'}, flags=flags, request=request)
+    storage.store_response(spider, request, response)
+    return request
+
+
+def test_cache_storage(tmp_path):
+    """
+    Tests that responses come back whole from their compressed form, with the TTL of their page type.
+    """
+    storage, spider = open_storage(tmp_path)
+    product = store(storage, spider, 'https://www.amazon.com/dp/B000000001', 'product')
+    qa = store(storage, spider, 'https://www.amazon.com/ask/questions/asin/B000000001', 'qa')
+    assert storage.size < len(PAGE)
+
+    response = storage.retrieve_response(spider, product)
+    assert isinstance(response, HtmlResponse)
+    assert response.body == PAGE and response.headers[b'Content-Type'] == b'text/html'
+
+    # An hour later the product page is stale but the Q&A page is not
+    storage.db.execute('UPDATE responses SET stored_at = ?', (time.time() - 600,))
+    assert storage.retrieve_response(spider, product) is None
+    assert storage.retrieve_response(spider, qa).body == PAGE
+    assert storage.retrieve_response(spider, Request('https://www.amazon.com/dp/B000000002')) is None
+
+    # Block pages are never stored
+    blocked = store(storage, spider, 'https://www.amazon.com/dp/B000000003', 'product', flags=['blocked'])
+    assert storage.retrieve_response(spider, blocked) is None
+
+    stats = spider.crawler.stats
+    assert stats.get_value('httpcache/product/hit') == 1
+    assert stats.get_value('httpcache/product/stale') == 1
+    assert stats.get_value('httpcache/product/miss') == 1
+    assert stats.get_value('httpcache/qa/hit') == 1
+    assert stats.get_value('httpcache/other/miss') == 1
+    storage.close_spider(spider)
+
+
+def test_cache_eviction(tmp_path):
+    """
+    Tests that the least recently used responses are evicted once the cache goes over its size.
+    """
+    storage, spider = open_storage(tmp_path)
+    requests = [store(storage, spider, f'https://www.amazon.com/dp/B00000000{i}', 'product') for i in range(4)]
+    size = storage.size // 4
+    storage.close_spider(spider)
+
+    # Reopening reads the size back from the database
+    storage, spider = open_storage(tmp_path, HTTPCACHE_MAX_SIZE=int(size * 4.2))
+    assert storage.size == size * 4
+    storage.db.execute('UPDATE responses SET accessed_at = rowid')
+    assert storage.retrieve_response(spider, requests[0]) is not None
+    store(storage, spider, 'https://www.amazon.com/dp/B000000004', 'product')
+    # Down to 90% of the limit: the two least recently used go, the one just read stays
+    assert spider.crawler.stats.get_value('httpcache/evicted') == 2
+    assert storage.retrieve_response(spider, requests[0]) is not None
+    assert storage.retrieve_response(spider, requests[1]) is None
+    assert storage.retrieve_response(spider, requests[2]) is None
+    assert storage.retrieve_response(spider, requests[3]) is not None
+    storage.close_spider(spider)
+
+
+def test_cache_size_shared(tmp_path):
+    """
+    Tests that storages sharing the database, as processes do, keep one total size and evict against it.
+    """
+    first, first_spider = open_storage(tmp_path)
+    store(first, first_spider, 'https://www.amazon.com/dp/B000000000', 'product')
+    size = first.size
+    first.max_size = int(size * 3.5)
+    second, second_spider = open_storage(tmp_path, HTTPCACHE_MAX_SIZE=int(size * 3.5))
+    for i in range(1, 3):
+        store(second, second_spider, f'https://www.amazon.com/dp/B00000000{i}', 'product')
+    assert second.size == size * 3
+    # The first storage only stored one response, the total it reads has the two of the second
+    store(first, first_spider, 'https://www.amazon.com/dp/B000000003', 'product')
+    assert first_spider.crawler.stats.get_value('httpcache/evicted') == 1
+    assert first.read_size() == size * 3
+    assert first.db.execute('SELECT SUM(size) FROM responses').fetchone()[0] == size * 3
+    first.close_spider(first_spider)
+    second.close_spider(second_spider)
@@ -0,0 +1,76 @@
+from default.inputs import UrlQueue, normalize_product_url, read_urls_file
+
+
+def test_normalize_product_url():
+    """
+    Tests that every usual product link form and bare ASINs come out as the canonical product page URL.
+    """
+    canonical = 'https://www.amazon.com/dp/B08YKHGKT1'
+    assert normalize_product_url('B08YKHGKT1') == canonical
+    assert normalize_product_url(' https://www.amazon.com/dp/B08YKHGKT1?th=1&psc=1 ') == canonical
+    assert normalize_product_url('https://WWW.Amazon.com/Some-Product/dp/B08YKHGKT1/ref=sr_1_1') == canonical
+    assert normalize_product_url('https://www.amazon.com/gp/product/B08YKHGKT1') == canonical
+    assert normalize_product_url('https://www.amazon.com/product-reviews/B08YKHGKT1/') == canonical
+    assert normalize_product_url('B08YKHGKT1', domain='www.amazon.ca') == 'https://www.amazon.ca/dp/B08YKHGKT1'
+    assert normalize_product_url('https://www.amazon.com/s?k=laptop') is None
+    assert normalize_product_url('not a url') is None
+    assert normalize_product_url(None) is None
+
+
+def test_url_sources(tmp_path):
+    """
+    Tests that URLs are read from plain text and JSON lines files, bad lines included, and claimed once from a queue.
+    """
+    path = tmp_path / 'urls.txt'
+    path.write_text('# products\nB000000001\n\n"https://www.amazon.com/dp/B000000002"\n'
+                    '{"url": "https://www.amazon.com/dp/B000000003"}\n{bad json\n{"url": null}\nB000000004\n')
+    assert list(read_urls_file(path)) == ['B000000001', 'https://www.amazon.com/dp/B000000002',
+                                          'https://www.amazon.com/dp/B000000003', '{bad json', '{"url": null}',
+                                          'B000000004']
+
+    queue = UrlQueue(str(tmp_path / 'queue.db'))
+    queue.put(f'B00000000{i}' for i in range(5))
+    assert queue.claim(2) == ['B000000000', 'B000000001']
+    assert queue.pending() == 3
+    assert list(queue) == ['B000000002', 'B000000003', 'B000000004']
+    assert queue.claim(2) == []
+    queue.close()
+
+
+def test_url_queue_acknowledgements(tmp_path):
+    """
+    Tests that claimed URLs stay in the queue until acknowledged, and are handed out again once released or once
+    their lease ran out.
+    """
+    path = str(tmp_path / 'queue.db')
+    queue = UrlQueue(path)
+    queue.put(['B000000001', 'B000000002', 'B000000003'])
+    assert queue.claim(3) == ['B000000001', 'B000000002', 'B000000003']
+    queue.ack('B000000001')
+    queue.release(['B000000002'])
+    assert queue.claim(3) == ['B000000002']
+    queue.close()
+
+    # The crawl holding B000000002 and B000000003 died, the next one gets them once the lease ran out
+    queue = UrlQueue(path, lease=60)
+    assert queue.claim(3) == []
+    queue.db.execute('UPDATE urls SET claimed_at = claimed_at - 60')
+    assert queue.claim(3) == ['B000000002', 'B000000003']
+    queue.close()
+
+
+def test_url_queue_releases_claimed_batch(tmp_path):
+    """
+    Tests that releasing the claimed URLs puts back the whole batch, the URLs never iterated included.
+    """
+    path = str(tmp_path / 'queue.db')
+    queue = UrlQueue(path, batch=3)
+    queue.put(['B000000001', 'B000000002', 'B000000003', 'B000000004'])
+    urls = iter(queue)
+    assert next(urls) == 'B000000001'
+    queue.ack('B000000001')
+    assert queue.claimed == {'B000000002', 'B000000003'}
+    assert queue.pending() == 1
+    queue.release_claimed()
+    assert queue.claimed == set() and queue.pending() == 3
+    queue.close()
@@ -0,0 +1,97 @@
+import pytest
+from scrapy.exceptions import NotConfigured
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from default import metrics
+from default.extensions import LatencyMetrics
+
+
+def test_histogram_percentiles():
+    """
+    Tests that percentiles are read from the fixed buckets and capped at the largest observation.
+    """
+    histogram = metrics.Histogram()
+    assert histogram.percentile(50) is None
+    for _ in range(90):
+        histogram.observe(0.003)
+    for _ in range(10):
+        histogram.observe(0.2)
+    assert histogram.percentile(50) == 0.005
+    assert histogram.percentile(95) == 0.2
+    assert histogram.percentile(99) == 0.2
+    assert histogram.bucket_counts() == {'<=5ms': 90, '<=250ms': 10}
+
+    earlier = histogram.copy()
+    histogram.observe(60)
+    recent = histogram.since(earlier)
+    assert recent.count == 1
+    assert recent.bucket_counts() == {'>30000ms': 1}
+
+
+def test_timeit(monkeypatch):
+    """
+    Tests that timeit leaves functions untouched when disabled and times generators while they are iterated.
+    """
+    def callback(count):
+        for i in range(count):
+            yield i
+
+    monkeypatch.setattr(metrics, 'TIMING_ENABLED', False)
+    assert metrics.timeit(callback) is callback
+
+    monkeypatch.setattr(metrics, 'TIMING_ENABLED', True)
+    monkeypatch.setattr(metrics, 'histograms', {})
+    timed = metrics.timeit(callback)
+    generator = timed(3)
+    assert metrics.histograms == {}
+    assert list(generator) == [0, 1, 2]
+    assert metrics.histograms['test_metrics.test_timeit.<locals>.callback'].count == 1
+    timed_sum = metrics.timeit(sum)
+    assert timed_sum([1, 2]) == 3
+    assert metrics.histograms['builtins.sum'].count == 1
+
+
+def test_latency_metrics_extension(monkeypatch):
+    """
+    Tests that the extension writes the percentiles of the observations made by its own crawl, and not those of
+    another crawl in the same process or of code running outside any crawl.
+    """
+    monkeypatch.setattr(metrics, 'TIMING_ENABLED', False)
+    with pytest.raises(NotConfigured):
+        LatencyMetrics.from_crawler(get_crawler(Spider))
+
+    monkeypatch.setattr(metrics, 'TIMING_ENABLED', True)
+    monkeypatch.setattr(metrics, 'histograms', {})
+    clock = iter(range(0, 100, 2))
+    monkeypatch.setattr(metrics.time, 'perf_counter', lambda: next(clock) / 1000)
+
+    @metrics.timeit
+    def get_title(response):
+        return 'title'
+
+    class TimedSpider(Spider):
+        name = 'test'
+
+        @metrics.timeit
+        def parse(self, response):
+            yield get_title(response)
+
+    crawls = []
+    for _ in range(2):
+        crawler = get_crawler(TimedSpider)
+        extension = LatencyMetrics.from_crawler(crawler)
+        crawls.append((TimedSpider.from_crawler(crawler), crawler, extension))
+    get_title(None)
+    first, second = (spider.parse(None) for spider, _, _ in crawls)
+    # The callbacks of the two crawls are iterated in turns, as the engine does
+    assert next(first) == next(second) == 'title'
+    assert list(first) == list(second) == []
+    list(crawls[0][0].parse(None))
+    for spider, crawler, extension in crawls:
+        extension.spider_closed(spider)
+    name = 'test_metrics.test_latency_metrics_extension.<locals>.get_title'
+    assert crawls[0][1].stats.get_value(f'timing/{name}/count') == 2
+    assert crawls[1][1].stats.get_value(f'timing/{name}/count') == 1
+    assert crawls[0][1].stats.get_value(f'timing/{name}/p50_ms') == 2
+    assert metrics.histograms[name].count == 1
@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp import web
+from scrapy.exceptions import NotConfigured
+from scrapy.spiders import Spider
+from scrapy.statscollectors import MemoryStatsCollector
+from scrapy.utils.test import get_crawler
+
+from default.pipelines import HttpPipeline
+
+
+class JobSpider(Spider):
+    name = 'test'
+
+    def __init__(self, *args, **kwargs):
+        super(JobSpider, self).__init__(*args, **kwargs)
+        self.closed_jobs = []
+
+    def close_job(self, job):
+        self.closed_jobs.append(job['job_id'])
+
+
+async def deliver(items, statuses, spider=None, **kwargs):
+    """
+    Run HttpPipeline against a local endpoint answering with the given statuses, then with 200.
+    :return: The bodies received by the endpoint and the pipeline stats.
+    """
+    received = []
+    statuses = list(statuses)
+
+    async def update(request):
+        received.append(json.loads(await request.text()))
+        return web.Response(status=statuses.pop(0) if statuses else 200)
+
+    app = web.Application()
+    app.router.add_post('/api/v1/scrapy/update', update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    spider = spider or Spider('test')
+    stats = MemoryStatsCollector(get_crawler(Spider))
+    pipeline = HttpPipeline(f'http://127.0.0.1:{port}', stats, retry_backoff=0.01, **kwargs)
+    pipeline.open_spider(spider)
+    for item in items:
+        await pipeline.process_item(item, spider)
+    await pipeline.drain()
+    await runner.cleanup()
+    return received, stats.get_stats()
+
+
+def test_http_pipeline_batches_and_retries():
+    """
+    Tests that queued items are posted in batches and that server errors are retried.
+    """
+    items = [{'job_id': str(i)} for i in range(3)]
+    received, stats = asyncio.run(deliver(items, [503], batch_size=2, concurrency=1))
+    # The sender starts once the three items are queued: a retried batch of two, then the last item on its own
+    assert received == [[{'job_id': '0'}, {'job_id': '1'}], [{'job_id': '0'}, {'job_id': '1'}], {'job_id': '2'}]
+    assert stats['http_pipeline/items_posted'] == 3
+    assert stats['http_pipeline/retries'] == 1
+    assert stats['http_pipeline/delivery_latency/count'] == 3
+    assert stats['http_pipeline/request_latency/count'] == 2
+
+
+def test_http_pipeline_gives_up():
+    """
+    Tests that client errors are not retried and that retries stop after HTTP_PIPELINE_MAX_RETRIES.
+    """
+    received, stats = asyncio.run(deliver([{'job_id': '1'}], [400]))
+    assert len(received) == 1
+    assert stats['http_pipeline/items_failed'] == 1
+
+    received, stats = asyncio.run(deliver([{'job_id': '1'}], [500, 500, 500], max_retries=2))
+    assert len(received) == 3
+    assert stats['http_pipeline/items_failed'] == 1
+
+
+def test_http_pipeline_skips_unserializable_items():
+    """
+    Tests that a batch that cannot be serialized is counted as failed without stopping its sender.
+    """
+    items = [{'job_id': '1', 'result': object()}, {'job_id': '2'}]
+    received, stats = asyncio.run(deliver(items, [], concurrency=1))
+    assert received == [{'job_id': '2'}]
+    assert stats['http_pipeline/items_failed'] == 1
+    assert stats['http_pipeline/items_posted'] == 1
+
+
+def test_http_pipeline_requires_service_url(caplog):
+    """
+    Tests that the pipeline is disabled with a warning when SERVICE_URL is not set.
+    """
+    with pytest.raises(NotConfigured):
+        HttpPipeline.from_crawler(get_crawler(Spider, {'SERVICE_URL': None}))
+    assert [record.levelname for record in caplog.records] == ['WARNING']
+
+
+def test_http_pipeline_closes_jobs_once_acknowledged():
+    """
+    Tests that close_job is called for every delivered job, and only for those.
+    """
+    spider = JobSpider()
+    items = [{'job_id': str(i)} for i in range(6)]
+    received, stats = asyncio.run(deliver(items, [400], spider=spider, max_retries=0))
+    assert len(received) == 6
+    assert stats['http_pipeline/items_failed'] == 1
+    # The first POST received was rejected
+    rejected = received[0]['job_id']
+    assert sorted(spider.closed_jobs) == [item['job_id'] for item in items if item['job_id'] != rejected]
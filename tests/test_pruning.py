@@ -0,0 +1,47 @@
+import pytest
+
+from default.pruning import declared_encoding, prune_html
+from default.settings import HTML_PRUNING
+from default.spiders.amazon import parse_product_page
+from helpers import get_all_html_files, mock_response
+
+
+def test_prune_html():
+    """
+    Tests that pruned regions keep their tags and attributes but lose their contents.
+    """
+    body = (b'<p>a<!-- <script> -->b<SCRIPT type="x">var a = "<b>";</script >c<svg/>d'
+            b'<svg id="s"><g></g></svg><style>p {}</style>')
+    assert prune_html(body, ['script', 'style', 'svg', 'comment']) == (
+        b'<p>a<!---->b<SCRIPT type="x"></script>c<svg/>d<svg id="s"></svg><style></style>')
+    assert prune_html(body, ['style']) == body.replace(b'p {}', b'')
+    assert prune_html(b'<p>a<script>unterminated', ['script']) == b'<p>a<script>unterminated'
+    with pytest.raises(ValueError):
+        prune_html(body, ['ads'])
+
+
+def test_declared_encoding():
+    """
+    Tests that the declared charset is read from the header first, then from the <meta> tag.
+    """
+    body = b'<html><head><meta charset="utf-8"/></head></html>'
+    assert declared_encoding(body, 'text/html; charset=ISO-8859-1') == 'ISO-8859-1'
+    assert declared_encoding(body, 'text/html') == 'utf-8'
+    assert declared_encoding(b'<html></html>') is None
+
+
+@pytest.mark.parametrize('html_file', get_all_html_files('fixtures/product_pages'))
+def test_pruning_keeps_product_data(html_file):
+    """
+    Tests that every product page extractor returns the same data on the pruned page.
+    """
+    url = 'https://www.amazon.com/dp/B08YKHGKTV'
+    response = mock_response(html_file, url=url)
+    product, reviews = parse_product_page(response, '123')
+    pruned = response.replace(body=prune_html(response.body, HTML_PRUNING['product']))
+    pruned_product, pruned_reviews = parse_product_page(pruned, '123')
+    for key in ('created_at', 'updated_at'):
+        product.pop(key)
+        pruned_product.pop(key)
+    assert pruned_product == product
+    assert pruned_reviews == reviews
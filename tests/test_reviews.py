@@ -0,0 +1,39 @@
+import pytest
+
+from default.reviews import ReviewAggregator, review_fingerprint
+from default.spiders.amazon import get_reviews
+from helpers import mock_response
+
+
+def test_review_fingerprint():
+    """
+    Tests that the fingerprint ignores the author, case and whitespace but not the rating or text.
+    """
+    review = {'rating': 4.0, 'text': 'Great  laptop', 'author': 'A'}
+    assert review_fingerprint(review) == review_fingerprint({'rating': 4.0, 'text': 'great laptop', 'author': 'B'})
+    assert review_fingerprint(review) != review_fingerprint({'rating': 5.0, 'text': 'Great laptop'})
+    assert review_fingerprint(review) != review_fingerprint({'rating': 4.0, 'text': 'Bad laptop'})
+
+
+def test_merge_review_streams():
+    """
+    Tests that merging keeps the first copy of every review, in stream order, and strips authors in place.
+    """
+    critical = [{'author': 'A', 'rating': 1.0, 'text': 'Broke'}, {'author': 'B', 'rating': 2.0, 'text': 'Meh'}]
+    positive = [{'author': 'C', 'rating': 5.0, 'text': 'Love it'}]
+    default = [dict(critical[0]), {'author': 'Amazon Customer', 'rating': 5.0, 'text': 'Fast'},
+               {'author': 'Amazon Customer', 'rating': 3.0, 'text': 'Slow'}]
+    aggregator = ReviewAggregator()
+    merged = aggregator.merge(critical, positive, default)
+    assert [review['text'] for review in merged] == ['Broke', 'Meh', 'Love it', 'Fast', 'Slow']
+    assert aggregator.strip_authors() is merged
+    assert all('author' not in review for review in merged)
+
+
+@pytest.mark.parametrize('html_file', ['fixtures/critical_reviews.html'])
+def test_get_reviews_skips_known_reviews(html_file):
+    """
+    Tests that get_reviews does not add reviews already in the list it is given.
+    """
+    reviews = get_reviews(mock_response(html_file), [])
+    assert len(get_reviews(mock_response(html_file), list(reviews))) == len(reviews)
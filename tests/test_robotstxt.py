@@ -0,0 +1,80 @@
+import inspect
+from types import SimpleNamespace
+
+from scrapy.downloadermiddlewares.robotstxt import RobotsTxtMiddleware
+from scrapy.http import Request, TextResponse
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+from default.middlewares import CachedRobotsTxtMiddleware
+
+ROBOTS_TXT = b'User-agent: *\nDisallow: /gp/cart\n'
+
+
+def test_robotstxt_cache(tmp_path):
+    """
+    Tests that a downloaded robots.txt is reused by the next crawl without being fetched again, until it expires.
+    """
+    settings = {'ROBOTSTXT_OBEY': True, 'ROBOTSTXT_CACHE_PATH': str(tmp_path / 'robotstxt.db')}
+    spider = Spider('test')
+    request = Request('https://www.amazon.com/dp/B000000001')
+
+    crawler = get_crawler(Spider, settings)
+    middleware = CachedRobotsTxtMiddleware(crawler)
+    middleware._parsers['www.amazon.com'] = Deferred()
+    robots_request = Request('https://www.amazon.com/robots.txt')
+    middleware._parse_robots(TextResponse(robots_request.url, body=ROBOTS_TXT, request=robots_request),
+                             'www.amazon.com', spider)
+
+    crawler = get_crawler(Spider, settings)
+    parser = CachedRobotsTxtMiddleware(crawler).robot_parser(request, spider)
+    assert not isinstance(parser, Deferred)
+    assert parser.allowed('https://www.amazon.com/dp/B000000001', 'Scrapy')
+    assert not parser.allowed('https://www.amazon.com/gp/cart', 'Scrapy')
+    assert crawler.stats.get_value('robotstxt/cache_hit') == 1
+
+    # Expired: robots.txt is downloaded again
+    crawler = get_crawler(Spider, dict(settings, ROBOTSTXT_CACHE_TTL=-1))
+    downloads = []
+    crawler.engine = SimpleNamespace(download=lambda robots_request: downloads.append(robots_request) or Deferred())
+    assert isinstance(CachedRobotsTxtMiddleware(crawler).robot_parser(request, spider), Deferred)
+    assert [robots_request.url for robots_request in downloads] == ['https://www.amazon.com/robots.txt']
+    assert crawler.stats.get_value('robotstxt/cache_miss') == 1
+
+
+def test_robotstxt_cache_hooks(tmp_path):
+    """
+    Tests that the RobotsTxtMiddleware internals the cache relies on are still there: the _parsers of the crawl, the
+    _parserimpl that builds them and _parse_robots, through which a robots.txt downloaded by the stock robot_parser
+    goes. Server errors and block pages are not stored, of a 4xx only the status is.
+    """
+    assert list(inspect.signature(RobotsTxtMiddleware._parse_robots).parameters) == [
+        'self', 'response', 'netloc', 'spider']
+    assert list(inspect.signature(RobotsTxtMiddleware.robot_parser).parameters) == ['self', 'request', 'spider']
+    settings = {'ROBOTSTXT_OBEY': True, 'ROBOTSTXT_CACHE_PATH': str(tmp_path / 'robotstxt.db')}
+    spider = Spider('test')
+    crawler = get_crawler(Spider, settings)
+    downloads = []
+
+    def download(robots_request):
+        deferred = Deferred()
+        downloads.append((robots_request, deferred))
+        return deferred
+
+    crawler.engine = SimpleNamespace(download=download)
+    middleware = CachedRobotsTxtMiddleware(crawler)
+    assert middleware._parsers == {} and hasattr(middleware._parserimpl, 'from_crawler')
+    parsers = []
+    domains = ('www.amazon.com', 'www.amazon.ca', 'www.amazon.de', 'www.amazon.fr')
+    for domain in domains:
+        middleware.robot_parser(Request(f'https://{domain}/dp/B000000001'), spider).addCallback(parsers.append)
+    for (robots_request, deferred), status, flags in zip(downloads, (200, 503, 200, 403),
+                                                           (None, None, ['blocked'], None)):
+        deferred.callback(TextResponse(robots_request.url, status=status, body=ROBOTS_TXT, request=robots_request,
+                                       flags=flags))
+    assert len(parsers) == 4
+    assert not parsers[0].allowed('https://www.amazon.com/gp/cart', 'Scrapy')
+    assert middleware._parsers['www.amazon.com'] is parsers[0]
+    rows = middleware.db.execute('SELECT netloc, status, body FROM robotstxt ORDER BY netloc').fetchall()
+    assert [tuple(row) for row in rows] == [('www.amazon.com', 200, ROBOTS_TXT), ('www.amazon.fr', 403, b'')]
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+from scrapy.http import Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+
+from default.middlewares import ProxySessionPoolMiddleware
+from default.proxies import ProxySessionPool
+from default.scheduler import SlotAwareScheduler
+
+
+def test_slot_aware_scheduler():
+    """
+    Tests that requests are held back while their download slot is full, then handed over by priority, oldest first.
+    """
+    crawler = get_crawler(Spider, {'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue'})
+    slot = SimpleNamespace(concurrency=2, queue=[])
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={'www.amazon.com': slot}))
+    spider = Spider.from_crawler(crawler, 'test')
+    scheduler = SlotAwareScheduler.from_crawler(crawler)
+    scheduler.open(spider)
+
+    for url in ('https://www.amazon.com/dp/B000000001', 'https://www.amazon.com/dp/B000000002'):
+        scheduler.enqueue_request(Request(url))
+    scheduler.enqueue_request(Request('https://www.amazon.com/product-reviews/B000000001/?pageNumber=2',
+                                      priority=10))
+    slot.queue = [None, None]
+    assert scheduler.next_request() is None
+    assert scheduler.has_pending_requests()
+    assert crawler.stats.get_value('scheduler/held_back') == 3
+    assert len(scheduler) == 3
+
+    slot.queue = [None]
+    urls = [scheduler.next_request().url for _ in range(3)]
+    assert urls == ['https://www.amazon.com/product-reviews/B000000001/?pageNumber=2',
+                    'https://www.amazon.com/dp/B000000001', 'https://www.amazon.com/dp/B000000002']
+    scheduler.close('finished')
+
+
+def test_full_slot_holds_back_its_host_only():
+    """
+    Tests that while one host's slot is full, the requests of the other hosts are still handed over, and the held
+    requests follow by priority once their slot has room again.
+    """
+    crawler = get_crawler(Spider, {'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue'})
+    amazon = SimpleNamespace(concurrency=1, queue=[None])
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(slots={'www.amazon.com': amazon}))
+    spider = Spider.from_crawler(crawler, 'test')
+    scheduler = SlotAwareScheduler.from_crawler(crawler)
+    scheduler.open(spider)
+
+    scheduler.enqueue_request(Request('https://www.amazon.com/dp/B000000001', priority=10))
+    scheduler.enqueue_request(Request('https://www.amazon.co.uk/dp/B000000002'))
+    scheduler.enqueue_request(Request('https://www.amazon.com/dp/B000000003'))
+    scheduler.enqueue_request(Request('https://www.amazon.co.uk/dp/B000000004'))
+    assert scheduler.next_request().url == 'https://www.amazon.co.uk/dp/B000000002'
+    assert scheduler.next_request().url == 'https://www.amazon.co.uk/dp/B000000004'
+    assert scheduler.next_request() is None
+    assert len(scheduler) == 2
+
+    # A request scheduled later does not overtake the held ones, whatever its host
+    scheduler.enqueue_request(Request('https://www.amazon.co.uk/dp/B000000005'))
+    amazon.queue = []
+    urls = [scheduler.next_request().url for _ in range(3)]
+    assert urls == ['https://www.amazon.com/dp/B000000001', 'https://www.amazon.com/dp/B000000003',
+                    'https://www.amazon.co.uk/dp/B000000005']
+    assert not scheduler.has_pending_requests()
+    assert crawler.stats.get_value('scheduler/dequeued') == 5
+    scheduler.close('finished')
+
+
+def test_scheduler_waits_for_proxy_sessions():
+    """
+    Tests that requests wait in the scheduler while every proxy session is busy, and that those sent without the
+    pool go on.
+    """
+    crawler = get_crawler(Spider, {'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue'})
+    spider = Spider.from_crawler(crawler, 'test')
+    pool = ProxySessionPool('user', 'secret', 'proxy.example.com', size=1, max_in_flight=1)
+    middleware = ProxySessionPoolMiddleware(pool, crawler.stats)
+    crawler.engine = SimpleNamespace(downloader=SimpleNamespace(
+        slots={}, middleware=SimpleNamespace(middlewares=[middleware])))
+    scheduler = SlotAwareScheduler.from_crawler(crawler)
+    scheduler.open(spider)
+
+    scheduler.enqueue_request(Request('https://www.amazon.com/dp/B000000001'))
+    scheduler.enqueue_request(Request('https://www.amazon.com/dp/B000000002'))
+    scheduler.enqueue_request(Request('https://www.amazon.com/dp/B000000003', meta={'proxy': 'http://other:8080'}))
+    first = scheduler.next_request()
+    middleware.process_request(first, spider)
+    assert scheduler.next_request().url == 'https://www.amazon.com/dp/B000000003'
+    assert scheduler.next_request() is None
+    middleware.request_left_downloader(first, spider)
+    assert scheduler.next_request().url == 'https://www.amazon.com/dp/B000000002'
+    scheduler.close('finished')
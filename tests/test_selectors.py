@@ -0,0 +1,31 @@
+import pytest
+
+from default.selectors import compile_query, evaluate, node_to_text
+from helpers import get_all_html_files, mock_response
+
+
+def test_compile_query_is_cached():
+    """
+    Tests that a query is compiled only once per process.
+    """
+    assert compile_query('#productTitle::text') is compile_query('#productTitle::text')
+    assert compile_query('//title/text()', query_type='xpath') is compile_query('//title/text()', query_type='xpath')
+    with pytest.raises(ValueError):
+        compile_query('//title', query_type='jsonpath')
+
+
+@pytest.mark.parametrize('html_file', get_all_html_files('fixtures/product_pages'))
+@pytest.mark.parametrize('query, query_type', [
+    ('#productTitle::text', 'css'),
+    ('div[data-hook="review"]', 'css'),
+    ('span.a-price span[aria-hidden="true"]::text', 'css'),
+    ("//div[@id='imgTagWrapperId']/img/@src", 'xpath'),
+    ('string(.//span[@data-hook="review-body"]//span)', 'xpath'),
+])
+def test_evaluate_matches_parsel(html_file, query, query_type):
+    """
+    Tests that evaluating a compiled query returns the same data as parsel.
+    """
+    response = mock_response(html_file)
+    expected = response.css(query).getall() if query_type == 'css' else response.xpath(query).getall()
+    assert [node_to_text(node) for node in evaluate(response, query, query_type)] == expected
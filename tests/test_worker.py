@@ -0,0 +1,147 @@
+import json
+import sqlite3
+
+from scrapy.settings import Settings
+from twisted.internet import defer
+from twisted.web.test.requesthelper import DummyRequest
+
+from default.worker import JobQueue, Worker, create_site
+
+
+def test_job_queue(tmp_path):
+    """
+    Tests that jobs are claimed oldest first, finished, and requeued when a worker stopped while running them.
+    """
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    first = queue.put('amazon', {'url': 'https://www.amazon.com/dp/B000000001', 'job_id': '1'})
+    second = queue.put('amazon_search', {'url': 'https://www.amazon.com/s?k=laptop'}, {'LOG_LEVEL': 'INFO'},
+                       job_id='search')
+    assert second == 'search'
+
+    job = queue.claim()
+    assert job['id'] == first
+    assert job['args'] == {'url': 'https://www.amazon.com/dp/B000000001', 'job_id': '1'}
+    assert queue.claim()['settings'] == {'LOG_LEVEL': 'INFO'}
+    assert queue.claim() is None
+    assert queue.counts() == {'running': 2}
+
+    queue.finish(first)
+    queue.finish(second, error='boom')
+    assert queue.counts() == {'finished': 1, 'failed': 1}
+    assert queue.list('failed')[0]['error'] == 'boom'
+
+    third = queue.put('amazon', {})
+    queue.claim()
+    # A new worker on the same database picks the interrupted job up again
+    queue = JobQueue(str(tmp_path / 'jobs.db'))
+    assert queue.requeue_running() == 1
+    assert queue.claim()['id'] == third
+
+
+def create_worker(tmp_path, max_jobs=2):
+    """
+    Create a worker whose runner records the crawls it is asked to start instead of running them.
+    :return: The worker and the list of (job id, spider arguments, deferred) of the started crawls.
+    """
+    settings = Settings({'SPIDER_MODULES': ['default.spiders'], 'WORKER_CONCURRENT_JOBS': max_jobs})
+    worker = Worker(settings, JobQueue(str(tmp_path / 'jobs.db')))
+    started = []
+
+    def crawl(crawler, _job, **kwargs):
+        deferred = defer.Deferred()
+        started.append((_job, kwargs, deferred))
+        return deferred
+
+    worker.runner.crawl = crawl
+    return worker, started
+
+
+def call(worker, path, method=b'GET', **args):
+    """Render an endpoint of the worker's site and return the decoded JSON body and the response code."""
+    request = DummyRequest([b''])
+    request.method = method
+    request.args = {key.encode('utf-8'): [value.encode('utf-8') for value in values] for key, values in args.items()}
+    body = create_site(worker).resource.getChildWithDefault(path, request).render(request)
+    return json.loads(body), request.responseCode
+
+
+def test_worker_runs_jobs(tmp_path):
+    """
+    Tests that the worker runs up to WORKER_CONCURRENT_JOBS jobs at a time, starts the next one as soon as a job
+    ends, and records the jobs that failed or could not start.
+    """
+    worker, started = create_worker(tmp_path)
+    for job_id in ('1', '2', '3'):
+        worker.queue.put('amazon', {'url': f'https://www.amazon.com/dp/B00000000{job_id}'}, job_id=job_id)
+    worker.queue.put('no_such_spider', job_id='4')
+    worker.poll()
+    assert [job_id for job_id, _, _ in started] == ['1', '2']
+    assert started[0][1] == {'url': 'https://www.amazon.com/dp/B000000001'}
+    assert worker.queue.counts() == {'running': 2, 'pending': 2}
+
+    started[0][2].callback(None)
+    # Job 3 took the free slot
+    assert [job_id for job_id, _, _ in started] == ['1', '2', '3']
+    started[1][2].errback(RuntimeError('crawl failed'))
+    # Job 4 could not start, its slot stays free
+    assert len(started) == 3 and list(worker.running) == ['3']
+    started[2][2].callback(None)
+    assert worker.running == {}
+    assert worker.queue.counts() == {'finished': 2, 'failed': 2}
+    errors = {job['id']: job['error'] for job in worker.queue.list('failed')}
+    assert errors['2'] == 'crawl failed' and 'no_such_spider' in errors['4']
+
+
+def test_worker_keeps_polling_after_claim_errors(tmp_path):
+    """
+    Tests that a claim failing, e.g. on a locked database, does not stop the poller, and that the next poll runs the
+    job.
+    """
+    worker, started = create_worker(tmp_path)
+    worker.queue.put('amazon', {'url': 'https://www.amazon.com/dp/B000000001'}, job_id='1')
+    claim = worker.queue.claim
+
+    def locked():
+        raise sqlite3.OperationalError('database is locked')
+
+    worker.queue.claim = locked
+    worker.start()
+    try:
+        assert worker.poller.running and started == []
+        worker.queue.claim = claim
+        worker.poll()
+        assert [job_id for job_id, _, _ in started] == ['1']
+    finally:
+        worker.poller.stop()
+
+
+def test_worker_endpoints(tmp_path):
+    """
+    Tests that jobs are scheduled and listed through the scrapyd compatible endpoints.
+    """
+    worker, started = create_worker(tmp_path, max_jobs=1)
+    data, _ = call(worker, b'schedule.json', b'POST', project=['default'], spider=['amazon'], jobid=['1'],
+                   url=['https://www.amazon.com/dp/B000000001'], setting=['LOG_LEVEL=INFO'])
+    assert data['status'] == 'ok' and data['jobid'] == '1'
+    # Scheduled jobs start right away, with their own settings
+    job_id, args, _ = started[0]
+    assert job_id == '1' and args == {'url': 'https://www.amazon.com/dp/B000000001'}
+    assert worker.running['1'].settings.get('LOG_LEVEL') == 'INFO'
+    data, _ = call(worker, b'schedule.json', b'POST', spider=['amazon_search'], url=['https://www.amazon.com/s?k=a'])
+    second = data['jobid']
+
+    data, _ = call(worker, b'listjobs.json')
+    assert [job['id'] for job in data['running']] == ['1']
+    assert [job['id'] for job in data['pending']] == [second]
+    data, _ = call(worker, b'daemonstatus.json')
+    assert (data['pending'], data['running'], data['finished']) == (1, 1, 0)
+
+    started[0][2].callback(None)
+    data, _ = call(worker, b'listjobs.json')
+    assert [job['id'] for job in data['finished']] == ['1']
+    assert [job['id'] for job in data['running']] == [second]
+
+    data, code = call(worker, b'schedule.json', b'POST', spider=['no_such_spider'])
+    assert code == 400 and data['status'] == 'error' and 'no_such_spider' in data['message']
+    data, code = call(worker, b'schedule.json', b'POST')
+    assert code == 400 and data['message'] == "'spider' is required"